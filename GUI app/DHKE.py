@@ -1,19 +1,74 @@
 # DHKE.py
+#
+# p and g are the "file" group from Prime.txt and g.txt; groups.py loads
+# that and the standard groups by ID.
+#
+# Modular exponentiation goes through powmod(), which uses gmpy2 (GMP)
+# when it is installed: several times faster than the built-in pow at
+# 2048 bits and up. P2P_BIGINT=builtin forces the built-in pow.
 
-from Crypto.Random import get_random_bytes
+import os
 
 p = 12980392895343054703014536073914488856684431224038760889795797821148268281653185633271150095369558651013705762317569403202651829160514973546664152667905529
 g = 97
 
+class InvalidPublicKeyError(ValueError):
+    """A peer's public key is unsafe to use (out of range or in a small subgroup)"""
+
+
+def check_public_key_range(key, p):
+    """Reject 0, 1, p-1 and anything outside [0, p), which give away the secret"""
+    if not 1 < key < p - 1:
+        raise InvalidPublicKeyError("Peer public key is out of range")
+
+
+BACKEND = None  # "gmpy2" or "builtin" once load_backend() has run
+_powmod = pow
+_mpz = int
+
+
+def load_backend():
+    """Pick the big-integer backend on first use and return its name"""
+    global BACKEND, _powmod, _mpz
+    if BACKEND is None:
+        name = "builtin"
+        if os.environ.get("P2P_BIGINT", "auto") != "builtin":
+            try:
+                import gmpy2  # Deferred: slow to import
+                _powmod, _mpz = gmpy2.powmod, gmpy2.mpz
+                name = "gmpy2"
+            except ImportError:
+                pass
+        BACKEND = name
+    return BACKEND
+
+
+def powmod(base, exponent, modulus):
+    """base^exponent mod modulus, as a plain int"""
+    if BACKEND is None:
+        load_backend()
+    return int(_powmod(base, exponent, modulus))
+
+
+def backend_int(value):
+    """value as the backend's native integer, for arithmetic in hot loops"""
+    if BACKEND is None:
+        load_backend()
+    return _mpz(value)
+
+
 class DHKE:
-    def __init__(self, p, g):
+    def __init__(self, p, g, power_g=None, check_key=None):
         self.p = p
         self.g = g
+        self.power_g = power_g  # Faster g^x mod p, e.g. groups.Group.power_g
+        self.check_key = check_key  # Full peer key check, e.g. groups.Group.check_public_key
         self.private_key = None
         self.public_key = None
         self.shared_secret = None
 
     def generate_private_key(self):
+        from Crypto.Random import get_random_bytes  # Deferred: slow to import
         self.private_key = get_random_bytes(32)
         return self.private_key
     
@@ -21,12 +76,58 @@ class DHKE:
         if self.private_key is None:
             raise ValueError("Private key not generated.")
         private_key_int = int.from_bytes(self.private_key, byteorder='big')
-        self.public_key = pow(self.g, private_key_int, self.p)
+        if self.power_g:
+            self.public_key = self.power_g(private_key_int)
+        else:
+            self.public_key = powmod(self.g, private_key_int, self.p)
         return self.public_key
 
     def compute_shared_secret(self, other_public_key):
         if self.private_key is None:
             raise ValueError("Private key not generated.")
+        if self.check_key:
+            self.check_key(other_public_key)
+        else:
+            check_public_key_range(other_public_key, self.p)
         private_key_int = int.from_bytes(self.private_key, byteorder='big')
-        self.shared_secret = pow(other_public_key, private_key_int, self.p)
+        self.shared_secret = powmod(other_public_key, private_key_int, self.p)
         return self.shared_secret
+
+
+def _benchmark(samples=100):
+    """Key generation and shared secret cost per group, for both backends"""
+    import random
+    import time
+    import groups
+    backends = {"builtin": pow}
+    try:
+        import gmpy2
+        backends["gmpy2"] = lambda b, e, m: int(gmpy2.powmod(b, e, m))
+    except ImportError:
+        print("[BENCH] gmpy2 is not installed, built-in pow only")
+    for group_id in groups.GROUP_IDS:
+        group = groups.get_group(group_id)
+        keys = [random.getrandbits(256) for _ in range(samples)]
+        peers = [random.randrange(2, group.p - 1) for _ in range(samples)]
+        results = []
+        for name, power in backends.items():
+            start = time.perf_counter()
+            for key in keys:
+                power(group.g, key, group.p)
+            keygen = (time.perf_counter() - start) / samples
+            start = time.perf_counter()
+            for key, peer in zip(keys, peers):
+                power(peer, key, group.p)
+            secret = (time.perf_counter() - start) / samples
+            results.append(f"{name} keygen {keygen * 1e6:.0f} us, secret {secret * 1e6:.0f} us")
+        start = time.perf_counter()
+        for key in keys:
+            group.power_g(key)
+        table = (time.perf_counter() - start) / samples
+        print(f"[BENCH] {group_id} ({group.bits}-bit): {'; '.join(results)}; "
+              f"table keygen ({BACKEND}) {table * 1e6:.0f} us")
+
+
+if __name__ == "__main__":
+    print(f"[BENCH] Default backend: {load_backend()}")
+    _benchmark()
@@ -1,15 +1,15 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
-import socket
 import threading
 import time
+import queue
 from datetime import datetime
-import json
 import os
-from DHKE import DHKE, p, g
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
-from Crypto.Hash import SHA256
+from link import STATE_CONNECTED, STATE_RECONNECTING, STATE_CLOSED
+from link import BACKPRESSURE_NOTIFY
+from session import P2PSession
+from history import History
+from presence import PresenceClient, dial
 
 class P2PChatGUI:
     def __init__(self):
@@ -37,15 +37,28 @@ class P2PChatGUI:
         self.server_host = '10.196.43.51'
         self.server_port = 6000
         self.listen_port = 7000
+        self.heartbeat_interval = 5.0  # Seconds between pings on an idle link
+        self.dead_timeout = 15.0  # Seconds of silence before the link is dropped
+        self.max_reconnect_attempts = 20  # Per outage, with exponential backoff
+        self.send_queue_size = 256  # Chat messages waiting for the sender thread
+        self.send_backpressure = BACKPRESSURE_NOTIFY  # block, drop or notify when full
+        self.dh_group = "file"  # DH group, must match the peer's (see groups.py)
+        self.batch_window = 0.0  # Seconds to pack bursts of small messages into one frame; 0 is off
+        self.history_file = None  # e.g. "history.log": keep the chat and resync it on connect (if the peer keeps one too)
+        self.history = History(self.history_file) if self.history_file else None
+        self.call = None  # e.g. "bob": dial a user who is online at the mediator instead of using the room
+        self.go_online = False  # Register our name so contacts can see and dial us
+        self.contacts = []  # Names whose online/offline changes are shown while we are online
+        self.queue_role = None  # e.g. "customer" or "agent": the room is a queue, take any free peer of the other role
+        self.presence = None
         
         # Chat variables
         self.name = ""
         self.peer_name = ""
         self.peer_ip = ""
-        self.conn = None
-        self.aes_key = None
+        self.session = None
+        self.last_send_latency = None
         self.is_connected = False
-        self.is_host = False
         
         # Setup UI
         self.setup_styles()
@@ -101,12 +114,24 @@ class P2PChatGUI:
                                         bg=self.colors['bg'],
                                         font=('Arial', 10, 'bold'))
         
+        self.latency_label = tk.Label(self.status_frame,
+                                text="",
+                                fg=self.colors['text_muted'],
+                                bg=self.colors['bg'],
+                                font=('Arial', 9))
+        
         self.peer_info = tk.Label(self.status_frame,
                                 text="No peer connected",
                                 fg=self.colors['text_muted'],
                                 bg=self.colors['bg'],
                                 font=('Arial', 9))
         
+        self.send_stats_label = tk.Label(self.status_frame,
+                                text="",
+                                fg=self.colors['text_muted'],
+                                bg=self.colors['bg'],
+                                font=('Arial', 9))
+        
         # Chat area
         self.chat_frame = ttk.Frame(self.main_frame, style='Dark.TFrame')
         
@@ -207,7 +232,9 @@ class P2PChatGUI:
         self.header_frame.pack(fill=tk.X, pady=(0, 10))
         self.status_frame.pack(side=tk.LEFT)
         self.connection_status.pack(side=tk.LEFT)
+        self.latency_label.pack(side=tk.LEFT, padx=(5, 0))
         self.peer_info.pack(side=tk.LEFT, padx=(10, 0))
+        self.send_stats_label.pack(side=tk.LEFT, padx=(10, 0))
         
         # Controls (right side of header)
         self.controls_frame.pack(side=tk.RIGHT)
@@ -265,7 +292,7 @@ class P2PChatGUI:
         name_entry.focus()
         
         # Server settings
-        tk.Label(dialog, text="Server IP:", 
+        tk.Label(dialog, text="Server IP(s):", 
                 fg=self.colors['text'], bg=self.colors['bg'],
                 font=('Arial', 11)).pack(pady=(10, 5))
         
@@ -303,7 +330,10 @@ class P2PChatGUI:
             self.server_host = server_ip
             self.room = room
             dialog.destroy()
-            self.connect_to_peer()
+            if self.go_online:
+                threading.Thread(target=self._register_presence, daemon=True).start()
+            if self.call or not self.go_online:
+                self.connect_to_peer()
         
         # Connect button
         connect_btn = tk.Button(dialog,
@@ -344,7 +374,8 @@ class P2PChatGUI:
         
     def send_message(self):
         """Send a message to the peer"""
-        if not self.is_connected or not self.conn:
+        session = self.session
+        if not session or not session.link:
             messagebox.showwarning("Warning", "Not connected to peer")
             return
             
@@ -352,17 +383,20 @@ class P2PChatGUI:
         if not message:
             return
             
+        # Encryption and the socket write happen on the sender thread
         try:
-            msg_bytes = message.encode()
-            cipher = AES.new(self.aes_key, AES.MODE_CBC)
-            ct = cipher.encrypt(pad(msg_bytes, AES.block_size))
-            self.conn.send(cipher.iv + ct)
-            
-            self.add_message(self.name, message)
-            self.message_entry.delete(0, tk.END)
+            if not session.send(message):
+                self.add_message("System", "Send queue full, message dropped", True)
+                return
+        except queue.Full:
+            self.add_message("System", "Send queue full, try again shortly", True)
+            return
             
-        except Exception as e:
-            self.add_message("System", f"Send error: {str(e)}", True)
+        if session.state != STATE_CONNECTED:
+            message += " (queued)"
+        self.add_message(self.name, message)
+        self.message_entry.delete(0, tk.END)
+        self._update_send_stats(None)
             
     def connect_to_peer(self):
         """Connect to peer through mediator server"""
@@ -375,102 +409,90 @@ class P2PChatGUI:
         # Run connection in separate thread
         threading.Thread(target=self._connect_thread, daemon=True).start()
         
+    def _register_presence(self):
+        """Go online at the mediator so contacts can see and dial us"""
+        presence = PresenceClient(
+            self.name, self.server_host, self.server_port, contacts=self.contacts,
+            on_presence=lambda who, online: self.root.after(0, lambda: self.add_message(
+                "System", f"{who} is {'online' if online else 'offline'}", True)),
+            on_invite=lambda room, caller: self.root.after(
+                0, lambda: self._incoming_call(room, caller)))
+        try:
+            presence.connect()
+        except Exception as e:
+            error = f"Could not go online: {e}"
+            self.root.after(0, lambda: self.add_message("System", error, True))
+            return
+        self.presence = presence
+        self.root.after(0, lambda: self.add_message("System", "Online, waiting for calls", True))
+        
+    def _incoming_call(self, room, caller):
+        """Join the room the mediator set up when someone dialed us"""
+        if self.is_connected or self.session:
+            self.add_message("System", f"Missed a call from {caller} (busy)", True)
+            return
+        self.add_message("System", f"{caller} is calling", True)
+        self.room = room
+        self.connect_to_peer()
+        
     def _connect_thread(self):
         """Connection thread"""
+        if self.call:
+            try:
+                self.room, _ = dial(self.server_host, self.name, self.call,
+                                    server_port=self.server_port)
+            except Exception as e:
+                error = f"Could not dial {self.call}: {e}"
+                self.root.after(0, lambda: self.add_message("System", error, True))
+                self.root.after(0, lambda: self.connect_button.config(state='normal'))
+                return
+        session = P2PSession(
+            self.name, self.room, self.server_host, self.server_port, self.listen_port,
+            on_peer=self._peer_found,
+            on_message=self._receive_message,
+            on_state=self._link_state_changed,
+            on_rtt=self._rtt_updated,
+            on_sent=self._message_sent,
+            on_error=self._send_failed,
+            heartbeat_interval=self.heartbeat_interval,
+            dead_timeout=self.dead_timeout,
+            max_reconnect_attempts=self.max_reconnect_attempts,
+            send_queue_size=self.send_queue_size,
+            send_backpressure=self.send_backpressure,
+            group=self.dh_group,
+            batch_window=self.batch_window,
+            history=self.history,
+            role=self.queue_role)
+        self.session = session
         try:
-            # Setup DHKE
-            dh = DHKE(p, g)
-            dh.generate_private_key()
-            pubkey = dh.generate_public_key()
-            
-            # Connect to mediator server
-            s = socket.socket()
-            s.connect((self.server_host, self.server_port))
-            s.send(f"{self.room}:{pubkey}:{self.name}".encode())
-            
-            # Receive peer info
-            response = s.recv(4096).decode().strip()
-            
-            if ":" not in response:
-                raise Exception("Malformed response from server")
-                
-            peer_pubkey_str, self.peer_ip, self.peer_name = response.split(":", 2)
-            peer_pubkey = int(peer_pubkey_str)
-            
-            # Setup AES key
-            shared_secret = dh.compute_shared_secret(peer_pubkey)
-            self.aes_key = SHA256.new(str(shared_secret).encode()).digest()
-            
-            s.close()
-            
-            # Determine role
-            self.is_host = pubkey > peer_pubkey
-            
-            self.root.after(0, lambda: self.add_message("System", 
-                f"Found peer: {self.peer_name} ({self.peer_ip})", True))
-            self.root.after(0, lambda: self.add_message("System", 
-                f"Role: {'Host' if self.is_host else 'Client'}", True))
-            
-            # Establish P2P connection
-            if self.is_host:
-                self._host_connection()
-            else:
-                self._client_connection()
-                
+            # Establish P2P connection, reconnecting whenever it drops
+            session.connect()
         except Exception as e:
+            if self.session is not session:
+                return  # Disconnected while waiting for a peer
+            self.session = None
             self.root.after(0, lambda: self.add_message("System", 
                 f"Connection error: {str(e)}", True))
             self.root.after(0, lambda: self.connect_button.config(state='normal'))
             
-    def _host_connection(self):
-        """Host P2P connection"""
-        try:
-            self.root.after(0, lambda: self.add_message("System", 
-                "Waiting for peer to connect...", True))
-            
-            listener = socket.socket()
-            listener.bind(('', self.listen_port))
-            listener.listen(1)
-            
-            self.conn, addr = listener.accept()
-            listener.close()
-            
-            self._connection_established()
-            
-        except Exception as e:
-            self.root.after(0, lambda: self.add_message("System", 
-                f"Host connection error: {str(e)}", True))
-            
-    def _client_connection(self):
-        """Client P2P connection"""
-        try:
-            self.conn = socket.socket()
-            max_retries = 10
-            
-            for i in range(max_retries):
-                try:
-                    self.conn.connect((self.peer_ip, self.listen_port))
-                    break
-                except ConnectionRefusedError:
-                    if i == max_retries - 1:
-                        raise Exception("Host not available")
-                    time.sleep(1)
-            
-            self._connection_established()
-            
-        except Exception as e:
-            self.root.after(0, lambda: self.add_message("System", 
-                f"Client connection error: {str(e)}", True))
-            
+    def _peer_found(self, peer_name, peer_ip):
+        """Called once the mediator has paired us and the key is ready"""
+        session = self.session
+        if not session:
+            return
+        self.peer_name, self.peer_ip = peer_name, peer_ip
+        is_leader = session.is_leader
+        self.root.after(0, lambda: self.add_message("System", 
+            f"Found peer: {peer_name} ({peer_ip})", True))
+        self.root.after(0, lambda: self.add_message("System", 
+            f"Role: {'Leader' if is_leader else 'Follower'}", True))
+        self.root.after(0, lambda: self.add_message("System", 
+            "Racing direct connection to peer...", True))
+        
     def _connection_established(self):
         """Handle successful P2P connection"""
         self.is_connected = True
-        
-        # Update UI
-        self.root.after(0, self._update_connection_ui)
-        
-        # Start message handling threads
-        threading.Thread(target=self._receive_messages, daemon=True).start()
+        self._update_connection_ui()
         
     def _update_connection_ui(self):
         """Update UI for connected state"""
@@ -480,35 +502,70 @@ class P2PChatGUI:
         self.disconnect_button.config(state='normal')
         self.add_message("System", f"Connected to {self.peer_name}!", True)
         
-    def _receive_messages(self):
-        """Handle incoming messages"""
-        while self.is_connected and self.conn:
-            try:
-                data = self.conn.recv(4096)
-                if not data:
-                    break
-                    
-                iv = data[:16]
-                ct = data[16:]
-                cipher = AES.new(self.aes_key, AES.MODE_CBC, iv)
-                msg = unpad(cipher.decrypt(ct), AES.block_size)
-                
-                self.root.after(0, lambda m=msg.decode(): 
-                    self.add_message(self.peer_name, m))
-                    
-            except Exception as e:
-                self.root.after(0, lambda: self.add_message("System", 
-                    f"Receive error: {str(e)}", True))
-                break
-                
-        # Connection lost
-        if self.is_connected:
-            self.root.after(0, self._connection_lost)
+    def _receive_message(self, msg):
+        """Handle an incoming message"""
+        self.root.after(0, lambda m=msg.decode(): 
+            self.add_message(self.peer_name, m))
+        
+    def _rtt_updated(self, rtt):
+        """Show the latest smoothed round-trip time"""
+        text = f"{rtt.srtt * 1000:.0f} ms ±{rtt.rttvar * 1000:.0f}"
+        self.root.after(0, lambda: self.latency_label.config(text=text))
+        
+    def _message_sent(self, latency, depth):
+        """Called on the sender thread after each chat message"""
+        self.root.after(0, lambda: self._update_send_stats(latency))
+        
+    def _send_failed(self, error):
+        self.root.after(0, lambda: self.add_message("System", 
+            f"Send error: {str(error)}", True))
+        
+    def _update_send_stats(self, latency):
+        """Show chat queue depth and the latest send latency"""
+        if not self.session or not self.session.link:
+            self.send_stats_label.config(text="")
+            return
+        if latency is not None:
+            self.last_send_latency = latency
+        text = f"Queue: {self.session.queue_depth}"
+        if self.last_send_latency is not None:
+            text += f" | Send: {self.last_send_latency * 1000:.1f} ms"
+        self.send_stats_label.config(text=text)
+        
+    def _link_state_changed(self, state, detail):
+        """Marshal link state changes onto the UI thread"""
+        self.root.after(0, lambda: self._update_link_state(state, detail))
+        
+    def _update_link_state(self, state, detail):
+        """Reflect reconnects in the status bar"""
+        if not self.session:
+            return
+            
+        if state == STATE_CONNECTED:
+            if not self.is_connected:
+                self._connection_established()
+            else:
+                self.connection_status.config(text="● Connected", fg=self.colors['success'])
+                self.add_message("System", "Reconnected", True)
+            if detail:
+                self.add_message("System", detail.capitalize(), True)
+        elif state == STATE_RECONNECTING:
+            self.connection_status.config(text="● Reconnecting", fg=self.colors['warning'])
+            self.latency_label.config(text="")
+            self.add_message("System", detail, True)
+        elif state == STATE_CLOSED:
+            self.add_message("System", detail, True)
+            self.session = None
+            self.send_stats_label.config(text="")
+            self._connection_lost()
+        elif detail:
+            self.add_message("System", detail, True)
             
     def _connection_lost(self):
         """Handle connection loss"""
         self.is_connected = False
         self.connection_status.config(text="● Disconnected", fg=self.colors['danger'])
+        self.latency_label.config(text="")
         self.peer_info.config(text="Connection lost")
         self.connect_button.config(state='normal')
         self.disconnect_button.config(state='disabled')
@@ -516,10 +573,11 @@ class P2PChatGUI:
         
     def disconnect(self):
         """Disconnect from peer"""
-        if self.conn:
-            self.conn.close()
-            self.conn = None
         self.is_connected = False
+        session, self.session = self.session, None
+        if session:
+            session.close()
+        self.send_stats_label.config(text="")
         self._connection_lost()
         
     def show_settings(self):
@@ -529,6 +587,8 @@ class P2PChatGUI:
     def on_closing(self):
         """Handle window closing"""
         self.disconnect()
+        if self.presence:
+            self.presence.close()
         self.root.destroy()
         
     def run(self):
@@ -0,0 +1,134 @@
+# cluster.py
+#
+# Mediator cluster membership and room placement.
+#
+# Every mediator in a cluster is started with the same static member list
+# ("host:port" entries). Room IDs are placed on the members by consistent
+# hashing, so adding or removing a node only moves the rooms next to it on
+# the ring. Clients that know the list hash the room themselves and go
+# straight to its owner, falling back along the ring when a node is down;
+# a join that still lands on the wrong node is redirected (binary
+# clients) or forwarded (legacy clients) to the owner.
+
+import bisect
+import hashlib
+import socket
+import threading
+import time
+
+REPLICAS = 100  # Virtual nodes per member, evens out the room spread
+PROBE_INTERVAL = 2.0  # Seconds between liveness probes of the other members
+PROBE_TIMEOUT = 1.0
+DEFAULT_PORT = 6000
+
+
+def parse_node(node, default_port=DEFAULT_PORT):
+    """Split "host:port" (or a bare host) into (host, port)"""
+    node = node.strip()
+    if node.startswith("["):  # [IPv6]:port
+        host, _, port = node[1:].partition("]")
+        return host, int(port[1:]) if port else default_port
+    if node.count(":") == 1:
+        host, port = node.split(":")
+        return host, int(port)
+    return node, default_port
+
+
+def parse_nodes(text, default_port=DEFAULT_PORT):
+    """Normalise a comma-separated server list to "host:port" entries"""
+    nodes = []
+    for entry in text.split(","):
+        if entry.strip():
+            host, port = parse_node(entry, default_port)
+            nodes.append(f"[{host}]:{port}" if ":" in host else f"{host}:{port}")
+    return nodes
+
+
+def resolve_hosts(hosts):
+    """The IP addresses of hosts, and the hosts that didn't resolve"""
+    ips, unresolved = set(), []
+    for host in hosts:
+        try:
+            infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+        except socket.gaierror:
+            unresolved.append(host)
+            continue
+        ips.update(info[4][0] for info in infos)
+    return ips, unresolved
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of room IDs onto nodes"""
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.nodes = list(dict.fromkeys(nodes))
+        points = sorted((_hash(f"{node}#{i}"), node)
+                        for node in self.nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+    def owners(self, key):
+        """Every node, in ring order starting with the key's owner"""
+        start = bisect.bisect(self._hashes, _hash(key))
+        found = []
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in found:
+                found.append(node)
+                if len(found) == len(self.nodes):
+                    break
+        return found
+
+
+class Cluster:
+    """One mediator's view of the cluster
+
+    The other members are probed in the background; a room whose owner
+    is down moves to the next live node on the ring, which is where the
+    clients fail over to as well.
+    """
+
+    def __init__(self, node, nodes, probe_interval=PROBE_INTERVAL):
+        if node not in nodes:
+            raise ValueError(f"{node} is not in the cluster member list")
+        self.node = node
+        self.ring = HashRing(nodes)
+        # Resolved once: connections are told apart by peer IP, not by name
+        self.member_ips, self.unresolved = resolve_hosts({parse_node(n)[0] for n in nodes})
+        self.down = set()
+        self.probe_interval = probe_interval
+        threading.Thread(target=self._probe_loop, daemon=True).start()
+
+    def owner(self, room_id):
+        for node in self.ring.owners(room_id):
+            if node == self.node or node not in self.down:
+                return node
+
+    def is_member(self, ip):
+        """Whether a connection comes from a node allowed to forward joins"""
+        return ip in self.member_ips
+
+    def mark_down(self, node):
+        self.down.add(node)
+
+    def _probe_loop(self):
+        # Everyone counts as up until a probe says otherwise, so nodes
+        # started together don't write each other off while booting.
+        while True:
+            time.sleep(self.probe_interval)
+            for node in self.ring.nodes:
+                if node == self.node:
+                    continue
+                try:
+                    socket.create_connection(parse_node(node), timeout=PROBE_TIMEOUT).close()
+                    self.down.discard(node)
+                except OSError:
+                    self.down.add(node)
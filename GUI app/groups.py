@@ -0,0 +1,371 @@
+# groups.py
+#
+# Diffie-Hellman groups for the key exchange.
+#
+# A group is picked by ID. "file" is the prime and generator shipped in
+# Prime.txt and g.txt (the original 512-bit group, still the default so
+# older clients can pair); the others are the standard RFC 3526 MODP and
+# RFC 7919 FFDHE groups. Both peers of a room must use the same group.
+#
+# The first load of a group validates it (p prime, (p-1)/2 prime for a
+# safe prime, g in range) and builds a fixed-base table that makes g^x
+# several times cheaper than pow(). Both are cached on disk under a hash
+# of (p, g), so later startups skip the validation and the table build.
+# With gmpy2 installed (see DHKE.load_backend) the table holds GMP
+# integers and primality is tested by GMP, both much faster again.
+#
+# Peer public keys are checked before use: range always, and subgroup
+# membership when g generates the prime-order subgroup of a safe prime.
+# The subgroup test costs a full-size modexp, so results are memoised per
+# key in a bounded LRU.
+
+import hashlib
+import json
+import os
+import random
+import threading
+from collections import OrderedDict
+from DHKE import powmod, backend_int, load_backend
+from DHKE import InvalidPublicKeyError, check_public_key_range
+
+FILE_GROUP = "file"
+DEFAULT_GROUP = FILE_GROUP
+GROUP_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get("P2P_GROUP_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".cache", "p2p-chat", "groups"))
+
+TABLE_BITS = 256  # Exponent bits the table covers; private keys are 32 bytes
+TABLE_WINDOW = 8  # Exponent bits per table row
+KEY_MEMO_SIZE = 1024  # Peer public keys remembered per group
+MILLER_RABIN_ROUNDS = 16  # Per number; p and (p-1)/2 are both tested
+
+# RFC 3526 (MODP) and RFC 7919 (FFDHE) groups, all with generator 2
+_STANDARD = {
+    "modp2048": """
+        FFFFFFFF FFFFFFFF C90FDAA2 2168C234 C4C6628B 80DC1CD1
+        29024E08 8A67CC74 020BBEA6 3B139B22 514A0879 8E3404DD
+        EF9519B3 CD3A431B 302B0A6D F25F1437 4FE1356D 6D51C245
+        E485B576 625E7EC6 F44C42E9 A637ED6B 0BFF5CB6 F406B7ED
+        EE386BFB 5A899FA5 AE9F2411 7C4B1FE6 49286651 ECE45B3D
+        C2007CB8 A163BF05 98DA4836 1C55D39A 69163FA8 FD24CF5F
+        83655D23 DCA3AD96 1C62F356 208552BB 9ED52907 7096966D
+        670C354E 4ABC9804 F1746C08 CA18217C 32905E46 2E36CE3B
+        E39E772C 180E8603 9B2783A2 EC07A28F B5C55DF0 6F4C52C9
+        DE2BCBF6 95581718 3995497C EA956AE5 15D22618 98FA0510
+        15728E5A 8AACAA68 FFFFFFFF FFFFFFFF""",
+    "modp3072": """
+        FFFFFFFF FFFFFFFF C90FDAA2 2168C234 C4C6628B 80DC1CD1
+        29024E08 8A67CC74 020BBEA6 3B139B22 514A0879 8E3404DD
+        EF9519B3 CD3A431B 302B0A6D F25F1437 4FE1356D 6D51C245
+        E485B576 625E7EC6 F44C42E9 A637ED6B 0BFF5CB6 F406B7ED
+        EE386BFB 5A899FA5 AE9F2411 7C4B1FE6 49286651 ECE45B3D
+        C2007CB8 A163BF05 98DA4836 1C55D39A 69163FA8 FD24CF5F
+        83655D23 DCA3AD96 1C62F356 208552BB 9ED52907 7096966D
+        670C354E 4ABC9804 F1746C08 CA18217C 32905E46 2E36CE3B
+        E39E772C 180E8603 9B2783A2 EC07A28F B5C55DF0 6F4C52C9
+        DE2BCBF6 95581718 3995497C EA956AE5 15D22618 98FA0510
+        15728E5A 8AAAC42D AD33170D 04507A33 A85521AB DF1CBA64
+        ECFB8504 58DBEF0A 8AEA7157 5D060C7D B3970F85 A6E1E4C7
+        ABF5AE8C DB0933D7 1E8C94E0 4A25619D CEE3D226 1AD2EE6B
+        F12FFA06 D98A0864 D8760273 3EC86A64 521F2B18 177B200C
+        BBE11757 7A615D6C 770988C0 BAD946E2 08E24FA0 74E5AB31
+        43DB5BFC E0FD108E 4B82D120 A93AD2CA FFFFFFFF FFFFFFFF""",
+    "ffdhe2048": """
+        FFFFFFFF FFFFFFFF ADF85458 A2BB4A9A AFDC5620 273D3CF1
+        D8B9C583 CE2D3695 A9E13641 146433FB CC939DCE 249B3EF9
+        7D2FE363 630C75D8 F681B202 AEC4617A D3DF1ED5 D5FD6561
+        2433F51F 5F066ED0 85636555 3DED1AF3 B557135E 7F57C935
+        984F0C70 E0E68B77 E2A689DA F3EFE872 1DF158A1 36ADE735
+        30ACCA4F 483A797A BC0AB182 B324FB61 D108A94B B2C8E3FB
+        B96ADAB7 60D7F468 1D4F42A3 DE394DF4 AE56EDE7 6372BB19
+        0B07A7C8 EE0A6D70 9E02FCE1 CDF7E2EC C03404CD 28342F61
+        9172FE9C E98583FF 8E4F1232 EEF28183 C3FE3B1B 4C6FAD73
+        3BB5FCBC 2EC22005 C58EF183 7D1683B2 C6F34A26 C1B2EFFA
+        886B4238 61285C97 FFFFFFFF FFFFFFFF""",
+    "ffdhe3072": """
+        FFFFFFFF FFFFFFFF ADF85458 A2BB4A9A AFDC5620 273D3CF1
+        D8B9C583 CE2D3695 A9E13641 146433FB CC939DCE 249B3EF9
+        7D2FE363 630C75D8 F681B202 AEC4617A D3DF1ED5 D5FD6561
+        2433F51F 5F066ED0 85636555 3DED1AF3 B557135E 7F57C935
+        984F0C70 E0E68B77 E2A689DA F3EFE872 1DF158A1 36ADE735
+        30ACCA4F 483A797A BC0AB182 B324FB61 D108A94B B2C8E3FB
+        B96ADAB7 60D7F468 1D4F42A3 DE394DF4 AE56EDE7 6372BB19
+        0B07A7C8 EE0A6D70 9E02FCE1 CDF7E2EC C03404CD 28342F61
+        9172FE9C E98583FF 8E4F1232 EEF28183 C3FE3B1B 4C6FAD73
+        3BB5FCBC 2EC22005 C58EF183 7D1683B2 C6F34A26 C1B2EFFA
+        886B4238 611FCFDC DE355B3B 6519035B BC34F4DE F99C0238
+        61B46FC9 D6E6C907 7AD91D26 91F7F7EE 598CB0FA C186D91C
+        AEFE1309 85139270 B4130C93 BC437944 F4FD4452 E2D74DD3
+        64F2E21E 71F54BFF 5CAE82AB 9C9DF69E E86D2BC5 22363A0D
+        ABC52197 9B0DEADA 1DBF9A42 D5C4484E 0ABCD06B FA53DDEF
+        3C1B20EE 3FD59D7C 25E41D2B 66C62E37 FFFFFFFF FFFFFFFF""",
+}
+GROUP_IDS = (FILE_GROUP,) + tuple(_STANDARD)
+
+_SMALL_PRIMES = (3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73)
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+class Group:
+    """A validated Diffie-Hellman group, with a fast g^x for key generation"""
+
+    def __init__(self, group_id, p, g):
+        self.id = group_id
+        self.p = p
+        self.g = g
+        self.hash = hashlib.sha256(f"{p}:{g}".encode()).hexdigest()[:32]
+        self.safe_prime = False
+        self.generator_order = None  # "q" or "2q" for a safe prime p = 2q + 1
+        self.from_cache = False
+        self._table = None  # Row i, column j: g^(j << i * TABLE_WINDOW) mod p
+        self._modulus = p  # p as the backend's integer type
+        self._key_memo = OrderedDict()  # public key: rejection reason or None
+        self._memo_lock = threading.Lock()
+        self.keys_checked = 0
+        self.key_memo_hits = 0
+        self.keys_rejected = 0
+
+    @property
+    def bits(self):
+        return self.p.bit_length()
+
+    def power_g(self, exponent):
+        """g^exponent mod p"""
+        table = self._table
+        if table is None or exponent < 0 or exponent.bit_length() > TABLE_BITS:
+            return powmod(self.g, exponent, self.p)
+        p = self._modulus
+        mask = (1 << TABLE_WINDOW) - 1
+        result = 1
+        for row in table:
+            digit = exponent & mask
+            if digit:
+                result = result * row[digit] % p
+            exponent >>= TABLE_WINDOW
+            if not exponent:
+                break
+        return int(result)
+
+    def check_public_key(self, key):
+        """Raise InvalidPublicKeyError unless key is safe to use as a peer's public key"""
+        with self._memo_lock:
+            if key in self._key_memo:
+                self._key_memo.move_to_end(key)
+                self.key_memo_hits += 1
+                reason = self._key_memo[key]
+                if reason:
+                    self.keys_rejected += 1
+                    raise InvalidPublicKeyError(reason)
+                return
+        try:
+            check_public_key_range(key, self.p)
+            # Outside the q-order subgroup means a small-subgroup key
+            if self.generator_order == "q" and powmod(key, (self.p - 1) // 2, self.p) != 1:
+                raise InvalidPublicKeyError("Peer public key is not in the group's subgroup")
+            reason = None
+        except InvalidPublicKeyError as e:
+            reason = f"{e} (group {self.id})"
+        with self._memo_lock:
+            self.keys_checked += 1
+            self._key_memo[key] = reason
+            if len(self._key_memo) > KEY_MEMO_SIZE:
+                self._key_memo.popitem(last=False)
+            if reason:
+                self.keys_rejected += 1
+        if reason:
+            raise InvalidPublicKeyError(reason)
+
+    def _use_table(self, table):
+        self._table = [[backend_int(value) for value in row] for row in table]
+        self._modulus = backend_int(self.p)
+
+
+def _is_probable_prime(n, rounds=MILLER_RABIN_ROUNDS):
+    if load_backend() == "gmpy2":
+        import gmpy2
+        return gmpy2.is_prime(n, rounds)
+    if n < 2:
+        return False
+    for small in (2,) + _SMALL_PRIMES:
+        if n % small == 0:
+            return n == small
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    rng = random.SystemRandom()
+    for _ in range(rounds):
+        x = pow(rng.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _validate(group):
+    """Check the group's structure; raises ValueError if it is unusable"""
+    p, g = group.p, group.g
+    if not _is_probable_prime(p):
+        raise ValueError(f"Group {group.id}: p is not prime")
+    if not 1 < g < p - 1:
+        raise ValueError(f"Group {group.id}: g is out of range")
+    q = (p - 1) // 2
+    group.safe_prime = _is_probable_prime(q)
+    if group.safe_prime:
+        group.generator_order = "q" if powmod(g, q, p) == 1 else "2q"
+    else:
+        print(f"[GROUP] Warning: group {group.id} ({group.bits}-bit) is not a safe prime; "
+              f"prefer a standard group")
+
+
+def _build_table(group):
+    p = group.p
+    table = []
+    for i in range(TABLE_BITS // TABLE_WINDOW):
+        base = powmod(group.g, 1 << (i * TABLE_WINDOW), p)
+        row = [1]
+        for _ in range((1 << TABLE_WINDOW) - 1):
+            row.append(row[-1] * base % p)
+        table.append(row)
+    return table
+
+
+def _cache_paths(group):
+    base = os.path.join(CACHE_DIR, group.hash)
+    return base + ".json", base + ".table"
+
+
+def _load_cached(group):
+    info_path, table_path = _cache_paths(group)
+    try:
+        with open(info_path) as f:
+            info = json.load(f)
+        with open(table_path, "rb") as f:
+            data = f.read()
+    except (OSError, ValueError):
+        return False
+    width = (group.bits + 7) // 8
+    rows = TABLE_BITS // TABLE_WINDOW
+    columns = 1 << TABLE_WINDOW
+    if (info.get("p") != hex(group.p) or info.get("g") != group.g
+            or info.get("window") != TABLE_WINDOW or len(data) != rows * columns * width):
+        return False
+    table = []
+    offset = 0
+    for _ in range(rows):
+        row = []
+        for _ in range(columns):
+            row.append(int.from_bytes(data[offset:offset + width], "big"))
+            offset += width
+        table.append(row)
+    # One spot check, so a damaged cache file can't yield wrong keys
+    if table[-1][1] != powmod(group.g, 1 << ((rows - 1) * TABLE_WINDOW), group.p):
+        return False
+    group.safe_prime = info["safe_prime"]
+    group.generator_order = info["generator_order"]
+    group._use_table(table)
+    group.from_cache = True
+    return True
+
+
+def _save_cached(group, table):
+    info_path, table_path = _cache_paths(group)
+    width = (group.bits + 7) // 8
+    info = {"id": group.id, "p": hex(group.p), "g": group.g, "window": TABLE_WINDOW,
+            "safe_prime": group.safe_prime, "generator_order": group.generator_order}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Written aside and renamed, so a concurrent startup never reads half a file
+        with open(table_path + ".tmp", "wb") as f:
+            for row in table:
+                f.write(b"".join(value.to_bytes(width, "big") for value in row))
+        os.replace(table_path + ".tmp", table_path)
+        with open(info_path + ".tmp", "w") as f:
+            json.dump(info, f)
+        os.replace(info_path + ".tmp", info_path)
+    except OSError:
+        pass  # No cache this time; the group works all the same
+
+
+def _read_file_group():
+    try:
+        with open(os.path.join(GROUP_DIR, "Prime.txt")) as f:
+            p = int(f.read().strip())
+        with open(os.path.join(GROUP_DIR, "g.txt")) as f:
+            g = int(f.read().strip())
+    except FileNotFoundError:
+        from DHKE import p, g  # Same values, for copies shipped without the files
+    return p, g
+
+
+def get_group(group_id=DEFAULT_GROUP):
+    """Load, validate (or take from the cache) and return a group by ID"""
+    with _lock:
+        group = _loaded.get(group_id)
+        if group is not None:
+            return group
+        if group_id == FILE_GROUP:
+            p, g = _read_file_group()
+        elif group_id in _STANDARD:
+            p, g = int("".join(_STANDARD[group_id].split()), 16), 2
+        else:
+            raise ValueError(f"Unknown DH group {group_id!r}, expected one of {', '.join(GROUP_IDS)}")
+        group = Group(group_id, p, g)
+        if not _load_cached(group):
+            _validate(group)
+            table = _build_table(group)
+            _save_cached(group, table)
+            group._use_table(table)
+        _loaded[group_id] = group
+        return group
+
+
+def _benchmark(samples=50):
+    """Cold and cached load times, g^x with and without the table, peer key checks"""
+    import time
+    for group_id in GROUP_IDS:
+        start = time.perf_counter()
+        group = get_group(group_id)
+        load = time.perf_counter() - start
+        exponents = [random.getrandbits(TABLE_BITS) for _ in range(samples)]
+        start = time.perf_counter()
+        for e in exponents:
+            pow(group.g, e, group.p)  # Built-in, whatever the backend
+        plain = (time.perf_counter() - start) / samples
+        start = time.perf_counter()
+        for e in exponents:
+            group.power_g(e)
+        fast = (time.perf_counter() - start) / samples
+        print(f"[BENCH] {group_id} ({group.bits}-bit, safe prime: {group.safe_prime}, "
+              f"{load_backend()}): load {load * 1000:.1f} ms ({'cached' if group.from_cache else 'validated'}), "
+              f"g^x {plain * 1e6:.0f} us with pow, {fast * 1e6:.0f} us with the table")
+
+        keys = [group.power_g(e) for e in exponents]
+        start = time.perf_counter()
+        for key in keys:
+            group.check_public_key(key)
+        check = (time.perf_counter() - start) / samples
+        start = time.perf_counter()
+        for key in keys:
+            group.check_public_key(key)
+        memo = (time.perf_counter() - start) / samples
+        rejected = 0
+        for bad in (0, 1, group.p - 1, group.p, group.p + 5):
+            try:
+                group.check_public_key(bad)
+            except InvalidPublicKeyError:
+                rejected += 1
+        print(f"[BENCH]   peer key check {check * 1e6:.0f} us, memo hit {memo * 1e6:.1f} us; "
+              f"{group.keys_checked} checked, {group.key_memo_hits} memo hits, "
+              f"{group.keys_rejected} rejected ({rejected}/5 bad keys caught)")
+
+
+if __name__ == "__main__":
+    _benchmark()
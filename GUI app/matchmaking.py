@@ -0,0 +1,288 @@
+# matchmaking.py
+#
+# "Any available peer" matchmaking for the mediator.
+#
+# Besides exact rooms, a client can wait in a named queue under a role,
+# e.g. queue "support" as "customer" or as "agent", and is paired with
+# whoever of the other role has waited longest. A queue pairs two named
+# roles, or waiters of ROLE_ANY among themselves. Within a role, waiters
+# are served by priority (higher first) and then first come, first served.
+#
+# Joining only appends to a pending list under a lock. One matcher
+# thread wakes up every tick (or early, once ROUND_SIZE joins are
+# pending), moves the pending waiters into per-role heaps that only it
+# touches, and pairs as many as it can in one round. Queues without new
+# arrivals can't have anything to pair, so a round costs as much as the
+# arrivals since the last one, not the number of waiters.
+
+import heapq
+import threading
+import time
+from collections import deque
+
+TICK = 0.05  # Seconds between matching rounds
+ROUND_SIZE = 256  # Pending joins that start a round before the tick is up
+MAX_QUEUED = 100000  # Waiters across all queues
+MAX_PRIORITY = 9
+WAIT_TIMEOUT = 600.0  # Seconds a waiter may wait for a match
+SWEEP_INTERVAL = 5.0  # Seconds between sweeps for hung-up or expired waiters
+WAIT_SAMPLES = 10000  # Recent waits kept for percentiles
+ROLE_ANY = ""  # Paired with another waiter of ROLE_ANY
+
+
+class MatchError(Exception):
+    """A waiter was refused; the message is the reason sent to the client"""
+
+
+class Waiter:
+    """A client waiting in a queue, with whatever the server needs to reply"""
+
+    def __init__(self, queue, role, priority, conn=None, addr=None, name="",
+                 pubkey=None, port=None):
+        self.queue = queue
+        self.role = role
+        self.priority = min(max(priority, 0), MAX_PRIORITY)
+        self.conn = conn
+        self.addr = addr
+        self.name = name
+        self.pubkey = pubkey
+        self.port = port
+        self.enqueued_at = time.monotonic()
+
+
+class Matchmaker:
+    """Typed queues matched in batched rounds
+
+    on_match(a, b) is called for every pair and on_drop(waiter, reason)
+    for every waiter given up on; both run on the matcher thread, after
+    the round. is_gone(waiter) says whether a waiter hung up; it is asked
+    before a waiter is paired and in every sweep.
+    """
+
+    def __init__(self, on_match, on_drop=None, is_gone=None, tick=TICK,
+                 max_queued=MAX_QUEUED, wait_timeout=WAIT_TIMEOUT):
+        self.on_match = on_match
+        self.on_drop = on_drop
+        self.is_gone = is_gone
+        self.tick = tick
+        self.max_queued = max_queued
+        self.wait_timeout = wait_timeout
+        self.queues = {}  # queue: {role: [(-priority, seq, waiter)]}, changed under _round_lock
+        self.queued = 0
+        self.matched = 0
+        self.dropped = 0
+        self.rounds = 0
+        self.round_time = 0.0  # Seconds spent in rounds, in total
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self.started_at = time.monotonic()
+        self.closed = False
+        self._pending = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._round_lock = threading.Lock()  # Held while a round or close() changes the queues
+        self._last_sweep = time.monotonic()
+
+    def enqueue(self, waiter):
+        """Queue a waiter for the next round; raises MatchError when full"""
+        with self._cond:
+            if self.closed:
+                raise MatchError("Mediator is stopping")
+            if self.queued >= self.max_queued:
+                raise MatchError("Too many clients waiting")
+            self.queued += 1
+            self._pending.append(waiter)
+            if len(self._pending) >= ROUND_SIZE:
+                self._cond.notify()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def close(self):
+        """Stop the matcher thread; returns the waiters still queued, now removed
+
+        A round already running finishes and still calls on_match for
+        its pairs. Nothing else is done with the returned waiters.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        with self._round_lock:
+            with self._cond:
+                left, self._pending = self._pending, []
+            for roles in self.queues.values():
+                for heap in roles.values():
+                    left.extend(entry[2] for entry in heap)
+            self.queues = {}
+            with self._cond:
+                self.queued -= len(left)
+        return left
+
+    def run_round(self):
+        """Pair whatever can be paired now; returns the number of pairs"""
+        start = time.perf_counter()
+        with self._round_lock:
+            with self._cond:
+                pending, self._pending = self._pending, []
+            pairs, drops = self._match(pending)
+            now = time.monotonic()
+            if now - self._last_sweep > SWEEP_INTERVAL:
+                drops.extend(self._sweep(now))
+                self._last_sweep = now
+        with self._cond:
+            self.queued -= 2 * len(pairs) + len(drops)
+        self.matched += len(pairs)
+        self.dropped += len(drops)
+        self.rounds += 1
+        self.round_time += time.perf_counter() - start
+        for a, b in pairs:
+            self.waits.append(now - a.enqueued_at)
+            self.waits.append(now - b.enqueued_at)
+            self.on_match(a, b)
+        if self.on_drop:
+            for waiter, reason in drops:
+                self.on_drop(waiter, reason)
+        return len(pairs)
+
+    def stats(self):
+        """Queue lengths, wait percentiles and match throughput"""
+        waits = sorted(self.waits)
+
+        def percentile(p):
+            return waits[min(len(waits) - 1, len(waits) * p // 100)] if waits else 0.0
+
+        lengths = {queue: {role: len(heap) for role, heap in list(roles.items())}
+                   for queue, roles in list(self.queues.items())}
+        elapsed = time.monotonic() - self.started_at
+        return {
+            "queued": self.queued,
+            "lengths": lengths,
+            "matched": self.matched,
+            "dropped": self.dropped,
+            "matches_per_second": self.matched / elapsed if elapsed else 0.0,
+            "wait_p50": percentile(50),
+            "wait_p90": percentile(90),
+            "wait_p99": percentile(99),
+            "round_ms": self.round_time / self.rounds * 1000 if self.rounds else 0.0,
+        }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.closed or len(self._pending) >= ROUND_SIZE,
+                                    self.tick)
+                if self.closed:
+                    return
+            self.run_round()
+
+    def _match(self, pending):
+        pairs = []
+        drops = []
+        touched = set()
+        for waiter in pending:
+            roles = self.queues.setdefault(waiter.queue, {})
+            if waiter.role not in roles and (len(roles) == 2 or ROLE_ANY in roles or
+                                             (roles and waiter.role == ROLE_ANY)):
+                drops.append((waiter, f"Queue {waiter.queue} pairs "
+                                      f"{' and '.join(roles) or 'any'} only"))
+                continue
+            self._seq += 1
+            heapq.heappush(roles.setdefault(waiter.role, []),
+                           (-waiter.priority, self._seq, waiter))
+            touched.add(waiter.queue)
+
+        for queue in touched:
+            heaps = list(self.queues[queue].values())
+            if len(heaps) == 1 and ROLE_ANY not in self.queues[queue]:
+                continue  # Only one side has shown up so far
+            first, second = (heaps[0], heaps[0]) if len(heaps) == 1 else heaps
+            while True:
+                a = self._pop(first, drops)
+                if a is None:
+                    break
+                b = self._pop(second, drops)
+                if b is None:
+                    heapq.heappush(first, a)  # Keeps its place
+                    break
+                pairs.append((a[2], b[2]))
+            if not any(self.queues[queue].values()):
+                del self.queues[queue]
+        return pairs, drops
+
+    def _pop(self, heap, drops):
+        while heap:
+            entry = heapq.heappop(heap)
+            if self.is_gone and self.is_gone(entry[2]):
+                drops.append((entry[2], "Disconnected while waiting"))
+                continue
+            return entry
+        return None
+
+    def _sweep(self, now):
+        drops = []
+        for queue, roles in list(self.queues.items()):
+            for role, heap in list(roles.items()):
+                kept = []
+                for entry in heap:
+                    waiter = entry[2]
+                    if now - waiter.enqueued_at > self.wait_timeout:
+                        drops.append((waiter, "Timed out waiting for a peer"))
+                    elif self.is_gone and self.is_gone(waiter):
+                        drops.append((waiter, "Disconnected while waiting"))
+                    else:
+                        kept.append(entry)
+                if len(kept) != len(heap):
+                    heapq.heapify(kept)
+                    roles[role] = kept
+            if not any(roles.values()):
+                del self.queues[queue]
+        return drops
+
+
+def format_stats(stats):
+    return (f"{stats['queued']} waiting, {stats['matched']} matched "
+            f"({stats['matches_per_second']:.1f}/s), {stats['dropped']} dropped, wait "
+            f"p50 {stats['wait_p50']:.2f}s p90 {stats['wait_p90']:.2f}s "
+            f"p99 {stats['wait_p99']:.2f}s, round {stats['round_ms']:.2f} ms")
+
+
+def _benchmark(waiters=20000, queues=10, threads=8):
+    """Throughput and waits with 10k+ clients queued behind busy agents"""
+    import random
+    print(f"[BENCH] {waiters} customers arrive at once in {queues} queues; "
+          f"agents join later in bursts")
+    matched = []
+    matchmaker = Matchmaker(on_match=lambda a, b: matched.append(a))
+    customers = [Waiter(f"support{i % queues}", "customer", random.choice((0, 0, 0, 5)))
+                 for i in range(waiters)]
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=lambda part: [matchmaker.enqueue(w) for w in part],
+                                args=(customers[i::threads],)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    enqueued = time.perf_counter() - start
+    matchmaker.run_round()
+    print(f"[BENCH] {waiters} joins from {threads} threads: {waiters / enqueued:.0f} joins/s; "
+          f"{matchmaker.queued} queued")
+
+    start = time.perf_counter()
+    rounds = 0
+    while matchmaker.queued:
+        for i in range(waiters // 20):
+            matchmaker.enqueue(Waiter(f"support{i % queues}", "agent", 0))
+        matchmaker.run_round()
+        rounds += 1
+    elapsed = time.perf_counter() - start
+    stats = matchmaker.stats()
+    priority_first = sum(w.priority for w in matched[:waiters // 4]) / (waiters // 4)
+    print(f"[BENCH] {stats['matched']} matches in {rounds} rounds: "
+          f"{stats['matched'] / elapsed:.0f} matches/s, round {stats['round_ms']:.2f} ms")
+    print(f"[BENCH] Waits p50 {stats['wait_p50'] * 1000:.0f} ms, "
+          f"p90 {stats['wait_p90'] * 1000:.0f} ms, p99 {stats['wait_p99'] * 1000:.0f} ms; "
+          f"mean priority of the first quarter served {priority_first:.2f} (all: 1.25)")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,432 @@
+# presence.py
+#
+# Presence and direct dialing through the mediator.
+#
+# Instead of agreeing on a room beforehand, a client can go online: it
+# registers its name (and optionally an opaque key, e.g. a mailbox
+# address) on a control connection it keeps open. Anyone can then dial
+# it by name or key. The mediator finds the user in a dict, makes up a
+# private room and pushes it to both sides at once; they join it like
+# any other room. Clients also name the contacts they want to follow,
+# and every time one of them comes online or goes offline the mediator
+# pushes that to the users watching it. A reverse index (name -> watchers)
+# makes that cost one push per watcher, however many users are online.
+#
+# Control connection, client to mediator:
+#   MSG_REGISTER (name, key, contacts), then MSG_SUBSCRIBE (contacts) ...
+# and mediator to client:
+#   MSG_REGISTERED, MSG_PRESENCE (name, status), MSG_INVITE (room, name) ...
+# A dial is a one-shot request, MSG_DIAL answered by MSG_INVITE or MSG_ERROR.
+
+import os
+import socket
+import ssl
+import threading
+import protocol
+
+MAX_USERS = 100000  # Users online at once
+MAX_CONTACTS = 1000  # Contacts one user may follow
+SEND_TIMEOUT = 5.0  # Seconds a push may take before the user is dropped
+REGISTER_TIMEOUT = 5.0  # Seconds a client waits for its registration to be confirmed
+PRESENCE_ROOM = "@presence"  # Ring key of the node that keeps the registry in a cluster
+
+
+class PresenceError(Exception):
+    """A registration was refused; the message is the reason sent to the client"""
+
+
+class User:
+    """An online client and its control connection"""
+
+    def __init__(self, name, key, conn, addr, contacts=()):
+        self.name = name
+        self.key = key
+        self.conn = conn
+        self.addr = addr
+        self.contacts = set()  # Names this user is told about
+        self.requested = list(contacts)  # Contacts asked for in the registration
+        self._send_lock = threading.Lock()
+
+    def push(self, data):
+        """Send frames to the user; False (and the user dropped) if that failed"""
+        with self._send_lock:
+            try:
+                self.conn.sendall(data)
+                return True
+            except OSError:
+                pass
+        self.drop()
+        return False
+
+    def drop(self):
+        # Wakes up the thread serving the connection, which unregisters it
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Presence:
+    """Who is online, indexed by name and key, and who follows whom"""
+
+    def __init__(self, max_users=MAX_USERS):
+        self.max_users = max_users
+        self.users = {}  # name: User
+        self.keys = {}  # key: User
+        self.watchers = {}  # name: {User following it}
+        self.pushes = 0
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.users)
+
+    def register(self, user):
+        """Put a user online and tell its watchers; raises PresenceError
+
+        A name is refused while the connection it is online on is still
+        open. Once that connection has hung up the name moves to the new
+        one, even before the mediator has finished with the old one. The
+        key proves nothing here: anyone who can dial a user by key has it.
+        """
+        with self._lock:
+            old = self.users.get(user.name)
+        # Peeked at outside the lock; the old connection is checked again below
+        if old is not None and not protocol.peer_closed(old.conn):
+            raise PresenceError(f"{user.name} is already online")
+        with self._lock:
+            if self.closed:
+                raise PresenceError("Mediator is stopping")
+            if self.users.get(user.name) is not old:
+                raise PresenceError(f"{user.name} is already online")
+            if old is None and len(self.users) >= self.max_users:
+                raise PresenceError("Too many users online")
+            if user.key is not None and self.keys.get(user.key, old) is not old:
+                raise PresenceError("Key is registered by another user")
+            if old is not None:
+                self._remove(old)
+            self.users[user.name] = user
+            if user.key is not None:
+                self.keys[user.key] = user
+            watchers = list(self.watchers.get(user.name, ())) if old is None else []
+        if old is not None:
+            old.drop()
+        self._fan_out(watchers, protocol.encode_presence(user.name, True))
+
+    def unregister(self, user):
+        """Take a user offline and tell its watchers
+
+        Returns False if the user had already been replaced by a newer
+        registration, which stays online.
+        """
+        with self._lock:
+            if self.users.get(user.name) is not user:
+                return False
+            self._remove(user)
+            watchers = list(self.watchers.get(user.name, ()))
+        self._fan_out(watchers, protocol.encode_presence(user.name, False))
+        return True
+
+    def close(self):
+        """Take everyone offline and refuse new registrations; returns who was online
+
+        Their control connections are shut down. Nobody is told: every
+        watcher is one of the users going offline.
+        """
+        with self._lock:
+            self.closed = True
+            users = list(self.users.values())
+            self.users.clear()
+            self.keys.clear()
+            self.watchers.clear()
+        for user in users:
+            user.drop()
+        return users
+
+    def subscribe(self, user, names):
+        """Follow more contacts; the ones online now are pushed right away"""
+        with self._lock:
+            if self.users.get(user.name) is not user:
+                return
+            room = MAX_CONTACTS - len(user.contacts)
+            names = [name for name in dict.fromkeys(names)
+                     if name not in user.contacts][:max(room, 0)]
+            for name in names:
+                user.contacts.add(name)
+                self.watchers.setdefault(name, set()).add(user)
+            online = [name for name in names if name in self.users]
+        if online:
+            self.pushes += len(online)
+            user.push(b"".join(protocol.encode_presence(name, True) for name in online))
+
+    def lookup(self, name=None, key=None):
+        """The online user with that name or key, or None"""
+        if name is not None:
+            return self.users.get(name)
+        if key is not None:
+            return self.keys.get(key)
+        return None
+
+    def serve(self, user):
+        """Keep a registered user online until its control connection closes
+
+        Returns whether that took the user offline (see unregister).
+        """
+        conn = user.conn
+        conn.settimeout(SEND_TIMEOUT)  # Bounds pushes to a client that stopped reading
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        reader = protocol.FrameReader()
+        try:
+            user.push(protocol.encode_registered())
+            self.subscribe(user, user.requested)
+            while True:
+                try:
+                    data = conn.recv(4096)
+                except (socket.timeout, BlockingIOError, ssl.SSLWantReadError):
+                    # Idle, not gone; keepalive notices dead peers. The socket is
+                    # briefly non-blocking while register() peeks at it.
+                    continue
+                if not data:
+                    break
+                for msg_type, fields in reader.feed(data):
+                    if msg_type == protocol.MSG_SUBSCRIBE:
+                        self.subscribe(user, protocol.decode_names(
+                            fields.get(protocol.FIELD_CONTACTS, b"")))
+        except (OSError, protocol.ProtocolError):
+            pass
+        finally:
+            conn.close()
+            went_offline = self.unregister(user)
+        return went_offline
+
+    def _remove(self, user):
+        # Called with the lock held
+        del self.users[user.name]
+        if user.key is not None and self.keys.get(user.key) is user:
+            del self.keys[user.key]
+        for name in user.contacts:
+            watchers = self.watchers[name]
+            watchers.discard(user)
+            if not watchers:
+                del self.watchers[name]
+        user.contacts = set()
+
+    def _fan_out(self, watchers, frame):
+        # One encoded frame for everyone; sent outside the lock
+        self.pushes += len(watchers)
+        for watcher in watchers:
+            watcher.push(frame)
+
+
+def dial_room():
+    """A fresh private room for a dialed pair"""
+    return "dial-" + os.urandom(16).hex()
+
+
+# === Client side ===
+
+class PresenceClient:
+    """Keeps us online at the mediator so contacts can see and dial us
+
+    Callbacks run on the client's reader thread:
+      on_presence(name, online)   a contact came online or went offline
+      on_invite(room, name)       name dialed us; join room to talk
+      on_closed(reason)           the control connection is gone
+    """
+
+    def __init__(self, name, server_host, server_port=6000, key=None, contacts=(),
+                 on_presence=None, on_invite=None, on_closed=None):
+        self.name = name
+        self.server_host = server_host
+        self.server_port = server_port
+        self.key = key
+        self.contacts = list(contacts)
+        self.on_presence = on_presence
+        self.on_invite = on_invite
+        self.on_closed = on_closed
+        self.online = {}  # contact: whether it is online
+        self.sock = None
+        self.closed = False
+
+    def connect(self):
+        """Register and start listening for pushes
+
+        Raises OSError, ConnectionError or protocol.ProtocolError if the
+        mediator can't be reached or refuses the registration.
+        """
+        frame = protocol.encode_register(self.name, self.key, self.contacts)
+        self.sock, _, frames = _request(self.server_host, self.server_port, frame,
+                                        protocol.MSG_REGISTERED, REGISTER_TIMEOUT)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        threading.Thread(target=self._run, args=(frames,), daemon=True).start()
+
+    def subscribe(self, names):
+        """Follow more contacts"""
+        self.contacts.extend(names)
+        self.sock.sendall(protocol.encode_subscribe(names))
+
+    def dial(self, target=None, key=None, timeout=REGISTER_TIMEOUT):
+        """See dial(); we are the caller"""
+        return dial(self.server_host, self.name, target, key, self.server_port, timeout)
+
+    def close(self):
+        self.closed = True
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    def _run(self, frames):
+        reason = "Closed"
+        try:
+            for msg_type, fields in frames:
+                if msg_type == protocol.MSG_PRESENCE:
+                    name = fields.get(protocol.FIELD_NAME, b"").decode()
+                    online = fields.get(protocol.FIELD_STATUS) == b"\x01"
+                    self.online[name] = online
+                    if self.on_presence:
+                        self.on_presence(name, online)
+                elif msg_type == protocol.MSG_INVITE:
+                    if self.on_invite:
+                        self.on_invite(fields.get(protocol.FIELD_ROOM, b"").decode(),
+                                       fields.get(protocol.FIELD_NAME, b"").decode())
+                elif msg_type == protocol.MSG_ERROR:
+                    reason = fields.get(protocol.FIELD_REASON, b"").decode()
+                    break  # The mediator hangs up next
+        except (OSError, protocol.ProtocolError) as e:
+            if not self.closed:
+                reason = str(e)
+        self.closed = True
+        if self.on_closed:
+            self.on_closed(reason)
+
+
+def dial(server_host, name, target=None, key=None, server_port=6000, timeout=REGISTER_TIMEOUT):
+    """Ask the mediator to connect us (name) with an online user
+
+    The user is found by target name or by the key it registered. Returns
+    (room, their name) once they have been sent the same room; join it
+    with a P2PSession. Raises protocol.ProtocolError if they are offline.
+    """
+    frame = protocol.encode_dial(name, target, key)
+    sock, fields, _ = _request(server_host, server_port, frame, protocol.MSG_INVITE, timeout)
+    sock.close()
+    return (fields.get(protocol.FIELD_ROOM, b"").decode(),
+            fields.get(protocol.FIELD_NAME, b"").decode())
+
+
+def _request(server_host, server_port, frame, expected, timeout):
+    """Send frame to the registry's node, following redirects
+
+    Returns the socket, the fields of the first `expected` frame and an
+    iterator over the other frames, starting with any that came before it.
+    """
+    from cluster import HashRing, parse_nodes
+    from tls import connect_mediator, keep_session
+    candidates = HashRing(parse_nodes(server_host, server_port)).owners(PRESENCE_ROOM)
+    error = None
+    while candidates:
+        node = candidates.pop(0)
+        try:
+            sock = connect_mediator(node, timeout=timeout)
+            sock.sendall(frame)
+        except OSError as e:
+            error = e
+            continue
+        early = []
+        frames = _frames(sock)
+        try:
+            for msg_type, fields in frames:
+                if msg_type == protocol.MSG_REDIRECT:
+                    raise protocol.RedirectError(fields.get(protocol.FIELD_NODE, b"").decode())
+                if msg_type == protocol.MSG_ERROR:
+                    raise protocol.ProtocolError(
+                        f"Mediator error: {fields.get(protocol.FIELD_REASON, b'').decode()}")
+                if msg_type == expected:
+                    keep_session(node, sock)
+                    return sock, fields, _chain(early, frames)
+                early.append((msg_type, fields))
+        except protocol.RedirectError as e:
+            sock.close()
+            candidates.insert(0, e.node)
+        except BaseException:
+            sock.close()
+            raise
+    raise error or ConnectionError("No mediator reachable")
+
+
+def _frames(sock):
+    reader = protocol.FrameReader()
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("Connection closed by mediator")
+        yield from reader.feed(data)
+
+
+def _chain(*parts):
+    for part in parts:
+        yield from part
+
+
+class _Sink:
+    """Stands in for a control connection in the benchmark"""
+
+    def __init__(self):
+        self.sent = 0
+
+    def sendall(self, data):
+        self.sent += len(data)
+
+    def shutdown(self, how):
+        pass
+
+
+def _benchmark(users=100000, contacts=50, lookups=200000):
+    """Registry cost with many users online, each following some contacts"""
+    import random
+    import time
+    names = [f"user{i}" for i in range(users)]
+    presence = Presence(max_users=users)
+
+    start = time.perf_counter()
+    online = []
+    for name in names:
+        user = User(name, os.urandom(16), _Sink(), None)
+        presence.register(user)
+        presence.subscribe(user, random.sample(names, contacts))
+        online.append(user)
+    elapsed = time.perf_counter() - start
+    print(f"[BENCH] {users} users online, {contacts} contacts each: "
+          f"{users / elapsed:.0f} registrations/s with their subscriptions and pushes")
+
+    targets = [random.choice(names) for _ in range(1000)]
+    start = time.perf_counter()
+    for i in range(lookups):
+        presence.lookup(targets[i % len(targets)])
+    by_name = (time.perf_counter() - start) / lookups
+    keys = [user.key for user in random.sample(online, 1000)]
+    start = time.perf_counter()
+    for i in range(lookups):
+        presence.lookup(key=keys[i % len(keys)])
+    by_key = (time.perf_counter() - start) / lookups
+    print(f"[BENCH] Dial lookup: by name {by_name * 1e6:.2f} us, by key {by_key * 1e6:.2f} us")
+
+    churn = random.sample(online, 10000)
+    pushes = presence.pushes
+    start = time.perf_counter()
+    for user in churn:
+        presence.unregister(user)
+        presence.register(User(user.name, user.key, _Sink(), None))
+    elapsed = time.perf_counter() - start
+    pushes = presence.pushes - pushes
+    print(f"[BENCH] {len(churn)} users went offline and back: "
+          f"{len(churn) * 2 / elapsed:.0f} status changes/s, "
+          f"{pushes / (len(churn) * 2):.1f} pushes per change, {pushes / elapsed:.0f} pushes/s")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -3,9 +3,19 @@ from tkinter import ttk, scrolledtext, messagebox
 import socket
 import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import os
+import protocol
+from admission import Admission, PrefixSet, reject
+from admission import REJECT_RATE, REJECT_CAPACITY, REJECT_BLOCKED
+from tracing import Tracer
+from postbox import Postbox, MailboxFull, EXPIRE_INTERVAL
+from presence import Presence, PresenceError, User, dial_room
+from matchmaking import Matchmaker, MatchError, Waiter, format_stats
+from waiting import WaitingRooms, RoomWaiter
+from workers import WorkerPool
+from tls import server_context, accept_tls
 
 class MediatorServerGUI:
     def __init__(self):
@@ -34,10 +44,30 @@ class MediatorServerGUI:
         self.port = 6000
         self.server_socket = None
         self.is_running = False
+        self.stopped = None  # Set when this run of the server stops; new one per start
+        self.rate_limit = 5.0  # Connections per second per IP
+        self.rate_burst = 20
+        self.max_connections = 1000  # Served at once
+        self.blocklist_path = "blocklist.txt"  # Addresses/CIDR prefixes to refuse
+        self.admission = None
+        self.workers = 64  # Connections handled at once
+        self.worker_backlog = 1024  # Admitted connections that may wait for a worker
+        self.pool = None
+        self.tls_cert = os.environ.get("P2P_TLS_CERT")  # TLS for clients with P2P_TLS_CA (opt-in, see tls.py)
+        self.tls_key = os.environ.get("P2P_TLS_KEY")  # Unless the key is in the certificate file
+        self.tls_context = None
+        self.join_timeout = 10.0  # Seconds a new connection gets to send its join
+        self.wait_timeout = 600.0  # Seconds a client may wait in a room for its peer
+        self.reap_interval = 5.0  # Seconds between sweeps for hung-up or expired waiters
+        self.postbox_dir = os.environ.get("P2P_POSTBOX")  # Offline mail directory (opt-in, see postbox.py)
+        self.postbox = None
+        self.max_online = 100000  # Users registered for presence and dialing at once
+        self.presence = None
+        self.matchmaker = None
         
         # Data structures
-        self.rooms = {}  # room_id: (pubkey, conn, addr, name, timestamp)
-        self.connections = {}  # conn: (addr, room_id, name, timestamp)
+        self.rooms = WaitingRooms()  # Waiters by room, IP and join time (see waiting.py)
+        self.connections = set()  # Sockets of clients being served
         self.stats = {
             'total_connections': 0,
             'successful_matches': 0,
@@ -160,7 +190,39 @@ class MediatorServerGUI:
         self.rooms_frame = tk.Frame(self.notebook, bg=self.colors['bg'])
         self.notebook.add(self.rooms_frame, text='Active Rooms')
         
-        # Rooms table
+        # Rooms table is built the first time the tab is opened
+        self.rooms_tree = None
+        
+        # Logs Tab
+        self.logs_frame = tk.Frame(self.notebook, bg=self.colors['bg'])
+        self.notebook.add(self.logs_frame, text='Logs')
+        
+        # Logs display
+        self.logs_text = scrolledtext.ScrolledText(
+            self.logs_frame,
+            wrap=tk.WORD,
+            width=100,
+            height=30,
+            bg=self.colors['surface'],
+            fg=self.colors['text'],
+            font=('Consolas', 10),
+            insertbackground=self.colors['text'],
+            selectbackground=self.colors['primary'],
+            border=0,
+            highlightthickness=1,
+            highlightcolor=self.colors['border'],
+            highlightbackground=self.colors['border']
+        )
+        
+        # Settings Tab
+        self.settings_frame = tk.Frame(self.notebook, bg=self.colors['bg'])
+        self.notebook.add(self.settings_frame, text='Settings')
+        self.settings_built = False
+        
+        self.notebook.bind('<<NotebookTabChanged>>', self.on_tab_changed)
+        
+    def create_rooms_widgets(self):
+        """Create the active rooms table"""
         self.rooms_tree = ttk.Treeview(
             self.rooms_frame,
             columns=('Room ID', 'Client Name', 'IP Address', 'Public Key', 'Wait Time'),
@@ -169,6 +231,7 @@ class MediatorServerGUI:
         )
         
         # Configure treeview style
+        style = ttk.Style()
         style.configure('Treeview',
                        background=self.colors['surface'],
                        foreground=self.colors['text'],
@@ -194,33 +257,20 @@ class MediatorServerGUI:
         self.rooms_scrollbar = ttk.Scrollbar(self.rooms_frame, orient="vertical", command=self.rooms_tree.yview)
         self.rooms_tree.configure(yscrollcommand=self.rooms_scrollbar.set)
         
-        # Logs Tab
-        self.logs_frame = tk.Frame(self.notebook, bg=self.colors['bg'])
-        self.notebook.add(self.logs_frame, text='Logs')
-        
-        # Logs display
-        self.logs_text = scrolledtext.ScrolledText(
-            self.logs_frame,
-            wrap=tk.WORD,
-            width=100,
-            height=30,
-            bg=self.colors['surface'],
-            fg=self.colors['text'],
-            font=('Consolas', 10),
-            insertbackground=self.colors['text'],
-            selectbackground=self.colors['primary'],
-            border=0,
-            highlightthickness=1,
-            highlightcolor=self.colors['border'],
-            highlightbackground=self.colors['border']
-        )
-        
-        # Settings Tab
-        self.settings_frame = tk.Frame(self.notebook, bg=self.colors['bg'])
-        self.notebook.add(self.settings_frame, text='Settings')
-        
-        self.create_settings_widgets()
+        self.rooms_tree.pack(side='left', fill='both', expand=True, padx=(20, 0), pady=20)
+        self.rooms_scrollbar.pack(side='right', fill='y', padx=(0, 20), pady=20)
         
+    def on_tab_changed(self, event):
+        """Build hidden tabs on first use to keep startup fast"""
+        selected = self.notebook.nametowidget(self.notebook.select())
+        if selected is self.rooms_frame:
+            if self.rooms_tree is None:
+                self.create_rooms_widgets()
+            self.update_rooms_display()
+        elif selected is self.settings_frame and not self.settings_built:
+            self.create_settings_widgets()
+            self.settings_built = True
+            
     def create_stats_cards(self):
         """Create statistics cards"""
         # Total Connections Card
@@ -248,6 +298,19 @@ class MediatorServerGUI:
             self.stats_frame, "Server Uptime", "00:00:00", self.colors['info']
         )
         
+        # Rejected Connections Card, with the reasons underneath
+        self.rejected_card = self.create_stat_card(
+            self.stats_frame, "Rejected Connections", "0", self.colors['secondary']
+        )
+        self.rejected_detail = tk.Label(
+            self.rejected_card['frame'],
+            text="rate 0 | cap 0 | blocked 0",
+            font=('Arial', 9),
+            fg=self.colors['text_muted'],
+            bg=self.colors['surface']
+        )
+        self.rejected_detail.pack(pady=(0, 10))
+        
     def create_stat_card(self, parent, title, value, color):
         """Create a statistics card widget"""
         card_frame = tk.Frame(
@@ -370,7 +433,7 @@ class MediatorServerGUI:
         # Arrange stats cards in grid
         cards = [
             self.total_conn_card, self.matches_card, self.failed_card,
-            self.active_rooms_card, self.uptime_card
+            self.active_rooms_card, self.uptime_card, self.rejected_card
         ]
         
         for i, card in enumerate(cards):
@@ -382,10 +445,6 @@ class MediatorServerGUI:
         for i in range(3):
             self.stats_frame.grid_columnconfigure(i, weight=1)
             
-        # Rooms layout
-        self.rooms_tree.pack(side='left', fill='both', expand=True, padx=(20, 0), pady=20)
-        self.rooms_scrollbar.pack(side='right', fill='y', padx=(0, 20), pady=20)
-        
         # Logs layout
         self.logs_text.pack(fill='both', expand=True, padx=20, pady=20)
         
@@ -429,7 +488,27 @@ class MediatorServerGUI:
             self.server_socket.bind((self.host, self.port))
             self.server_socket.listen(5)
             
+            self.admission = Admission(rate=self.rate_limit, burst=self.rate_burst,
+                                       max_connections=self.max_connections,
+                                       blocklist=PrefixSet.load(self.blocklist_path))
+            if self.admission.blocklist.size:
+                self.log_message(f"Loaded {self.admission.blocklist.size} blocklist entries")
+            self.pool = WorkerPool(self.workers, self.worker_backlog)
+            self.tls_context = server_context(self.tls_cert, self.tls_key) if self.tls_cert else None
+            if self.tls_context:
+                self.log_message(f"TLS enabled with {self.tls_cert}")
+            self.postbox = Postbox(self.postbox_dir) if self.postbox_dir else None
+            self.presence = Presence(self.max_online)
+            self.matchmaker = Matchmaker(self.send_queue_match, self.drop_queued,
+                                         is_gone=lambda waiter: protocol.peer_closed(waiter.conn),
+                                         wait_timeout=self.wait_timeout)
+            self.matchmaker.start()
+            if self.postbox:
+                self.log_message(f"Keeping offline mail in {self.postbox.path} "
+                                 f"({self.postbox.size} bytes waiting)")
+            
             self.is_running = True
+            self.stopped = threading.Event()
             self.stats['server_start_time'] = datetime.now()
             
             # Update UI
@@ -439,8 +518,11 @@ class MediatorServerGUI:
             
             self.log_message(f"Server started on {self.host}:{self.port}", "SUCCESS")
             
-            # Start server thread
+            # Start server and reaper threads
             threading.Thread(target=self.server_loop, daemon=True).start()
+            threading.Thread(target=self.reap_waiters, args=(self.stopped,), daemon=True).start()
+            if self.postbox:
+                threading.Thread(target=self.expire_mail, args=(self.stopped,), daemon=True).start()
             
         except Exception as e:
             self.log_message(f"Failed to start server: {str(e)}", "ERROR")
@@ -452,19 +534,28 @@ class MediatorServerGUI:
             return
             
         self.is_running = False
+        self.stopped.set()
         
         if self.server_socket:
             self.server_socket.close()
             
         # Close all client connections
-        for conn in list(self.connections.keys()):
+        for conn in list(self.connections):
             try:
                 conn.close()
             except:
                 pass
                 
         self.connections.clear()
-        self.rooms.clear()
+        for waiter in self.rooms.clear():
+            waiter.conn.close()
+        if self.presence:
+            self.presence.close()
+        if self.matchmaker:
+            for waiter in self.matchmaker.close():
+                waiter.conn.close()
+        if self.pool:
+            self.pool.close()
         
         # Update UI
         self.server_status.config(text="● Server Stopped", fg=self.colors['danger'])
@@ -478,83 +569,253 @@ class MediatorServerGUI:
         while self.is_running:
             try:
                 conn, addr = self.server_socket.accept()
+                if self.admission.admit(addr[0]):
+                    reject(conn)  # Counted in the dashboard, not logged
+                    continue
                 self.stats['total_connections'] += 1
                 
                 self.log_message(f"New connection from {addr[0]}:{addr[1]}")
                 
-                # Handle client in separate thread
-                threading.Thread(
-                    target=self.handle_client, 
-                    args=(conn, addr), 
-                    daemon=True
-                ).start()
+                # Handle client on a worker thread
+                if not self.pool.submit(self.handle_client, conn, addr):
+                    self.admission.release()
+                    reject(conn)
+                    self.log_message(f"All workers busy, refused {addr[0]}", "WARNING")
                 
             except Exception as e:
                 if self.is_running:
                     self.log_message(f"Server loop error: {str(e)}", "ERROR")
                 break
                 
+    def drop_waiter(self, waiter, reason):
+        """Tell a waiter it was dropped (if it can still hear it) and free its slot"""
+        self.log_message(f"{waiter.name} ({waiter.addr[0]}) removed from room {waiter.room}: "
+                         f"{reason}", "WARNING")
+        try:
+            waiter.conn.send(protocol.encode_failure(reason, waiter.legacy))
+        except OSError:
+            pass
+        waiter.conn.close()
+        self.connections.discard(waiter.conn)
+        self.admission.release()
+        
+    def send_queue_match(self, a, b):
+        """Send two clients paired by the matchmaker each other's details"""
+        self.log_message(f"Queue {a.queue}: matching {a.name} ({a.addr[0]}) and "
+                         f"{b.name} ({b.addr[0]})", "SUCCESS")
+        self.stats['successful_matches'] += 1
+        try:
+            a.conn.send(protocol.encode_peer(b.pubkey, b.addr[0], b.name, b.port))
+            b.conn.send(protocol.encode_peer(a.pubkey, a.addr[0], a.name, a.port))
+        except OSError as e:
+            self.log_message(f"Failed to send to both clients: {str(e)}", "ERROR")
+            self.stats['failed_connections'] += 1
+            a.conn.close()
+            b.conn.close()
+        self.admission.release()
+        self.admission.release()
+        if self.matchmaker.matched % 1000 == 0:
+            self.log_message(f"Queues: {format_stats(self.matchmaker.stats())}")
+        
+    def drop_queued(self, waiter, reason):
+        """Tell a queued client it was dropped and free its slot"""
+        self.log_message(f"{waiter.name} ({waiter.addr[0]}) removed from queue "
+                         f"{waiter.queue}: {reason}", "WARNING")
+        try:
+            waiter.conn.send(protocol.encode_error(reason))
+        except OSError:
+            pass
+        waiter.conn.close()
+        self.admission.release()
+        
+    def reap_waiters(self, stopped):
+        """Purge waiters that hung up or waited too long, until this run stops"""
+        while not stopped.wait(self.reap_interval):
+            expired = self.rooms.joined_before(time.monotonic() - self.wait_timeout)
+            candidates = [(waiter, "Timed out waiting for a peer") for waiter in expired]
+            expired = set(expired)
+            # Sockets are checked outside the locks; only waiters still there go
+            candidates += [(waiter, "Disconnected while waiting") for waiter in self.rooms.oldest()
+                           if waiter not in expired and protocol.peer_closed(waiter.conn)]
+            for waiter, reason in candidates:
+                if self.rooms.remove(waiter):
+                    self.drop_waiter(waiter, reason)
+                
+    def expire_mail(self, stopped):
+        """Delete mail nobody collected within the TTL, until this run stops"""
+        while not stopped.wait(EXPIRE_INTERVAL):
+            freed = self.postbox.expire()
+            if freed:
+                self.log_message(f"Expired {freed} bytes of undelivered mail", "WARNING")
+                
+    def take_deposits(self, conn, addr, deposit):
+        """Store deposits, confirming each, until the client hangs up; closes conn"""
+        stored = 0
+        try:
+            while True:
+                room_id, mailbox, blob = deposit
+                try:
+                    if self.postbox is None:
+                        raise MailboxFull("This mediator keeps no mail")
+                    self.postbox.deposit(mailbox, blob)
+                    stored += 1
+                    conn.sendall(protocol.encode_stored())
+                except MailboxFull as e:
+                    conn.sendall(protocol.encode_error(str(e)))
+                try:
+                    msg_type, deposit = protocol.read_request(conn, timeout=self.join_timeout)
+                except (ConnectionError, socket.timeout, protocol.ProtocolError):
+                    break
+                if msg_type != protocol.MSG_DEPOSIT:
+                    break
+        finally:
+            conn.close()
+        self.log_message(f"{stored} blob(s) deposited by {addr[0]}")
+        
+    def deliver_mail(self, conn, addr, name, mailbox):
+        """Stream a joining client's mail to it, a segment per write"""
+        delivered = self.postbox.deliver(mailbox, lambda blobs: conn.sendall(
+            b"".join(protocol.encode_mail(blob) for blob in blobs)))
+        if delivered:
+            self.log_message(f"{delivered} blob(s) delivered to {name} ({addr[0]})")
+                
+    def serve_presence(self, conn, addr, request):
+        """Keep a registered client online until it hangs up"""
+        name, key, contacts = request
+        user = User(name, key, conn, addr, contacts)
+        try:
+            self.presence.register(user)
+        except PresenceError as e:
+            conn.send(protocol.encode_error(str(e)))
+            conn.close()
+            return
+        self.log_message(f"{name} ({addr[0]}) is online, {len(self.presence)} online")
+        if self.presence.serve(user):
+            self.log_message(f"{name} ({addr[0]}) went offline, {len(self.presence)} online")
+        
+    def dial_user(self, conn, addr, request):
+        """Put a caller in touch with an online user: both get a private room"""
+        name, target, key = request
+        callee = self.presence.lookup(target, key)
+        room_id = dial_room()
+        if callee is None or not callee.push(protocol.encode_invite(room_id, name)):
+            conn.send(protocol.encode_error(f"{target or 'That user'} is not online"))
+            return
+        self.log_message(f"{name} ({addr[0]}) dialed {callee.name}", "SUCCESS")
+        conn.send(protocol.encode_invite(room_id, callee.name))
+                
     def handle_client(self, conn, addr):
         """Handle individual client connection"""
+        tracer = Tracer(f"{addr[0]}:{addr[1]}", process="mediator")
+        waiting = False
         try:
-            data = conn.recv(4096).decode()
-            parts = data.strip().split(":")
-            
-            if len(parts) != 3:
-                self.log_message(f"Invalid data from {addr}: {data}", "ERROR")
-                conn.send(b"error")
+            if self.tls_context:
+                try:
+                    with tracer.span("tls_handshake"):
+                        conn = accept_tls(conn, self.tls_context, self.join_timeout)
+                except OSError as e:
+                    self.log_message(f"TLS handshake with {addr[0]} failed: {str(e)}", "ERROR")
+                    self.stats['failed_connections'] += 1
+                    return
+                if conn is None:
+                    return
+            try:
+                with tracer.span("read_join"):
+                    msg_type, request = protocol.read_request(conn, timeout=self.join_timeout)
+            except protocol.ProtocolError as e:
+                self.log_message(f"Invalid data from {addr}: {str(e)}", "ERROR")
+                conn.send(protocol.encode_failure(str(e), e.legacy))
                 self.stats['failed_connections'] += 1
                 return
-                
-            room_id, pubkey_str, name = parts
-            
-            try:
-                pubkey = int(pubkey_str)
-            except ValueError:
-                self.log_message(f"Invalid pubkey from {addr}: {pubkey_str}", "ERROR")
-                conn.send(b"error")
+            except ConnectionError:
+                return  # Closed before joining, e.g. a liveness probe
+            except socket.timeout:
+                self.log_message(f"{addr[0]} sent no join within {self.join_timeout:.0f}s", "WARNING")
                 self.stats['failed_connections'] += 1
+                conn.close()
+                return
+                
+            if msg_type == protocol.MSG_DEPOSIT:
+                self.take_deposits(conn, addr, request)
+                return
+            if msg_type == protocol.MSG_DIAL:
+                self.dial_user(conn, addr, request)
+                return
+            if msg_type == protocol.MSG_REGISTER:
+                self.admission.release()  # Online users are capped by the registry instead
+                waiting = True  # So the slot isn't released twice
+                # Stays connected while online, so not on a worker
+                threading.Thread(target=self.serve_presence, args=(conn, addr, request),
+                                 daemon=True).start()
                 return
+            if msg_type == protocol.MSG_ENQUEUE:
+                queue_name, role, priority, pubkey, name, p2p_port = request
+                try:
+                    self.matchmaker.enqueue(Waiter(queue_name, role, priority, conn, addr, name,
+                                                   pubkey, p2p_port))
+                except MatchError as e:
+                    conn.send(protocol.encode_error(str(e)))
+                    return
+                waiting = True  # Stays admitted until matched or dropped
+                self.log_message(f"{name} ({addr[0]}) waiting as {role or 'any'} in queue {queue_name}")
+                return
+            room_id, pubkey, name, p2p_port, _, legacy, mailbox = request
+            if mailbox and self.postbox:
+                with tracer.span("deliver_mail"):
+                    self.deliver_mail(conn, addr, name, mailbox)
                 
             # Store connection info
-            self.connections[conn] = (addr, room_id, name, datetime.now())
+            self.connections.add(conn)
             
-            if room_id not in self.rooms:
+            # Pair with the room's waiter or become it, in one step; a waiter
+            # that hung up would waste this client's session, so it is replaced
+            waiter, dead = self.rooms.join(
+                RoomWaiter(room_id, pubkey, conn, addr, name, p2p_port, legacy),
+                is_gone=lambda waiter: protocol.peer_closed(waiter.conn))
+            waiting = waiter is None  # Stays admitted until matched or purged
+            if dead:
+                self.drop_waiter(dead, "Disconnected while waiting")
+                
+            if waiting:
                 # First client in room - waiting
-                self.rooms[room_id] = (pubkey, conn, addr, name, datetime.now())
                 self.log_message(f"{name} ({addr[0]}) waiting in room {room_id}")
                 
             else:
                 # Second client - make connection
-                pubkey1, conn1, addr1, name1, _ = self.rooms.pop(room_id)
+                self.admission.release()  # The waiter's slot
                 
-                self.log_message(f"Matching {name1} ({addr1[0]}) and {name} ({addr[0]})", "SUCCESS")
+                self.log_message(f"Matching {waiter.name} ({waiter.addr[0]}) and {name} ({addr[0]})",
+                                 "SUCCESS")
                 self.stats['successful_matches'] += 1
                 
                 try:
                     # Send peer info to both clients
-                    conn1.send(f"{pubkey}:{addr[0]}:{name}".encode())
-                    conn.send(f"{pubkey1}:{addr1[0]}:{name1}".encode())
+                    with tracer.span("match", room=room_id):
+                        waiter.conn.send(protocol.encode_reply(pubkey, addr[0], name, waiter.legacy,
+                                                               p2p_port))
+                        conn.send(protocol.encode_reply(waiter.pubkey, waiter.addr[0], waiter.name,
+                                                        legacy, waiter.port))
                     
                     # Remove from active connections
-                    if conn in self.connections:
-                        del self.connections[conn]
-                    if conn1 in self.connections:
-                        del self.connections[conn1]
+                    self.connections.discard(conn)
+                    self.connections.discard(waiter.conn)
                         
                 except Exception as e:
                     self.log_message(f"Failed to send to both clients: {str(e)}", "ERROR")
                     self.stats['failed_connections'] += 1
-                    conn1.close()
+                    waiter.conn.close()
                     conn.close()
                     
         except Exception as e:
             self.log_message(f"Client handling error: {str(e)}", "ERROR")
             self.stats['failed_connections'] += 1
         finally:
+            tracer.flush()
+            if not waiting:
+                self.admission.release()
+            
             # Clean up if connection still exists
-            if conn in self.connections:
-                del self.connections[conn]
+            self.connections.discard(conn)
                 
     def update_ui_thread(self):
         """Update UI elements periodically"""
@@ -570,6 +831,12 @@ class MediatorServerGUI:
         self.matches_card['value_label'].config(text=str(self.stats['successful_matches']))
         self.failed_card['value_label'].config(text=str(self.stats['failed_connections']))
         self.active_rooms_card['value_label'].config(text=str(len(self.rooms)))
+        if self.admission:
+            rejected = self.admission.rejected
+            self.rejected_card['value_label'].config(text=str(self.admission.total_rejected))
+            self.rejected_detail.config(text=f"rate {rejected[REJECT_RATE]} | "
+                                             f"cap {rejected[REJECT_CAPACITY]} | "
+                                             f"blocked {rejected[REJECT_BLOCKED]}")
         
         # Update uptime
         if self.stats['server_start_time'] and self.is_running:
@@ -581,20 +848,26 @@ class MediatorServerGUI:
             
     def update_rooms_display(self):
         """Update active rooms display"""
+        # Nothing to redraw while the tab is hidden
+        if self.rooms_tree is None or self.notebook.select() != str(self.rooms_frame):
+            return
+            
         # Clear existing items
         for item in self.rooms_tree.get_children():
             self.rooms_tree.delete(item)
             
-        # Add current rooms
-        for room_id, (pubkey, conn, addr, name, timestamp) in self.rooms.items():
-            wait_time = datetime.now() - timestamp
+        # Add current rooms, longest waiting first
+        now = time.monotonic()
+        for waiter in self.rooms.oldest():
+            wait_time = timedelta(seconds=now - waiter.joined_at)
             wait_time_str = str(wait_time).split('.')[0]  # Remove microseconds
+            pubkey = str(waiter.pubkey)
             
             self.rooms_tree.insert('', 'end', values=(
-                room_id,
-                name,
-                addr[0],
-                str(pubkey)[:20] + "..." if len(str(pubkey)) > 20 else str(pubkey),
+                waiter.room,
+                waiter.name,
+                waiter.addr[0],
+                pubkey[:20] + "..." if len(pubkey) > 20 else pubkey,
                 wait_time_str
             ))
             
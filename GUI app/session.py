@@ -0,0 +1,343 @@
+# session.py
+#
+# Headless P2P chat session.
+#
+# P2PSession runs the whole connection flow (key exchange, mediator
+# rendezvous, connection racing, reconnects and channel multiplexing)
+# without prompts or widgets and reports everything through callbacks.
+# Chat goes on mux.CHANNEL_CHAT; open_channel() adds more, e.g. for bulk
+# transfers that must not hold up chat. client.py
+# and the GUI client are thin shells over it. Bots and services can drive
+# hundreds of sessions from one process by passing listen_port=0: each
+# session then listens on an ephemeral port and the mediator tells the
+# peer which one. server_host may list several mediators of a cluster
+# ("host:port,host:port"); the room's owner is then found by consistent
+# hashing, with failover along the ring. Both peers must pick the same
+# Diffie-Hellman group (see groups.py), like they pick the same room.
+# batch_window (seconds, off by default) lets the link pack bursts of
+# small messages into one frame, at the cost of up to that much latency.
+# With a history (history.History) chat messages are numbered and kept,
+# and when the peer keeps one too every connect resyncs what either side
+# missed, e.g. while one of them was restarted.
+# With a mailbox address (see postbox.py) the mediator first streams the
+# mail other peers left there while we were offline to on_mail.
+# With a role, room names a matchmaking queue instead (see
+# matchmaking.py) and the session is paired with any waiting peer of the
+# other role, e.g. a customer with the first free agent.
+
+import socket
+import threading
+from DHKE import DHKE, load_backend
+from groups import get_group, DEFAULT_GROUP
+from protocol import encode_join, encode_enqueue, read_peer, RedirectError
+from cluster import HashRing, parse_nodes
+from link import ReconnectingLink, BACKPRESSURE_NOTIFY
+from link import STATE_CONNECTING, STATE_CONNECTED, STATE_CLOSED
+from mux import Mux, CHANNEL_CHAT, CHANNEL_CHAT_ENTRY, CHANNEL_SYNC
+from mux import PRIORITY_INTERACTIVE, PRIORITY_BULK
+from history import ENTRY, SYNC_SUMMARY, SYNC_ENTRIES
+from history import encode_summary, decode_summary, encode_entries, decode_entries
+from race import create_listener, race_connect
+from tracing import Tracer
+from tls import connect_mediator, keep_session
+
+DEFAULT_LISTEN_PORT = 7000  # Also assumed for peers whose join carried no port
+MEDIATOR_TIMEOUT = 5.0  # Seconds to reach a mediator before trying the next
+MAX_REDIRECTS = 3
+
+
+class P2PSession:
+    """One end of an encrypted P2P chat, driven from code
+
+    Callbacks run on background threads:
+      on_peer(name, ip)          the mediator paired us, keys are ready
+      on_message(data)           a chat message arrived (bytes); with a
+                                 history, also ones recovered by a resync
+      on_state(state, detail)    link state changes, see link.STATE_*
+      on_rtt(estimator)          new round-trip sample
+      on_sent(latency, depth)    a queued chat message went out
+      on_error(exception)        a send failed, or connect_async() failed
+      on_mail(blob)              offline mail from the mediator, still sealed
+    """
+
+    def __init__(self, name, room, server_host, server_port=6000,
+                 listen_port=DEFAULT_LISTEN_PORT, on_message=None, on_state=None,
+                 on_peer=None, on_rtt=None, on_sent=None, on_error=None,
+                 heartbeat_interval=5.0, dead_timeout=15.0, max_reconnect_attempts=None,
+                 send_queue_size=256, send_backpressure=BACKPRESSURE_NOTIFY,
+                 group=DEFAULT_GROUP, batch_window=0.0, history=None,
+                 mailbox=None, on_mail=None, role=None, priority=0):
+        self.name = name
+        self.room = room
+        self.server_host = server_host
+        self.server_port = server_port
+        self.servers = parse_nodes(server_host, server_port)
+        self.listen_port = listen_port
+        self.group = group
+        self.on_message = on_message
+        self.on_state = on_state
+        self.on_peer = on_peer
+        self.on_rtt = on_rtt
+        self.on_sent = on_sent
+        self.on_error = on_error
+        self.heartbeat_interval = heartbeat_interval
+        self.dead_timeout = dead_timeout
+        self.max_reconnect_attempts = max_reconnect_attempts
+        self.batch_window = batch_window
+        self.history = history
+        self.mailbox = mailbox
+        self.on_mail = on_mail
+        self.role = role
+        self.priority = priority
+
+        self.peer_name = ""
+        self.peer_ip = ""
+        self.peer_port = None
+        self.peer_pubkey = None
+        self.pubkey = None
+        self.aes_key = None
+        self.is_leader = False
+        self.listener = None
+        self.link = None
+        self.closed = False
+        self._mediator = None
+        # Handshake phases are traced when P2P_TRACE is set
+        self.tracer = Tracer(f"{room}/{name}")
+
+        # Channels can be opened before connecting; nothing is sent until
+        # the link exists. Every session opens the history channels, so
+        # peers that differ in keeping a history still understand each
+        # other; we chat on CHANNEL_CHAT_ENTRY if we keep one.
+        self.mux = Mux(self._send_frame, on_error=on_error)
+        self._chat_channel = CHANNEL_CHAT if history is None else CHANNEL_CHAT_ENTRY
+        for channel, on_message in ((CHANNEL_CHAT, self._receive_message),
+                                    (CHANNEL_CHAT_ENTRY, self._receive_entry)):
+            self.mux.open_channel(channel, PRIORITY_INTERACTIVE,
+                                  maxsize=send_queue_size, policy=send_backpressure,
+                                  block_timeout=1.0, on_message=on_message,
+                                  on_sent=on_sent)
+        self.mux.open_channel(CHANNEL_SYNC, PRIORITY_BULK, maxsize=0,
+                              on_message=self._receive_sync)
+
+    @property
+    def state(self):
+        if self.closed:
+            return STATE_CLOSED
+        return self.link.state if self.link else STATE_CONNECTING
+
+    @property
+    def queue_depth(self):
+        """Chat messages waiting for the sender thread"""
+        return self.mux.queued(self._chat_channel)
+
+    def connect(self):
+        """Pair with a peer through the mediator and start the P2P link
+
+        Blocks until the peer is found; the direct connection itself comes
+        up in the background and is reported through on_state. Raises
+        OSError, ConnectionError, protocol.ProtocolError or
+        DHKE.InvalidPublicKeyError on failure.
+        """
+        tracer = self.tracer
+        try:
+            with tracer.span("dh_keygen", group=self.group, backend=load_backend()):
+                group = get_group(self.group)
+                dh = DHKE(group.p, group.g, power_g=group.power_g,
+                          check_key=group.check_public_key)
+                dh.generate_private_key()
+                self.pubkey = dh.generate_public_key()
+
+            # Listen first so the mediator can pass our port to the peer
+            self.listener = create_listener(self.listen_port)
+            port = self.listener.getsockname()[1]
+
+            self.peer_pubkey, self.peer_ip, self.peer_name, peer_port = self._join_room(port)
+            self.peer_port = peer_port or DEFAULT_LISTEN_PORT
+
+            with tracer.span("compute_shared_secret"):
+                from Crypto.Hash import SHA256  # Deferred to keep startup fast
+                shared_secret = dh.compute_shared_secret(self.peer_pubkey)
+                self.aes_key = SHA256.new(str(shared_secret).encode()).digest()
+
+            # Both peers listen and dial, the leader only breaks ties
+            self.is_leader = self.pubkey > self.peer_pubkey
+        except Exception:
+            tracer.flush()
+            self.mux.close()
+            self._close_listener()
+            raise
+
+        if self.on_peer:
+            self.on_peer(self.peer_name, self.peer_ip)
+        if self.closed:
+            raise ConnectionError("Session closed")
+
+        self.link = ReconnectingLink(
+            self._p2p_connection,
+            self.aes_key,
+            on_message=self.mux.receive,
+            on_state=self._state_changed,
+            on_rtt=self.on_rtt,
+            max_attempts=self.max_reconnect_attempts,
+            heartbeat_interval=self.heartbeat_interval,
+            dead_timeout=self.dead_timeout,
+            batch_window=self.batch_window)
+        self.link.start()
+
+    def connect_async(self):
+        """Run connect() on a background thread; failures go to on_error"""
+        def run():
+            try:
+                self.connect()
+            except Exception as e:
+                if self.on_error and not self.closed:
+                    self.on_error(e)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def send(self, data, channel=CHANNEL_CHAT):
+        """Queue a message (str or bytes) for the peer
+
+        Messages sent while the link is reconnecting are replayed once it
+        is back. Returns False if the backpressure policy dropped it and
+        raises queue.Full under BACKPRESSURE_NOTIFY.
+        """
+        if self.link is None:
+            raise ConnectionError("Not connected")
+        if isinstance(data, str):
+            data = data.encode()
+        history = self.history
+        if history is None or channel != CHANNEL_CHAT:
+            return self.mux.submit(channel, data)
+        seq = history.reserve()
+        if not self.mux.submit(CHANNEL_CHAT_ENTRY, ENTRY.pack(history.origin, seq) + data):
+            return False
+        history.add(history.origin, seq, data)
+        return True
+
+    def open_channel(self, channel_id, priority=PRIORITY_BULK, on_message=None, **options):
+        """Add a logical channel; the peer must open it with the same window
+
+        See mux.Mux.open_channel for the options. Bulk channels block
+        send() while their queue is full rather than dropping data.
+        """
+        self.mux.open_channel(channel_id, priority, on_message=on_message, **options)
+
+    def close(self, reason="Closed"):
+        if self.closed:
+            return
+        self.closed = True
+        mediator = self._mediator
+        if mediator:
+            try:
+                mediator.shutdown(socket.SHUT_RDWR)  # Wakes up a pending room wait
+            except OSError:
+                pass
+        if self.link:
+            self.link.close(reason)
+        self.mux.close()
+        self._close_listener()
+
+    def _join_room(self, port):
+        """Join the room at its mediator and wait there for the peer
+
+        Mediators are tried in ring order starting with the room's owner,
+        skipping the ones that can't be reached, and redirects from a
+        node that doesn't own the room are followed.
+        """
+        if self.role is not None:
+            join = encode_enqueue(self.room, self.role, self.pubkey, self.name, port,
+                                  self.priority)
+        else:
+            join = encode_join(self.room, self.pubkey, self.name, port, mailbox=self.mailbox)
+        candidates = HashRing(self.servers).owners(self.room)
+        redirects = 0
+        error = None
+        while candidates and not self.closed:
+            node = candidates.pop(0)
+            try:
+                with self.tracer.span("mediator_connect", server=node):
+                    self._mediator = s = connect_mediator(node, timeout=MEDIATOR_TIMEOUT)
+                    s.settimeout(None)
+                    s.sendall(join)
+            except OSError as e:
+                error = e
+                if self._mediator:
+                    self._mediator.close()
+                    self._mediator = None
+                continue
+            try:
+                with self.tracer.span("room_wait", room=self.room):
+                    return read_peer(s, self.on_mail)
+            except RedirectError as e:
+                redirects += 1
+                if redirects > MAX_REDIRECTS:
+                    raise
+                candidates.insert(0, e.node)
+            finally:
+                self._mediator = None
+                keep_session(node, s)
+                s.close()
+        raise error or ConnectionError("Session closed")
+
+    def _p2p_connection(self):
+        # Called for the first connection and again after every drop;
+        # ReconnectingLink retries failures with jittered backoff.
+        listener = self.listener
+        if listener is None:
+            raise OSError("Session closed")
+        try:
+            with self.tracer.span("p2p_connect", peer=self.peer_ip):
+                return race_connect(listener, (self.peer_ip, self.peer_port),
+                                    self.aes_key, self.is_leader)
+        finally:
+            self.tracer.flush()
+
+    def _send_frame(self, data):
+        return self.link.send(data)
+
+    def _receive_message(self, data):
+        if self.on_message:
+            self.on_message(data)
+
+    def _receive_entry(self, data):
+        if len(data) < ENTRY.size:
+            return  # Malformed
+        origin, seq = ENTRY.unpack_from(data)
+        data = data[ENTRY.size:]
+        if self.history is not None and not self.history.add(origin, seq, data):
+            return  # Already recovered by a resync
+        if self.on_message:
+            self.on_message(data)
+
+    def _receive_sync(self, data):
+        if self.history is None or not data:
+            return  # The peer keeps a history, we don't
+        if data[0] == SYNC_SUMMARY:
+            for message in encode_entries(self.history.missing(decode_summary(data))):
+                self.mux.submit(CHANNEL_SYNC, message)
+        elif data[0] == SYNC_ENTRIES:
+            for origin, seq, message in decode_entries(data):
+                # Our own messages only come back if we lost them
+                if self.history.add(origin, seq, message) and \
+                        origin != self.history.origin and self.on_message:
+                    self.on_message(message)
+
+    def _state_changed(self, state, detail):
+        if state == STATE_CLOSED:
+            self.closed = True
+            self.mux.close()
+            self._close_listener()
+        elif state == STATE_CONNECTED and self.history is not None:
+            try:
+                self.mux.submit(CHANNEL_SYNC, encode_summary(self.history.summary()))
+            except ConnectionError:
+                pass  # Closed meanwhile
+        if self.on_state:
+            self.on_state(state, detail)
+
+    def _close_listener(self):
+        listener, self.listener = self.listener, None
+        if listener:
+            listener.close()
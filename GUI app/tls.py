@@ -0,0 +1,199 @@
+# tls.py
+#
+# Optional TLS between clients and the mediator.
+#
+# A join sent in the clear can be rewritten on the way: whoever sits on
+# the path can swap the DH public key in it for their own. A mediator
+# started with P2P_TLS_CERT (and P2P_TLS_KEY, unless the key is in the
+# same file) also speaks TLS on its port; clients given that certificate,
+# or the CA that signed it, in P2P_TLS_CA connect over TLS and check the
+# certificate before sending anything. The first byte of a connection
+# tells a TLS handshake (0x16) from a plaintext join, so older clients
+# keep working on the same port.
+#
+# A full handshake costs the mediator a certificate signature per join.
+# It hands out a session ticket after each handshake, and clients keep
+# the latest ticket from every node and offer it on their next
+# connection; a resumed handshake skips the certificate and signature.
+# Tickets are sealed with keys the mediator makes up at start, so they
+# are good until it restarts.
+
+import os
+import socket
+import ssl
+import threading
+from cluster import parse_node
+
+TLS_HANDSHAKE = b"\x16"  # Content type of the first TLS record
+TICKETS = 1  # Tickets issued per handshake; a client only keeps the latest
+
+_client_context = None
+_sessions = {}  # node: ssl.SSLSession, the latest one each mediator issued
+_lock = threading.Lock()
+
+
+# === Mediator side ===
+
+def server_context(certfile, keyfile=None):
+    """TLS context for a mediator; handshakes hand out session tickets"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = TICKETS
+    return context
+
+
+def accept_tls(conn, context, timeout):
+    """Serve conn over TLS if its client opened with a handshake
+
+    Returns the socket to talk to the client on: a TLS socket, conn
+    itself for a plaintext client, or None if the client hung up before
+    sending anything (e.g. a liveness probe). A handshake that fails or
+    takes longer than timeout raises OSError (ssl.SSLError is one) with
+    the connection closed.
+    """
+    try:
+        conn.settimeout(timeout)
+        first = conn.recv(1, socket.MSG_PEEK)
+        if first != TLS_HANDSHAKE:
+            conn.settimeout(None)
+            return conn if first else None
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Handshake flights are small
+        conn = context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+        conn.do_handshake()
+        conn.settimeout(None)
+        return conn
+    except OSError:
+        conn.close()
+        raise
+
+
+def format_stats(context):
+    stats = context.session_stats()
+    return (f"{stats['accept_good']} handshakes, {stats['hits']} resumed, "
+            f"{stats['accept'] - stats['accept_good']} failed")
+
+
+# === Client side ===
+
+def client_context():
+    """Context for reaching mediators over TLS, or None if P2P_TLS_CA isn't set"""
+    global _client_context
+    if _client_context is None and os.environ.get("P2P_TLS_CA"):
+        _client_context = ssl.create_default_context(cafile=os.environ["P2P_TLS_CA"])
+    return _client_context
+
+
+def connect_mediator(node, timeout=None):
+    """Connect to a mediator node, over TLS when client_context() says so
+
+    A session kept from this node earlier is offered for resumption.
+    Call keep_session() once the mediator has answered, so the next
+    connection can resume the session it issued.
+    """
+    host, port = parse_node(node)
+    sock = socket.create_connection((host, port), timeout=timeout)
+    context = client_context()
+    if context is None:
+        return sock
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Handshake flights are small
+        return context.wrap_socket(sock, server_hostname=host, session=_sessions.get(node))
+    except BaseException:
+        sock.close()
+        raise
+
+
+def keep_session(node, sock):
+    """Remember sock's session for the next connection to node
+
+    Under TLS 1.3 the ticket arrives after the handshake, so this only
+    finds one after something has been read from the mediator.
+    """
+    session = getattr(sock, "session", None)
+    if session is not None and session.has_ticket:
+        with _lock:
+            _sessions[node] = session
+
+
+def _benchmark(joins=300):
+    """Joins per second, and mediator CPU per join, with full and resumed TLS handshakes"""
+    import shutil
+    import subprocess
+    import tempfile
+    import time
+    import protocol
+    from DHKE import p
+    path = tempfile.mkdtemp(prefix="tls-")
+    try:
+        cert, key = os.path.join(path, "cert.pem"), os.path.join(path, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                        "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=127.0.0.1",
+                        "-addext", "subjectAltName=IP:127.0.0.1"],
+                       check=True, capture_output=True)
+        server = server_context(cert, key)
+        tls13 = ssl.create_default_context(cafile=cert)
+        tls12 = ssl.create_default_context(cafile=cert)
+        tls12.maximum_version = ssl.TLSVersion.TLSv1_2
+    finally:
+        shutil.rmtree(path)
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(64)
+    node = f"127.0.0.1:{listener.getsockname()[1]}"
+    mediator_cpu = [0.0]
+
+    def mediator():
+        # Answers every join at once as if its peer were waiting
+        while True:
+            conn, addr = listener.accept()
+            start = time.thread_time()
+            try:
+                conn = accept_tls(conn, server, 5.0)
+                protocol.read_request(conn, timeout=5.0)
+                conn.sendall(protocol.encode_peer(p - 1, "127.0.0.1", "peer", 7000))
+            except (OSError, protocol.ProtocolError):
+                pass
+            finally:
+                if conn:
+                    conn.close()
+            mediator_cpu[0] += time.thread_time() - start
+
+    threading.Thread(target=mediator, daemon=True).start()
+    join = protocol.encode_join("room", p - 2, "bench", 7000)
+
+    def run(context, resume):
+        session = None
+        resumed = 0
+        mediator_cpu[0] = 0.0
+        start = time.perf_counter()
+        for _ in range(joins):
+            sock = socket.create_connection(parse_node(node))
+            if context:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock = context.wrap_socket(sock, server_hostname="127.0.0.1",
+                                           session=session if resume else None)
+            with sock:
+                sock.sendall(join)
+                protocol.read_peer(sock)
+                if context:
+                    resumed += sock.session_reused
+                    session = sock.session
+        return joins / (time.perf_counter() - start), mediator_cpu[0] / joins, resumed
+
+    print(f"[BENCH] {joins} sequential joins on localhost, RSA-2048 certificate, "
+          f"{ssl.OPENSSL_VERSION}")
+    for label, context, resume in (("Plaintext", None, False),
+                                   ("TLS 1.3, full handshakes", tls13, False),
+                                   ("TLS 1.3, resumed", tls13, True),
+                                   ("TLS 1.2, full handshakes", tls12, False),
+                                   ("TLS 1.2, resumed", tls12, True)):
+        rate, cpu, resumed = run(context, resume)
+        print(f"[BENCH] {label}: {rate:.0f} joins/s, mediator CPU {cpu * 1e6:.0f} us/join "
+              f"({resumed} resumed)")
+    print(f"[BENCH] Mediator: {format_stats(server)}")
+
+
+if __name__ == "__main__":
+    _benchmark()
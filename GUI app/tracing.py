@@ -0,0 +1,127 @@
+# tracing.py
+#
+# Lightweight phase tracing for connection setup.
+#
+# Set P2P_TRACE to a file path to enable it. Paths ending in ".json" get
+# Chrome trace events (open in chrome://tracing or Perfetto); anything
+# else gets one JSON object per span. Files are appended to, so the
+# clients and the mediator can share one file and their timelines line up.
+# With P2P_TRACE unset, span() hands back a shared no-op object.
+
+import os
+import threading
+import time
+
+TRACE_PATH = os.environ.get("P2P_TRACE")
+
+# Converts perf_counter_ns() readings to wall-clock microseconds so spans
+# from different processes can be compared.
+_OFFSET_NS = time.time_ns() - time.perf_counter_ns()
+_write_lock = threading.Lock()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = repr(exc)
+        self.tracer._record(self.name, self.start, end, self.args)
+        return False
+
+    def set(self, **args):
+        """Attach extra details to the span"""
+        self.args.update(args)
+
+
+class Tracer:
+    """Collects the phase spans of one session
+
+    Use `with tracer.span("phase"):` around each step and call flush() once
+    the session is set up to append its timeline to the trace file.
+    """
+
+    def __init__(self, session, process="client", path=None):
+        self.session = session
+        self.process = process
+        self.path = path or TRACE_PATH
+        self.enabled = bool(self.path)
+        self.events = []
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def _record(self, name, start, end, args):
+        self.events.append((name, start, end, args, threading.get_ident()))
+
+    def flush(self):
+        if not self.enabled or not self.events:
+            return
+        events, self.events = self.events, []
+        import json  # Only paid for when tracing is enabled
+        if self.path.endswith(".json"):
+            lines = self._chrome_events(events)
+        else:
+            lines = [json.dumps({
+                "session": self.session,
+                "process": self.process,
+                "name": name,
+                "start_us": (start + _OFFSET_NS) // 1000,
+                "duration_us": (end - start) // 1000,
+                **args,
+            }) + "\n" for name, start, end, args, _ in events]
+        with _write_lock:
+            new_file = not os.path.exists(self.path)
+            with open(self.path, "a") as f:
+                if new_file and self.path.endswith(".json"):
+                    f.write("[\n")
+                f.writelines(lines)
+
+    def _chrome_events(self, events):
+        # JSON Array Format: the trailing comma and missing "]" are allowed
+        # by the trace viewers, which keeps the file appendable.
+        import json
+        pid = os.getpid()
+        lines = [json.dumps({"name": "process_name", "ph": "M", "pid": pid,
+                             "args": {"name": self.process}}) + ",\n"]
+        for name, start, end, args, tid in events:
+            lines.append(json.dumps({
+                "name": name,
+                "cat": self.session,
+                "ph": "X",
+                "ts": (start + _OFFSET_NS) // 1000,
+                "dur": (end - start) // 1000,
+                "pid": pid,
+                "tid": tid,
+                "args": {"session": self.session, **args},
+            }) + ",\n")
+        return lines
@@ -0,0 +1,222 @@
+# waiting.py
+#
+# Registry of clients waiting in a room for their peer.
+#
+# Every waiter is a small __slots__ object instead of a tuple, so its
+# fields have names and it costs no per-instance dict. Rooms are spread
+# over STRIPES stripes by hash; each stripe has its own lock, its part of
+# the room index and its part of two secondary indexes: waiters by IP
+# and waiters in the order they joined. A dict keeps insertion order and
+# deletes in O(1), so the join-order index is just a dict used as an
+# ordered set. Lookups by IP and oldest-first listings visit every
+# stripe, which is a few dict probes, never a scan of all waiters.
+
+import heapq
+import threading
+import time
+
+STRIPES = 16
+
+
+class RoomWaiter:
+    """A client waiting in a room"""
+
+    __slots__ = ("room", "pubkey", "conn", "addr", "name", "port", "legacy", "joined_at")
+
+    def __init__(self, room, pubkey, conn, addr, name, port=None, legacy=False):
+        self.room = room
+        self.pubkey = pubkey
+        self.conn = conn
+        self.addr = addr
+        self.name = name
+        self.port = port
+        self.legacy = legacy
+        self.joined_at = time.monotonic()
+
+
+class _Stripe:
+    __slots__ = ("lock", "rooms", "by_ip", "by_time")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}  # room: RoomWaiter
+        self.by_ip = {}  # ip: {RoomWaiter: None}
+        self.by_time = {}  # RoomWaiter: None, oldest first
+
+
+class WaitingRooms:
+    """Waiters by room, with secondary indexes by IP and join time"""
+
+    def __init__(self, stripes=STRIPES):
+        self._stripes = [_Stripe() for _ in range(stripes)]
+
+    def __len__(self):
+        return sum(len(stripe.rooms) for stripe in self._stripes)
+
+    def add(self, waiter):
+        """Put a waiter in its room; False if someone already waits there"""
+        stripe = self._stripe(waiter.room)
+        with stripe.lock:
+            if waiter.room in stripe.rooms:
+                return False
+            self._insert(stripe, waiter)
+            return True
+
+    def join(self, waiter, is_gone=None):
+        """Match a newcomer with its room's waiter, or make it the waiter
+
+        Looking at the room and taking or filling it is one step under
+        the stripe's lock, so two clients joining an empty room at once
+        can't both end up waiting. Returns (peer, dead): the waiter to
+        pair with, or None if the newcomer now waits; and a waiter found
+        hung up (is_gone(waiter) true) that the newcomer replaced.
+        """
+        stripe = self._stripe(waiter.room)
+        with stripe.lock:
+            peer = stripe.rooms.get(waiter.room)
+            dead = None
+            if peer is not None:
+                self._delete(stripe, peer)
+                if is_gone and is_gone(peer):
+                    dead, peer = peer, None
+            if peer is None:
+                self._insert(stripe, waiter)
+            return peer, dead
+
+    def get(self, room):
+        return self._stripe(room).rooms.get(room)
+
+    def pop(self, room):
+        """Take the waiter out of a room, or None"""
+        stripe = self._stripe(room)
+        with stripe.lock:
+            waiter = stripe.rooms.get(room)
+            if waiter is not None:
+                self._delete(stripe, waiter)
+            return waiter
+
+    def remove(self, waiter):
+        """Take out this waiter if it is still waiting; returns whether it was"""
+        stripe = self._stripe(waiter.room)
+        with stripe.lock:
+            if stripe.rooms.get(waiter.room) is not waiter:
+                return False
+            self._delete(stripe, waiter)
+            return True
+
+    def by_ip(self, ip):
+        """Waiters connected from an IP"""
+        found = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                found.extend(stripe.by_ip.get(ip, ()))
+        return found
+
+    def oldest(self, count=None):
+        """Waiters in the order they joined, the first `count` of them"""
+        parts = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                waiters = stripe.by_time
+                parts.append(list(waiters) if count is None else
+                             [w for w, _ in zip(waiters, range(count))])
+        merged = heapq.merge(*parts, key=lambda waiter: waiter.joined_at)
+        return list(merged) if count is None else [w for w, _ in zip(merged, range(count))]
+
+    def joined_before(self, deadline):
+        """Waiters that joined before a time.monotonic() value"""
+        found = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                for waiter in stripe.by_time:
+                    if waiter.joined_at >= deadline:
+                        break  # The rest joined later
+                    found.append(waiter)
+        return found
+
+    def clear(self):
+        """Remove everyone; returns who was waiting"""
+        removed = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                removed.extend(stripe.by_time)
+                stripe.rooms.clear()
+                stripe.by_ip.clear()
+                stripe.by_time.clear()
+        return removed
+
+    def _stripe(self, room):
+        return self._stripes[hash(room) % len(self._stripes)]
+
+    def _insert(self, stripe, waiter):
+        # Called with the stripe's lock held
+        stripe.rooms[waiter.room] = waiter
+        stripe.by_ip.setdefault(waiter.addr[0], {})[waiter] = None
+        stripe.by_time[waiter] = None
+
+    def _delete(self, stripe, waiter):
+        # Called with the stripe's lock held
+        del stripe.rooms[waiter.room]
+        same_ip = stripe.by_ip[waiter.addr[0]]
+        del same_ip[waiter]
+        if not same_ip:
+            del stripe.by_ip[waiter.addr[0]]
+        del stripe.by_time[waiter]
+
+
+def _benchmark(count=100000):
+    """Memory per waiter and lookup cost, against the tuple-and-dict layout"""
+    import random
+    import sys
+    import tracemalloc
+    from datetime import datetime
+    from DHKE import p
+    ips = [f"10.{random.randrange(256)}.{random.randrange(256)}.{random.randrange(256)}"
+           for _ in range(count // 10)]
+    # What a real join carries is allocated up front; only the bookkeeping is measured
+    joins = [(f"room{i}", p - i, (ips[i % len(ips)], 40000 + i % 20000), f"user{i}")
+             for i in range(count)]
+    print(f"[BENCH] {count} waiters from {len(ips)} IPs")
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    rooms = {}
+    connections = {}
+    for i, (room, pubkey, addr, name) in enumerate(joins):
+        conn = i  # Stands in for the socket object
+        rooms[room] = (pubkey, conn, addr, name, datetime.now(), None, False)
+        connections[conn] = (addr, room, name, datetime.now())
+    tuples = tracemalloc.get_traced_memory()[0] - before
+    target = joins[-1][2][0]
+    start = time.perf_counter()
+    for _ in range(100):
+        [room for room, waiter in rooms.items() if waiter[2][0] == target]
+    scan = (time.perf_counter() - start) / 100
+    del rooms, connections
+
+    before = tracemalloc.get_traced_memory()[0]
+    registry = WaitingRooms()
+    for i, (room, pubkey, addr, name) in enumerate(joins):
+        registry.add(RoomWaiter(room, pubkey, i, addr, name))
+    slotted = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(100):
+        registry.by_ip(target)
+    indexed = (time.perf_counter() - start) / 100
+    start = time.perf_counter()
+    registry.oldest(100)
+    oldest = time.perf_counter() - start
+
+    entry = RoomWaiter(*joins[0][:2], 0, *joins[0][2:])
+    record = (entry.pubkey, 0, entry.addr, entry.name, datetime.now(), None, False)
+    print(f"[BENCH] One waiter: RoomWaiter {sys.getsizeof(entry)} B, "
+          f"tuple {sys.getsizeof(record)} B + datetime {sys.getsizeof(record[4])} B")
+    print(f"[BENCH] Tuples in rooms + connections dicts: {tuples / count:.0f} bytes per waiter, "
+          f"lookup by IP {scan * 1000:.2f} ms (scan)")
+    print(f"[BENCH] WaitingRooms with IP and join-time indexes: {slotted / count:.0f} bytes "
+          f"per waiter, lookup by IP {indexed * 1e6:.1f} us, 100 oldest {oldest * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,197 @@
+# admission.py
+#
+# Admission control for the mediator's accept loop.
+#
+# Every accepted socket is checked before a thread is spent on it: first
+# against the blocklist, then against a global cap on connections being
+# served, then against a token bucket for its source IP (allowlisted
+# addresses, loopback by default, skip the bucket). A rejected socket is
+# reset on the spot and never reaches the room table.
+
+import ipaddress
+import os
+import socket
+import struct
+import threading
+import time
+
+RATE = 5.0  # Sustained connections per second from one IP
+BURST = 20  # Connections one IP may open back to back
+MAX_CONNECTIONS = 1000  # Connections served at once, across all IPs
+BUCKET_IDLE = 60.0  # Seconds before an idle IP's bucket is forgotten
+BLOCKLIST_PATH = "blocklist.txt"
+ALLOWLIST = ("127.0.0.0/8", "::1")
+
+# SO_LINGER on, zero timeout: close() sends a reset and leaves no TIME_WAIT
+_LINGER_RESET = struct.pack("ii", 1, 0)
+
+# Rejection reasons
+REJECT_BLOCKED = "blocked"
+REJECT_CAPACITY = "capacity"
+REJECT_RATE = "rate"
+
+
+class PrefixSet:
+    """Set of addresses and CIDR prefixes, for block and allow lists
+
+    Prefixes are bucketed by length into hash sets, so a lookup is one
+    masked set probe per distinct prefix length in the list (at most 33
+    for IPv4), however many entries it holds.
+    """
+
+    def __init__(self, entries=()):
+        self.networks = {4: {}, 6: {}}  # version: {prefix length: {network bits}}
+        self.size = 0
+        for entry in entries:
+            self.add(entry)
+
+    @classmethod
+    def load(cls, path=BLOCKLIST_PATH):
+        """One address or prefix per line, '#' starts a comment; missing file is empty"""
+        blocklist = cls()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    entry = line.split("#", 1)[0].strip()
+                    if entry:
+                        blocklist.add(entry)
+        return blocklist
+
+    def add(self, entry):
+        network = ipaddress.ip_network(entry, strict=False)  # Also takes network objects
+        shift = network.max_prefixlen - network.prefixlen
+        by_length = self.networks[network.version]
+        by_length.setdefault(network.prefixlen, set()).add(int(network.network_address) >> shift)
+        self.size += 1
+
+    def __contains__(self, ip):
+        # inet_pton is several times cheaper than ipaddress on this path
+        try:
+            value, version, bits = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big"), 4, 32
+        except OSError:
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, ip.split("%", 1)[0])
+            except OSError:
+                return False
+            value, version, bits = int.from_bytes(packed, "big"), 6, 128
+        for length, networks in self.networks[version].items():
+            if value >> (bits - length) in networks:
+                return True
+        return False
+
+
+class Admission:
+    """Decides which accepted connections get served
+
+    Call admit() right after accept() and release() once the connection
+    no longer needs the mediator (matched, failed, or gone while waiting).
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, max_connections=MAX_CONNECTIONS,
+                 blocklist=None, allowlist=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_connections = max_connections
+        self.blocklist = blocklist if blocklist is not None else PrefixSet()
+        self.allowlist = allowlist if allowlist is not None else PrefixSet(ALLOWLIST)
+        self.buckets = {}  # ip: [tokens, last refill]
+        self.active = 0
+        self.accepted = 0
+        self.rejected = {REJECT_BLOCKED: 0, REJECT_CAPACITY: 0, REJECT_RATE: 0}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    @property
+    def total_rejected(self):
+        return sum(self.rejected.values())
+
+    def admit(self, ip):
+        """Return None if the connection may be served, else the rejection reason"""
+        if self.blocklist.size and ip in self.blocklist:
+            reason = REJECT_BLOCKED
+        else:
+            with self._lock:
+                now = time.monotonic()
+                reason = self._take(ip, now)
+                if reason is None:
+                    self.active += 1
+                    self.accepted += 1
+                if now - self._last_sweep > BUCKET_IDLE:
+                    self._sweep(now)
+        if reason:
+            self.rejected[reason] += 1
+        return reason
+
+    def release(self):
+        with self._lock:
+            if self.active > 0:
+                self.active -= 1
+
+    def _take(self, ip, now):
+        if self.active >= self.max_connections:
+            return REJECT_CAPACITY  # Checked first so it doesn't cost a token
+        if ip in self.allowlist:
+            return None
+        bucket = self.buckets.get(ip)
+        if bucket is None:
+            self.buckets[ip] = [self.burst - 1, now]
+            return None
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return REJECT_RATE
+        bucket[0] = tokens - 1
+        return None
+
+    def _sweep(self, now):
+        # Buckets idle this long have refilled anyway
+        self.buckets = {ip: bucket for ip, bucket in self.buckets.items()
+                        if now - bucket[1] < BUCKET_IDLE}
+        self._last_sweep = now
+
+
+def reject(conn):
+    """Drop a connection that failed admission as cheaply as possible"""
+    try:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _LINGER_RESET)
+    except OSError:
+        pass
+    conn.close()
+
+
+def _benchmark(entries=100000, lookups=200000):
+    """Cost of the reject paths with a large blocklist"""
+    import random
+    blocklist = PrefixSet(ipaddress.ip_network((random.getrandbits(24) << 8, 24))
+                          for _ in range(entries))
+    blocklist.add("10.0.0.0/8")
+    admission = Admission(blocklist=blocklist)
+    ips = [str(ipaddress.ip_address(random.getrandbits(32))) for _ in range(1000)]
+
+    start = time.perf_counter()
+    for _ in range(lookups):
+        admission.admit("10.1.2.3")
+    blocked = (time.perf_counter() - start) / lookups
+
+    start = time.perf_counter()
+    for i in range(lookups):
+        admission.admit(ips[i % len(ips)])
+        admission.release()
+    admitted = (time.perf_counter() - start) / lookups
+
+    admission = Admission()
+    for _ in range(admission.burst):
+        admission.admit("192.0.2.1")
+    start = time.perf_counter()
+    for _ in range(lookups):
+        admission.admit("192.0.2.1")
+    limited = (time.perf_counter() - start) / lookups
+
+    print(f"[BENCH] Blocklist of {blocklist.size} prefixes")
+    print(f"[BENCH] Blocked reject {blocked * 1e6:.2f} us, rate-limited reject "
+          f"{limited * 1e6:.2f} us, admit+release {admitted * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    _benchmark()
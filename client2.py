@@ -1,119 +1,111 @@
-import socket
+import queue
 import threading
 import time
-from DHKE import DHKE, p, g
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
-from Crypto.Hash import SHA256
+from protocol import ProtocolError
+from link import STATE_CONNECTED, BACKPRESSURE_BLOCK
+from session import P2PSession
+from history import History
+from presence import PresenceClient, dial
+import DHKE
 
 # === CONFIGURATION ===
 room = "room123"
-server_host = '10.196.43.51' # Update to your server's IP
+server_host = '10.196.43.51' # Update to your server's IP (or a cluster: 'ip:port,ip:port')
 server_port = 6000
 listen_port = 7000  # P2P listening port
+dh_group = "file"  # DH group, must match the peer's: file, modp2048, modp3072, ffdhe2048, ffdhe3072
+batch_window = 0.0  # Seconds to pack bursts of small messages (e.g. pastes) into one frame; 0 is off
+history_file = None  # e.g. "history-room123.log": keep the chat and resync it on connect (if the peer keeps one too)
+call = None  # e.g. "bob": dial a user who is online at the mediator instead of meeting in `room`
+go_online = False  # Register your name so contacts can see and dial you; takes the first call
+contacts = []  # Names whose online/offline changes are shown while you are online
+queue_role = None  # e.g. "customer" or "agent": `room` is a queue, take any free peer of the other role
 # ======================
 
 # === Ask name from user ===
 name = input("Enter your name: ").strip()
 
-# Setup DHKE
-dh = DHKE(p, g)
-dh.generate_private_key()
-pubkey = dh.generate_public_key()
+# === Presence: find the peer by name instead of a shared room ===
+def handle_presence(who, online):
+    print(f"\n[PRESENCE] {who} is {'online' if online else 'offline'}")
 
-# Connect to mediator server
-s = socket.socket()
-s.connect((server_host, server_port))
-s.send(f"{room}:{pubkey}:{name}".encode())
-
-# Receive peer info
-response = s.recv(4096).decode().strip()
-print(f"[DEBUG] Raw response from server: {response}")
-
-if ":" not in response:
-    print("[ERROR] Malformed response from server.")
-    exit()
-
-peer_pubkey_str, peer_ip, peername = response.split(":", 2)
-# Log peer IP and name
-with open("peers.txt", "a") as f:
-    f.write(f"{peername} - {peer_ip}\n")
-print(f"[INFO] Peer logged: {peername} - {peer_ip}")
+calls = queue.Queue()
 try:
-    peer_pubkey = int(peer_pubkey_str)
-except ValueError:
-    print("[ERROR] Invalid peer public key.")
+    if go_online:
+        presence = PresenceClient(name, server_host, server_port, contacts=contacts,
+                                  on_presence=handle_presence,
+                                  on_invite=lambda room, caller: calls.put((room, caller)))
+        presence.connect()
+    if call:
+        room, _ = dial(server_host, name, call, server_port=server_port)
+        print(f"[INFO] Dialed {call}")
+    elif go_online:
+        print("[INFO] Online, waiting for a call...")
+        room, caller = calls.get()
+        print(f"[INFO] {caller} is calling")
+except (ProtocolError, OSError) as e:
+    print(f"[ERROR] Presence: {e}")
     exit()
 
-print(f"[INFO] Received peer IP: {peer_ip}, peer public key: {peer_pubkey}")
+# === Session callbacks ===
+def handle_peer(peername, peer_ip):
+    # Log peer IP and name
+    with open("peers.txt", "a") as f:
+        f.write(f"{peername} - {peer_ip}\n")
+    print(f"[INFO] Peer logged: {peername} - {peer_ip}")
 
-# AES key setup
-shared_secret = dh.compute_shared_secret(peer_pubkey)
-aes_key = SHA256.new(str(shared_secret).encode()).digest()
-print(f"[INFO] AES Key: {aes_key.hex()}")
+    print(f"[INFO] Received peer IP: {peer_ip}, peer public key: {session.peer_pubkey}")
+    print(f"[INFO] AES Key: {session.aes_key.hex()}")
+    print(f"[INFO] DH group: {session.group} ({DHKE.BACKEND} big integers)")
+    print(f"[INFO] Peer Name: {peername}")
+    print(f"[INFO] I am {'leader' if session.is_leader else 'follower'}")
+    print("[P2P] Racing direct connection to peer...")
 
-s.close()
+def handle_message(msg):
+    print(f"\n{session.peer_name}: {msg.decode()}\nYou: ", end="")
 
-# Role decision
-my_ip = socket.gethostbyname(socket.gethostname())
-is_host = pubkey > peer_pubkey
-print(f"[INFO] My IP: {my_ip}")
-print(f"[INFO] Peer IP: {peer_ip}")
-print(f"[INFO] Peer Name: {peername}")
-print(f"[INFO] I am {'host' if is_host else 'client'}")
+def handle_state(state, detail):
+    if state == STATE_CONNECTED:
+        print(f"\n[P2P] Connected to {session.peer_name}" + (f" ({detail})" if detail else ""))
+    else:
+        print(f"\n[P2P] {state.capitalize()}" + (f": {detail}" if detail else ""))
 
-# === Receive messages ===
-def handle_recv(p2p_conn):
-    while True:
-        try:
-            data = p2p_conn.recv(4096)
-            if not data:
-                print(f"\n[INFO] {peername} disconnected.")
-                break
-            iv = data[:16]
-            ct = data[16:]
-            cipher = AES.new(aes_key, AES.MODE_CBC, iv)
-            msg = unpad(cipher.decrypt(ct), AES.block_size)
-            print(f"\n{peername}: {msg.decode()}\nYou: ", end="")
-        except Exception as e:
-            print(f"[RECEIVE ERROR] {e}")
-            break
+def handle_error(error):
+    print(f"\n[SEND ERROR] {error}")
 
 # === Send messages ===
-def handle_send(p2p_conn):
+def handle_send(session):
     while True:
         try:
-            msg = input("You: ").encode()
-            cipher = AES.new(aes_key, AES.MODE_CBC)
-            ct = cipher.encrypt(pad(msg, AES.block_size))
-            p2p_conn.send(cipher.iv + ct)
+            session.send(input("You: "))
+        except queue.Full:
+            print("[SEND ERROR] Send queue full, message not sent")
         except Exception as e:
             print(f"[SEND ERROR] {e}")
             break
 
-# === P2P Connection ===
-if is_host:
-    print("[P2P] Acting as host... Waiting for peer to connect.")
-    listener = socket.socket()
-    listener.bind(('', listen_port))
-    listener.listen(1)
-    conn, addr = listener.accept()
-    print(f"[P2P] Connection established with {addr}")
-else:
-    print("[P2P] Acting as client...")
-    conn = socket.socket()
-    while True:
-        try:
-            conn.connect((peer_ip, listen_port))
-            print(f"[P2P] Connected to host at {peer_ip}:{listen_port}")
-            break
-        except ConnectionRefusedError:
-            print("[P2P] Host not ready, retrying...")
-            time.sleep(1)
+session = P2PSession(name, room, server_host, server_port, listen_port,
+                     on_peer=handle_peer, on_message=handle_message,
+                     on_state=handle_state, on_error=handle_error,
+                     send_backpressure=BACKPRESSURE_BLOCK, group=dh_group,
+                     batch_window=batch_window,
+                     history=History(history_file) if history_file else None,
+                     role=queue_role)
+
+# Mediator rendezvous, key exchange, then the P2P link in the background
+try:
+    session.connect()
+except ProtocolError as e:
+    print(f"[ERROR] Malformed response from server: {e}")
+    exit()
+except OSError as e:  # Unreachable or refused mediator, timeouts, dropped connections
+    print(f"[ERROR] Could not reach the mediator: {e}")
+    exit()
+except DHKE.InvalidPublicKeyError as e:
+    print(f"[ERROR] {e}, refusing to connect")
+    exit()
 
-# Start threads
-threading.Thread(target=handle_recv, args=(conn,), daemon=True).start()
-threading.Thread(target=handle_send, args=(conn,), daemon=True).start()
+threading.Thread(target=handle_send, args=(session,), daemon=True).start()
 
 # Keep main thread alive
 try:
@@ -121,4 +113,4 @@ try:
         time.sleep(1)
 except KeyboardInterrupt:
     print("\n[INFO] Exiting.")
-    conn.close()
+    session.close()
@@ -0,0 +1,137 @@
+# cluster_bench.py
+#
+# Aggregate join throughput of a mediator cluster on localhost.
+#
+#   python cluster_bench.py [max_nodes] [seconds]
+#
+# Starts 1, 2, 4 ... max_nodes mediator processes as one cluster and has a
+# pool of load-generating processes pair up rooms against it for a few
+# seconds each, routing joins by the same consistent hashing the clients
+# use. Also checks that a join sent to the wrong node still gets matched
+# (redirect for binary clients, forwarding for legacy ones).
+
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import protocol
+from cluster import HashRing, parse_node
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASE_PORT = 6100
+WORKERS = 4  # Load generator processes
+THREADS = 8  # Room pairs in flight per worker
+
+
+def start_cluster(count):
+    nodes = [f"127.0.0.1:{BASE_PORT + i}" for i in range(count)]
+    env = dict(os.environ, P2P_CLUSTER=",".join(nodes))
+    env.pop("P2P_TRACE", None)
+    procs = [subprocess.Popen([sys.executable, "server.py"], cwd=ROOT,
+                              env=dict(env, P2P_NODE=node),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+             for node in nodes]
+    for node in nodes:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(parse_node(node), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+    return nodes, procs
+
+
+def join(node, room, name, legacy=False):
+    sock = socket.create_connection(parse_node(node))
+    if legacy:
+        sock.sendall(f"{room}:{random.getrandbits(512)}:{name}".encode())
+    else:
+        sock.sendall(protocol.encode_join(room, random.getrandbits(512), name, 7000))
+    return sock
+
+
+def pair(ring, room, first=None):
+    node = first or ring.owner(room)
+    a = join(node, room, "a")
+    b = join(node, room, "b")
+    try:
+        protocol.read_peer(a)
+        protocol.read_peer(b)
+    except protocol.RedirectError as e:
+        a.close()
+        b.close()
+        return pair(ring, room, e.node)
+    finally:
+        a.close()
+        b.close()
+
+
+def generate_load(args):
+    nodes, seconds, worker = args
+    ring = HashRing(nodes)
+    done = [0] * THREADS
+    deadline = time.time() + seconds
+
+    def run(index):
+        n = 0
+        while time.time() < deadline:
+            pair(ring, f"bench-{worker}-{index}-{n}")
+            n += 1
+        done[index] = n
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(done) * 2
+
+
+def check_misrouted(nodes):
+    """A join sent to a node that doesn't own the room still gets matched"""
+    ring = HashRing(nodes)
+    room = next(f"misrouted-{i}" for i in range(1000) if ring.owner(f"misrouted-{i}") != nodes[0])
+    a = join(nodes[0], room, "binary")
+    try:
+        protocol.read_peer(a)
+        return False
+    except protocol.RedirectError as e:
+        a.close()
+        a = join(e.node, room, "binary")
+    b = join(nodes[0], room, "legacy", legacy=True)  # Forwarded to the owner
+    protocol.read_peer(a)
+    reply = b.recv(4096)
+    a.close()
+    b.close()
+    return reply.count(b":") >= 2
+
+
+def main():
+    max_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"[BENCH] {os.cpu_count()} CPU(s), {WORKERS} load processes x {THREADS} threads")
+    count = 1
+    while count <= max_nodes:
+        nodes, procs = start_cluster(count)
+        try:
+            if count > 1:
+                print(f"[BENCH] Misrouted joins matched: {check_misrouted(nodes)}")
+            with multiprocessing.Pool(WORKERS) as pool:
+                joins = sum(pool.map(generate_load, [(nodes, seconds, w) for w in range(WORKERS)]))
+            print(f"[BENCH] {count} node(s): {joins / seconds:.0f} joins/s")
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+        count *= 2
+
+
+if __name__ == "__main__":
+    main()
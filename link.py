@@ -0,0 +1,840 @@
+# link.py
+#
+# Framed, encrypted P2P link with heartbeats and automatic reconnect.
+#
+# Wire format of every frame:
+#   length (4, big-endian) | nonce (12) | AES-CTR(type (1) | [ping stamp (8)] | payload) | tag (16)
+# The tag is a truncated HMAC-SHA256 of nonce and ciphertext; cipher and
+# MAC keys are derived from the session key. Ping/pong frames are
+# encrypted like data, so an observer can't tell a heartbeat from a chat
+# message.
+#
+# On a link the nonce is the link's random salt plus a frame counter, so
+# frames don't depend on each other: large ones are sealed in parallel on
+# a shared thread pool and a reorder buffer writes them out in counter
+# order. The receiver refuses a frame whose counter doesn't move forward.
+#
+# Batching is opt-in (batch_window): small data messages sent within the
+# window go out together in one FRAME_BATCH frame, whose payload is
+#   [length (4) | held for, in microseconds (4) | message] ...
+# so a burst of tiny messages pays for one nonce, tag and write.
+
+import functools
+import hashlib
+import hmac
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+# pycryptodome costs tens of milliseconds to import, so it is loaded on
+# the first frame rather than at startup (see _load_crypto).
+AES = None
+
+LENGTH = struct.Struct(">I")
+STAMP = struct.Struct(">Q")
+SEQ = struct.Struct(">Q")
+NONCE = struct.Struct(">8sI")  # link salt, frame counter
+NONCE_SIZE = NONCE.size
+TAG_SIZE = 16
+MAX_FRAME = 16 * 1024 * 1024
+MAX_COUNTER = 0xFFFFFFFF  # Frames per link; the reconnect after it picks a new salt
+
+# Parallel sealing of large frames
+PARALLEL_MIN = 8 * 1024  # Smaller frames are sealed on the sending thread
+MAX_IN_FLIGHT = 64  # Frames per link waiting to be sealed or written
+CRYPTO_WORKERS = os.cpu_count() or 1  # 1 means sealing stays on the sending thread
+
+RECV_BUFFER = 256 * 1024  # Initial receive buffer per link; grows for bigger frames
+RECV_CHUNK = 64 * 1024  # Free space below which the buffer is compacted before recv
+IN_PLACE_MIN = 128 * 1024  # Smaller frames decrypt faster from a copy than in place
+
+# Nagle-style batching of small messages, off unless a link asks for it
+BATCH_WINDOW = 0.0  # Seconds a small message may wait for company; 0 sends it at once
+BATCH_SIZE = 16 * 1024  # Bytes of messages that make a batch go out before the window ends
+BATCH_ENTRY = struct.Struct(">II")  # length, microseconds held back by the sender
+
+# Frame types
+FRAME_DATA = 0
+FRAME_PING = 1
+FRAME_PONG = 2
+FRAME_ACK = 3  # Cumulative ack of received message sequence numbers
+FRAME_RESUME = 4  # Sent on every (re)connect with the last sequence received
+FRAME_BATCH = 5  # Several data messages, see BATCH_ENTRY
+FLAG_PING = 0x80  # Frame carries a piggybacked ping stamp before its payload
+
+HEARTBEAT_INTERVAL = 5.0  # Seconds between pings on an idle link
+DEAD_TIMEOUT = 15.0  # Seconds of silence before the peer is declared dead
+ACK_EVERY = 32  # Messages received before an explicit ack is sent
+
+# Backpressure policies, applied when a send queue is full (see mux.py)
+BACKPRESSURE_BLOCK = "block"  # Wait for room (up to a timeout)
+BACKPRESSURE_DROP = "drop"  # Silently discard the new message
+BACKPRESSURE_NOTIFY = "notify"  # Raise queue.Full so the caller can tell the user
+
+# Reconnect states
+STATE_CONNECTING = "connecting"
+STATE_CONNECTED = "connected"
+STATE_RECONNECTING = "reconnecting"
+STATE_CLOSED = "closed"
+
+
+def _load_crypto():
+    global AES
+    from Crypto.Cipher import AES
+
+
+@functools.lru_cache(maxsize=256)
+def _derive_keys(aes_key):
+    return (hashlib.sha256(b"p2p-chat cipher" + aes_key).digest(),
+            hashlib.sha256(b"p2p-chat mac" + aes_key).digest())
+
+
+def _tag(mac_key, sealed):
+    return hmac.digest(mac_key, sealed, "sha256")[:TAG_SIZE]
+
+
+def encrypt_frame(aes_key, frame_type, payload, stamp=None, nonce=None):
+    """Build a length-prefixed encrypted and authenticated frame
+
+    nonce must never repeat under the same key; None picks a random one.
+    """
+    if AES is None:
+        _load_crypto()
+    if nonce is None:
+        nonce = os.urandom(NONCE_SIZE)
+    if stamp is not None:
+        frame_type |= FLAG_PING
+        payload = STAMP.pack(stamp) + payload
+    cipher_key, mac_key = _derive_keys(aes_key)
+    sealed = nonce + AES.new(cipher_key, AES.MODE_CTR, nonce=nonce).encrypt(
+        bytes([frame_type]) + payload)
+    return LENGTH.pack(len(sealed) + TAG_SIZE) + sealed + _tag(mac_key, sealed)
+
+
+def decrypt_frame(aes_key, body, in_place=False):
+    """Check and decrypt a frame body, returning (type, ping stamp or None, payload)
+
+    With in_place=True body must be a writable memoryview (e.g. into a
+    receive buffer) and payload is a memoryview, valid until the buffer
+    is reused; frames of IN_PLACE_MIN bytes or more are decrypted over
+    the ciphertext instead of into a new buffer.
+    """
+    if AES is None:
+        _load_crypto()
+    if len(body) <= NONCE_SIZE + TAG_SIZE:
+        raise ValueError("Frame too short")
+    cipher_key, mac_key = _derive_keys(aes_key)
+    body = memoryview(body)
+    sealed = body[:-TAG_SIZE]
+    if not hmac.compare_digest(_tag(mac_key, sealed), body[-TAG_SIZE:]):
+        raise ValueError("Frame failed authentication")
+    ct = sealed[NONCE_SIZE:]
+    cipher = AES.new(cipher_key, AES.MODE_CTR, nonce=bytes(sealed[:NONCE_SIZE]))
+    if in_place and len(ct) >= IN_PLACE_MIN:
+        cipher.decrypt(ct, output=ct)
+        plain = ct
+    elif in_place:
+        # pycryptodome takes bytes much faster than a view, and slicing
+        # the plaintext as a view doesn't copy the payload again
+        plain = memoryview(cipher.decrypt(bytes(ct)))
+    else:
+        plain = cipher.decrypt(ct)
+    frame_type = plain[0]
+    if frame_type & FLAG_PING:
+        return frame_type & ~FLAG_PING, STAMP.unpack_from(plain, 1)[0], plain[1 + STAMP.size:]
+    return frame_type, None, plain[1:]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def set_crypto_workers(count):
+    """Size of the shared sealing pool; 1 seals on the sending thread"""
+    global CRYPTO_WORKERS, _pool
+    with _pool_lock:
+        CRYPTO_WORKERS = count
+        old, _pool = _pool, None
+    if old:
+        old.shutdown(wait=False)
+
+
+def _crypto_pool():
+    global _pool
+    if CRYPTO_WORKERS <= 1:
+        return None  # A pool thread would only add a hand-off
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _pool = ThreadPoolExecutor(CRYPTO_WORKERS, thread_name_prefix="crypto")
+    return _pool
+
+
+class RttEstimator:
+    """Smoothed round-trip time and jitter (RFC 6298 style EWMA)"""
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.last = None
+
+    def update(self, sample):
+        self.last = sample
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - sample)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * sample
+
+
+class SecureLink:
+    """Encrypted, framed P2P connection with keepalive and RTT measurement
+
+    on_message(payload) is called for each data frame, on_rtt(estimator)
+    after each pong, on_control(type, payload) for any other frame type and
+    on_close(reason) once when the link goes down. Callbacks run on the
+    link's own threads. Payloads are memoryviews into the receive buffer
+    and only valid during the call; copy (bytes(payload)) what you keep.
+
+    With a batch_window, messages shorter than batch_size are held for up
+    to that many seconds, or until they add up to batch_size bytes, and
+    sent together in one frame. The peer gets
+    them one by one as usual; during its on_message call, batch_delay
+    says how long the sender held the message back.
+    """
+
+    def __init__(self, sock, aes_key, on_message, on_close=None, on_rtt=None,
+                 on_control=None, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 dead_timeout=DEAD_TIMEOUT, batch_window=BATCH_WINDOW,
+                 batch_size=BATCH_SIZE):
+        self.sock = sock
+        self.aes_key = aes_key
+        self.on_message = on_message
+        self.on_close = on_close
+        self.on_rtt = on_rtt
+        self.on_control = on_control
+        self.heartbeat_interval = heartbeat_interval
+        self.dead_timeout = dead_timeout
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.batch_delay = 0.0
+
+        self.rtt = RttEstimator()
+        self.closed = False
+        self.last_received = time.monotonic()
+        self._ping_due = False
+        self._send_cond = threading.Condition()
+        self._outbox = deque()  # Frames (bytes or futures) in counter order, not yet written
+        self._writing = False  # A sender is writing its own frame outside _send_cond
+        self._writer = None
+        self._salt = os.urandom(8)
+        self._counter = 0
+        self._peer_salt = None
+        self._peer_counter = -1
+        self._batch = []  # (queued at, data) waiting for the window to end
+        self._batch_bytes = 0
+        self._batch_deadline = 0.0
+        self._close_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._receive_loop, daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def send(self, data):
+        """Send a data frame, piggybacking a ping on it if one is due"""
+        if self.batch_window and len(data) < self.batch_size:
+            self._add_to_batch(data)
+        else:
+            self._send_frame(FRAME_DATA, data, piggyback=True)
+
+    def send_control(self, frame_type, payload):
+        """Queue a control frame; never waits for room, so the receive thread can ack"""
+        self._send_frame(frame_type, payload, wait=False)
+
+    def close(self, reason="Closed"):
+        with self._close_lock:
+            if self.closed:
+                return
+            self.closed = True
+        self._stopped.set()
+        with self._send_cond:
+            self._outbox.clear()
+            self._batch.clear()
+            self._send_cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        if self.on_close:
+            self.on_close(reason)
+
+    def _send_frame(self, frame_type, payload, piggyback=False, wait=True):
+        with self._send_cond:
+            if wait:
+                self._wait_for_room()
+            elif self.closed:
+                raise ConnectionError("Link is closed")
+            # A batch still open goes first so data keeps its order
+            flushed = frame_type != FRAME_DATA or not self._batch or self._flush_batch()
+            stamp = self._take_ping() if piggyback else None
+            # Only senders that may block write their own frame; the
+            # receive thread (wait=False) always leaves it to the writer
+            queued = flushed and self._queue_frame(frame_type, payload, stamp, direct=wait)
+        if queued is True:
+            return
+        if queued:
+            self._write_direct(queued)
+            return
+        self.close("Frame counter exhausted")
+        raise ConnectionError("Link is closed")
+
+    def _write_direct(self, frame):
+        # Nothing was queued ahead of this frame and _writing keeps the
+        # writer thread and other senders off the socket until it is out
+        try:
+            self.sock.sendall(frame)
+        finally:
+            with self._send_cond:
+                self._writing = False
+                self._send_cond.notify_all()
+
+    def _add_to_batch(self, data):
+        with self._send_cond:
+            self._wait_for_room()
+            if not self._batch:
+                self._batch_deadline = time.monotonic() + self.batch_window
+                self._start_writer()  # Sends the batch when the window ends
+                self._send_cond.notify_all()
+            self._batch.append((time.monotonic_ns(), data))
+            self._batch_bytes += BATCH_ENTRY.size + len(data)
+            if self._batch_bytes < self.batch_size or self._flush_batch():
+                return
+        self.close("Frame counter exhausted")
+        raise ConnectionError("Link is closed")
+
+    def _wait_for_room(self):
+        # Called with _send_cond held
+        while len(self._outbox) >= MAX_IN_FLIGHT and not self.closed:
+            self._send_cond.wait()
+        if self.closed:
+            raise ConnectionError("Link is closed")
+
+    def _take_ping(self):
+        if not self._ping_due:
+            return None
+        self._ping_due = False
+        return time.monotonic_ns()
+
+    def _flush_batch(self):
+        # Called with _send_cond held; returns False once the counter is used up
+        now = time.monotonic_ns()
+        parts = []
+        for queued_at, data in self._batch:
+            parts.append(BATCH_ENTRY.pack(len(data), min((now - queued_at) // 1000, 0xFFFFFFFF)))
+            parts.append(data)
+        self._batch = []
+        self._batch_bytes = 0
+        return self._queue_frame(FRAME_BATCH, b"".join(parts), self._take_ping())
+
+    def _queue_frame(self, frame_type, payload, stamp=None, direct=False):
+        # Called with _send_cond held, so counters follow queue order.
+        # Returns False once the counter is used up. With direct, a frame
+        # that nothing is queued or being written ahead of is returned
+        # for the caller to write with _write_direct, after releasing
+        # _send_cond: a sender blocked in sendall must never hold it, as
+        # the receive thread needs it to queue pongs and acks.
+        if self._counter > MAX_COUNTER:
+            return False
+        nonce = NONCE.pack(self._salt, self._counter)
+        self._counter += 1
+        pool = _crypto_pool() if len(payload) >= PARALLEL_MIN else None
+        if pool is None:
+            frame = encrypt_frame(self.aes_key, frame_type, payload, stamp, nonce)
+            if direct and not self._outbox and not self._writing:
+                self._writing = True
+                return frame
+            self._outbox.append(frame)
+        else:
+            self._outbox.append(pool.submit(encrypt_frame, self.aes_key, frame_type,
+                                            payload, stamp, nonce))
+        self._start_writer()
+        self._send_cond.notify_all()
+        return True
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        # Reorder buffer: frames leave in counter order, whichever pool
+        # thread finishes first. A frame stays at the head of the outbox
+        # until it is written, so it still counts against MAX_IN_FLIGHT.
+        try:
+            while True:
+                with self._send_cond:
+                    while (not self._outbox or self._writing) and not self.closed:
+                        if self._writing or not self._batch:
+                            self._send_cond.wait()
+                        elif time.monotonic() < self._batch_deadline:
+                            self._send_cond.wait(self._batch_deadline - time.monotonic())
+                        elif not self._flush_batch():
+                            raise ConnectionError("Frame counter exhausted")
+                    if self.closed:
+                        return
+                    item = self._outbox[0]
+                frame = item if isinstance(item, bytes) else item.result()
+                self.sock.sendall(frame)
+                with self._send_cond:
+                    if self._outbox:
+                        self._outbox.popleft()
+                    self._send_cond.notify_all()
+        except Exception as e:
+            self.close(f"Send error: {str(e)}")
+
+    def _handle_frame(self, body):
+        frame_type, stamp, payload = decrypt_frame(self.aes_key, body, in_place=True)
+        salt, counter = NONCE.unpack_from(body)
+        if self._peer_salt is None:
+            self._peer_salt = salt
+        elif salt != self._peer_salt or counter <= self._peer_counter:
+            raise ValueError("Replayed or out-of-order frame")
+        self._peer_counter = counter
+        if stamp is not None:
+            self._send_frame(FRAME_PONG, STAMP.pack(stamp), wait=False)  # Queued, never blocks
+        if frame_type == FRAME_DATA:
+            self.on_message(payload)
+        elif frame_type == FRAME_BATCH:
+            self._deliver_batch(payload)
+        elif frame_type == FRAME_PONG:
+            sent = STAMP.unpack(payload)[0]
+            self.rtt.update((time.monotonic_ns() - sent) / 1e9)
+            if self.on_rtt:
+                self.on_rtt(self.rtt)
+        elif frame_type != FRAME_PING and self.on_control:
+            self.on_control(frame_type, payload)
+
+    def _deliver_batch(self, payload):
+        offset = 0
+        try:
+            while offset < len(payload):
+                length, held = BATCH_ENTRY.unpack_from(payload, offset)
+                offset += BATCH_ENTRY.size
+                if offset + length > len(payload):
+                    raise ValueError("Truncated batch")
+                self.batch_delay = held / 1e6
+                self.on_message(payload[offset:offset + length])
+                offset += length
+        finally:
+            self.batch_delay = 0.0
+
+    def _receive_loop(self):
+        # One buffer per link, filled with recv_into. Frames are parsed,
+        # checked and decrypted where they landed, so a message is only
+        # copied once, by whoever keeps it. Unparsed bytes are
+        # buffer[start:end].
+        buffer = bytearray(RECV_BUFFER)
+        view = memoryview(buffer)
+        start = end = 0
+        reason = "Peer disconnected"
+        try:
+            while not self.closed:
+                if start and len(buffer) - end < RECV_CHUNK:
+                    view[:end - start] = view[start:end]  # Move the partial frame to the front
+                    end -= start
+                    start = 0
+                if end == len(buffer):
+                    # A frame bigger than the buffer
+                    buffer = bytearray(min(2 * len(buffer), LENGTH.size + MAX_FRAME))
+                    buffer[:end] = view[:end]
+                    view = memoryview(buffer)
+                received = self.sock.recv_into(view[end:])
+                if not received:
+                    break
+                self.last_received = time.monotonic()
+                end += received
+                while end - start >= LENGTH.size:
+                    length = LENGTH.unpack_from(buffer, start)[0]
+                    if length > MAX_FRAME:
+                        raise ValueError("Frame too large")
+                    frame_end = start + LENGTH.size + length
+                    if frame_end > end:
+                        break
+                    self._handle_frame(view[start + LENGTH.size:frame_end])
+                    start = frame_end
+                if start == end:
+                    start = end = 0
+        except Exception as e:
+            if not self.closed:
+                reason = f"Receive error: {str(e)}"
+        self.close(reason)
+
+    def _heartbeat_loop(self):
+        # Each interval a ping becomes due. If data goes out before the next
+        # tick the ping rides on it for free; otherwise a standalone ping is
+        # sent, so only idle links pay for heartbeats.
+        while not self._stopped.wait(self.heartbeat_interval):
+            if time.monotonic() - self.last_received > self.dead_timeout:
+                self.close("Peer timed out")
+                return
+            try:
+                with self._send_cond:
+                    queued = not self._ping_due or self._queue_frame(
+                        FRAME_PING, b"", time.monotonic_ns())
+                    self._ping_due = True
+            except OSError as e:
+                self.close(f"Send error: {str(e)}")
+                return
+            if not queued:
+                self.close("Frame counter exhausted")
+                return
+
+
+class Backoff:
+    """Exponential backoff with equal jitter"""
+
+    def __init__(self, base=0.2, cap=10.0, factor=2.0):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempt = 0
+
+    def next(self):
+        delay = min(self.cap, self.base * self.factor ** self.attempt)
+        self.attempt += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        self.attempt = 0
+
+
+class ReconnectingLink:
+    """Message channel that survives drops of the underlying SecureLink
+
+    connect() must return a freshly connected socket or raise OSError; it is
+    retried with jittered exponential backoff, both for the first connection
+    and after the link drops. Messages are numbered and kept until the peer
+    acknowledges them, so anything sent while the link is down (or lost in
+    flight) is replayed in order after the reconnect. The receiver drops
+    sequence numbers it has already delivered, so replays never duplicate.
+
+    on_state(state, detail) reports every state change and retry.
+    on_message gets memoryviews, valid only during the call (see SecureLink).
+    """
+
+    def __init__(self, connect, aes_key, on_message, on_state=None, on_rtt=None,
+                 backoff=None, max_attempts=None, **link_options):
+        self.connect = connect
+        self.aes_key = aes_key
+        self.on_message = on_message
+        self.on_state = on_state
+        self.on_rtt = on_rtt
+        self.backoff = backoff or Backoff()
+        self.max_attempts = max_attempts
+        self.link_options = link_options
+
+        self.state = STATE_CONNECTING
+        self.link = None
+        self.pending = deque()  # (seq, data) not yet acknowledged by the peer
+        self.next_seq = 1
+        self.last_received = 0
+        self._unacked = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # Keeps sends in seq order; never taken by the receive thread
+
+    @property
+    def queued(self):
+        """Messages sent but not yet acknowledged by the peer"""
+        return len(self.pending)
+
+    def start(self, sock=None):
+        """Attach an already connected socket, or start connecting"""
+        if sock is not None:
+            self._attach(sock)
+        else:
+            threading.Thread(target=self._reconnect_loop, daemon=True).start()
+
+    def send(self, data):
+        """Queue a message and send it right away if the link is up"""
+        with self._send_lock:
+            with self._lock:
+                if self.state == STATE_CLOSED:
+                    raise ConnectionError("Link is closed")
+                seq = self.next_seq
+                self.next_seq += 1
+                self.pending.append((seq, data))
+                link = self.link if self.state == STATE_CONNECTED else None
+            # May block on a full link; _lock is free meanwhile, so the
+            # receive thread keeps reading and acking
+            if link:
+                try:
+                    link.send(SEQ.pack(seq) + data)
+                except OSError:
+                    pass  # Still pending, replayed after the reconnect
+        return seq
+
+    def close(self, reason="Closed"):
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return
+            self.state = STATE_CLOSED
+            link, self.link = self.link, None
+        if link:
+            link.close(reason)
+        self._notify(STATE_CLOSED, reason)
+
+    def _notify(self, state, detail=""):
+        if self.on_state:
+            self.on_state(state, detail)
+
+    def _attach(self, sock):
+        link = SecureLink(sock, self.aes_key, on_message=None,
+                          on_rtt=self.on_rtt, **self.link_options)
+        link.on_message = lambda payload: self._on_data(link, payload)
+        link.on_close = lambda reason: self._on_link_closed(link, reason)
+        link.on_control = lambda frame_type, payload: self._on_control(link, frame_type, payload)
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                sock.close()
+                return
+            self.link = link
+            last_received = self.last_received
+        link.start()
+        try:
+            link.send_control(FRAME_RESUME, SEQ.pack(last_received))
+        except OSError as e:
+            link.close(f"Send error: {str(e)}")
+
+    def _trim(self, acked):
+        while self.pending and self.pending[0][0] <= acked:
+            self.pending.popleft()
+
+    def _on_control(self, link, frame_type, payload):
+        if frame_type == FRAME_ACK:
+            with self._lock:
+                self._trim(SEQ.unpack(payload)[0])
+        elif frame_type == FRAME_RESUME:
+            # The replay can block on a full link, so it runs off the receive thread
+            threading.Thread(target=self._replay, args=(link, SEQ.unpack(payload)[0]),
+                             daemon=True).start()
+
+    def _replay(self, link, acked):
+        # Holding _send_lock keeps new messages behind the replayed ones
+        with self._send_lock:
+            with self._lock:
+                if link is not self.link:
+                    return
+                self._trim(acked)
+                backlog = list(self.pending)
+            try:
+                for seq, data in backlog:
+                    link.send(SEQ.pack(seq) + data)
+            except OSError:
+                return  # Down again; the next resume replays what is left
+            with self._lock:
+                if link is not self.link:
+                    return
+                self.state = STATE_CONNECTED
+                self.backoff.reset()
+        replayed = len(backlog)
+        self._notify(STATE_CONNECTED, f"{replayed} queued message(s) replayed" if replayed else "")
+
+    def _on_data(self, link, payload):
+        seq = SEQ.unpack_from(payload)[0]
+        with self._lock:
+            if seq <= self.last_received:
+                return  # Already delivered before a reconnect
+            self.last_received = seq
+            self._unacked += 1
+            ack = self._unacked >= ACK_EVERY
+            if ack:
+                self._unacked = 0
+        if ack:
+            link.send_control(FRAME_ACK, SEQ.pack(seq))
+        self.on_message(payload[SEQ.size:])
+
+    def _on_link_closed(self, link, reason):
+        with self._lock:
+            if link is not self.link or self.state == STATE_CLOSED:
+                return
+            self.link = None
+            self.state = STATE_RECONNECTING
+        self._notify(STATE_RECONNECTING, reason)
+        threading.Thread(target=self._reconnect_loop, daemon=True).start()
+
+    def _reconnect_loop(self):
+        attempts = 0
+        while self.state != STATE_CLOSED:
+            try:
+                sock = self.connect()
+            except OSError as e:
+                attempts += 1
+                if self.max_attempts and attempts >= self.max_attempts:
+                    self.close(f"Gave up after {attempts} attempts ({str(e)})")
+                    return
+                delay = self.backoff.next()
+                self._notify(self.state, f"Retrying in {delay:.1f}s ({str(e)})")
+                time.sleep(delay)
+                continue
+            self._attach(sock)
+            return
+
+
+def _benchmark(megabytes=256, chunk=16 * 1024):
+    """Sealing throughput of a bulk transfer as the crypto pool grows"""
+    key = os.urandom(32)
+    frames = megabytes * 1024 * 1024 // chunk
+    wire_bytes = frames * (LENGTH.size + NONCE_SIZE + 1 + chunk + TAG_SIZE)
+    payload = bytes(chunk)
+    counts = [1]
+    while counts[-1] < max(4, os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    print(f"[BENCH] {os.cpu_count()} CPU(s), {megabytes} MB in {chunk // 1024} KB frames")
+    for workers in counts:
+        set_crypto_workers(workers)
+        sock_a, sock_b = socket.socketpair()
+        link = SecureLink(sock_a, key, on_message=None)
+        done = threading.Event()
+
+        def drain():
+            remaining = wire_bytes
+            while remaining > 0:
+                data = sock_b.recv(1 << 20)
+                if not data:
+                    break
+                remaining -= len(data)
+            done.set()
+
+        threading.Thread(target=drain, daemon=True).start()
+        start = time.perf_counter()
+        for _ in range(frames):
+            link.send(payload)
+        done.wait()
+        elapsed = time.perf_counter() - start
+        link.close()
+        sock_b.close()
+        print(f"[BENCH] {workers} sealing thread(s): {megabytes / elapsed:.0f} MB/s")
+
+
+def _receive_benchmark(messages=200000, size=100):
+    """Receive path throughput and GC activity under a sustained message stream
+
+    Pre-sealed data frames are written into a ReconnectingLink as fast as
+    it takes them; the consumer copies each message out, like the mux.
+    """
+    import gc
+    key = os.urandom(32)
+    salt = os.urandom(8)
+    body = bytes(size)
+    stream = b"".join(encrypt_frame(key, FRAME_DATA, SEQ.pack(seq) + body,
+                                    nonce=NONCE.pack(salt, seq))
+                      for seq in range(1, messages + 1))
+    sock_a, sock_b = socket.socketpair()
+    received = [0]
+    done = threading.Event()
+    collections = [0, 0, 0]
+
+    def on_message(data):
+        bytes(data)
+        received[0] += 1
+        if received[0] == messages:
+            done.set()
+
+    def on_gc(phase, info):
+        if phase == "start":
+            collections[info["generation"]] += 1
+
+    def no_reconnect():
+        raise OSError("Benchmark link dropped")
+
+    def drain():
+        while sock_a.recv(65536):  # Resume and acks coming back
+            pass
+
+    threading.Thread(target=drain, daemon=True).start()
+    link = ReconnectingLink(no_reconnect, key, on_message=on_message, max_attempts=1)
+    link.start(sock_b)
+    gc.callbacks.append(on_gc)
+    start = time.perf_counter()
+    sock_a.sendall(stream)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    gc.callbacks.remove(on_gc)
+    link.close()
+    sock_a.close()
+    print(f"[BENCH] {messages} messages of {size} B received in {elapsed:.2f}s "
+          f"({messages / elapsed:.0f} msg/s), GC collections per 100k messages: "
+          + "/".join(f"{c * 100000 / messages:.1f}" for c in collections) + " (gen 0/1/2)")
+
+
+def _batch_run(window, messages, size, interval):
+    key = os.urandom(32)
+    filler = bytes(size - STAMP.size)
+    sock_a, sock_b = socket.socketpair()
+    latencies = []
+    frames = [0]
+    done = threading.Event()
+
+    def on_message(data):
+        latencies.append(time.perf_counter_ns() - STAMP.unpack_from(data)[0])
+        if len(latencies) == messages:
+            done.set()
+
+    receiver = SecureLink(sock_b, key, on_message=on_message)
+    handle_frame = receiver._handle_frame
+
+    def count_frames(body):
+        frames[0] += 1
+        handle_frame(body)
+
+    receiver._handle_frame = count_frames
+    receiver.start()
+    sender = SecureLink(sock_a, key, on_message=None, batch_window=window)
+    start = time.perf_counter()
+    for _ in range(messages):
+        sender.send(STAMP.pack(time.perf_counter_ns()) + filler)
+        if interval:
+            time.sleep(interval)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    latencies.sort()
+    return (messages / elapsed, frames[0], latencies[len(latencies) // 2] / 1e6,
+            latencies[len(latencies) * 99 // 100] / 1e6)
+
+
+def _batch_benchmark(messages=20000, size=100, windows=(0.0, 0.001, 0.002, 0.005)):
+    """Throughput and latency of small messages per batch window
+
+    A burst (e.g. a paste) is sent back to back, then a chatty bot sends
+    a message every half millisecond.
+    """
+    for label, count, interval in (("back to back", messages, 0),
+                                   ("every 0.5 ms", messages // 10, 0.0005)):
+        print(f"[BENCH] {count} messages of {size} B sent {label}")
+        for window in windows:
+            rate, frames, p50, p99 = _batch_run(window, count, size, interval)
+            print(f"[BENCH] window {window * 1000:g} ms: {rate:.0f} msg/s in {frames} frames, "
+                  f"latency p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:2] == ["recv"]:
+        _receive_benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
+    elif sys.argv[1:2] == ["batch"]:
+        _batch_benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+    else:
+        _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 256)
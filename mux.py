@@ -0,0 +1,335 @@
+# mux.py
+#
+# Logical channels multiplexed over one P2P link.
+#
+# Every message handed to the link starts with a channel header:
+#   channel (1) | flags (1) | chunk
+# Messages are cut into chunks so a bulk transfer never holds the socket
+# for long; FLAG_MORE means the next chunk on the same channel continues
+# the message. A single sender thread picks the next chunk strictly by
+# priority (control, then interactive, then bulk) and by weighted fair
+# queuing between channels of equal priority. Flow-controlled channels
+# may only have `window` bytes in flight; the receiver hands credit back
+# with WINDOW messages on the control channel as it delivers data, so a
+# bulk sender can't bury chat behind megabytes of queued data.
+
+import queue
+import struct
+import threading
+import time
+from collections import deque
+from link import BACKPRESSURE_BLOCK, BACKPRESSURE_DROP, BACKPRESSURE_NOTIFY
+
+CHANNEL_HEADER = struct.Struct(">BB")
+WINDOW_UPDATE = struct.Struct(">BBI")  # control type, channel, credit in bytes
+FLAG_MORE = 0x01
+
+# Well-known channels
+CHANNEL_CONTROL = 0  # Window updates; never flow-controlled
+CHANNEL_CHAT = 1
+CHANNEL_BULK = 2
+CHANNEL_SYNC = 3  # History resync, see history.py
+CHANNEL_CHAT_ENTRY = 4  # Chat numbered for a history, see history.py
+
+# Priorities, lower is sent first
+PRIORITY_CONTROL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+
+# Control message types
+CONTROL_WINDOW = 1
+
+CHUNK_SIZE = 16 * 1024
+WINDOW = 256 * 1024  # Bytes in flight per channel; both peers must use the same
+
+
+class Channel:
+    """Send and receive state of one logical channel"""
+
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.opened = False
+        self.priority = PRIORITY_BULK
+        self.weight = 1
+        self.window = WINDOW  # None disables flow control
+        self.credit = WINDOW
+        self.maxsize = 256  # Queued messages; 0 means unbounded
+        self.policy = BACKPRESSURE_BLOCK
+        self.block_timeout = None
+        self.on_message = None
+        self.on_sent = None
+        self.queue = deque()  # [queued_at, data, offset]
+        self.vtime = 0.0  # Bytes sent / weight, for fair queuing
+        self.dropped = 0
+        self.parts = []  # Chunks of the message being received
+        self.consumed = 0  # Bytes received since the last window update
+
+    def ready(self):
+        return bool(self.queue) and (self.window is None or self.credit > 0)
+
+
+class Mux:
+    """Priority scheduler and demultiplexer in front of a link
+
+    send is the link's send function (e.g. ReconnectingLink.send) and is
+    only ever called from the mux's sender thread; every message the link
+    receives goes to receive(). on_message(channel_id, data) gets messages
+    for channels without a handler of their own, and on_error(exception)
+    reports a failed send, after which the mux stops.
+    """
+
+    def __init__(self, send, on_message=None, on_error=None, chunk_size=CHUNK_SIZE):
+        self.send = send
+        self.on_message = on_message
+        self.on_error = on_error
+        self.chunk_size = chunk_size
+        self.channels = {}
+        self.closed = False
+        self._cond = threading.Condition()
+        self.open_channel(CHANNEL_CONTROL, PRIORITY_CONTROL, window=None, maxsize=0)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def open_channel(self, channel_id, priority=PRIORITY_BULK, weight=1, window=WINDOW,
+                     maxsize=256, policy=BACKPRESSURE_BLOCK, block_timeout=None,
+                     on_message=None, on_sent=None):
+        """Configure a channel before sending on it
+
+        on_message(data) receives its messages and on_sent(latency, depth)
+        reports each message once its last chunk is handed to the link.
+        When the queue holds maxsize messages, submit() blocks (for up to
+        block_timeout seconds, None waits for good), drops or raises
+        queue.Full, depending on the policy.
+        """
+        with self._cond:
+            channel = self._channel(channel_id)
+            if channel.opened:
+                raise ValueError(f"Channel {channel_id} is already open")
+            channel.opened = True
+            channel.priority = priority
+            channel.weight = weight
+            channel.window = channel.credit = window
+            channel.maxsize = maxsize
+            channel.policy = policy
+            channel.block_timeout = block_timeout
+            channel.on_message = on_message
+            channel.on_sent = on_sent
+
+    def queued(self, channel_id):
+        """Messages waiting on a channel"""
+        channel = self.channels.get(channel_id)
+        return len(channel.queue) if channel else 0
+
+    def submit(self, channel_id, data):
+        """Queue a message on an open channel; returns False if it was dropped"""
+        with self._cond:
+            channel = self.channels.get(channel_id)
+            if channel is None or not channel.opened:
+                raise ValueError(f"Channel {channel_id} is not open")
+            if channel.maxsize and len(channel.queue) >= channel.maxsize:
+                if channel.policy == BACKPRESSURE_DROP:
+                    channel.dropped += 1
+                    return False
+                if channel.policy == BACKPRESSURE_NOTIFY or not self._cond.wait_for(
+                        lambda: self.closed or len(channel.queue) < channel.maxsize,
+                        channel.block_timeout):
+                    raise queue.Full
+            self._enqueue(channel, data)
+        return True
+
+    def receive(self, payload):
+        """Handle one message received from the link
+
+        payload may be a memoryview into the link's receive buffer; what
+        is kept or handed on is copied out first.
+        """
+        channel_id, flags = CHANNEL_HEADER.unpack_from(payload)
+        chunk = payload[CHANNEL_HEADER.size:]
+        if channel_id == CHANNEL_CONTROL:
+            self._handle_control(chunk)
+            return
+
+        message = None
+        credit = 0
+        with self._cond:
+            channel = self._channel(channel_id)
+            if flags & FLAG_MORE:
+                channel.parts.append(bytes(chunk))
+            elif channel.parts:
+                parts, channel.parts = channel.parts, []
+                parts.append(chunk)
+                message = b"".join(parts)
+            else:
+                message = bytes(chunk)
+            if channel.window is not None:
+                channel.consumed += len(chunk)
+                if channel.consumed >= channel.window // 2:
+                    credit, channel.consumed = channel.consumed, 0
+            if credit and not self.closed:
+                self._enqueue(self.channels[CHANNEL_CONTROL],
+                              WINDOW_UPDATE.pack(CONTROL_WINDOW, channel_id, credit))
+
+        if message is not None:
+            if channel.on_message:
+                channel.on_message(message)
+            elif self.on_message:
+                self.on_message(channel_id, message)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            for channel in self.channels.values():
+                channel.queue.clear()
+            self._cond.notify_all()
+
+    def _channel(self, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = Channel(channel_id)
+        return channel
+
+    def _enqueue(self, channel, data):
+        if self.closed:
+            raise ConnectionError("Mux is closed")
+        if not channel.queue:
+            # A channel coming back from idle starts level with the busy
+            # ones instead of claiming the bandwidth it didn't use.
+            busy = [c.vtime for c in self.channels.values()
+                    if c.queue and c.priority == channel.priority]
+            if busy:
+                channel.vtime = max(channel.vtime, min(busy))
+        channel.queue.append([time.perf_counter(), memoryview(data), 0])
+        self._cond.notify_all()
+
+    def _handle_control(self, data):
+        if data[0] == CONTROL_WINDOW:
+            _, channel_id, credit = WINDOW_UPDATE.unpack(data)
+            with self._cond:
+                self._channel(channel_id).credit += credit
+                self._cond.notify_all()
+
+    def _next_channel(self):
+        best = None
+        for channel in self.channels.values():
+            if channel.ready() and (best is None or
+                                    (channel.priority, channel.vtime) < (best.priority, best.vtime)):
+                best = channel
+        return best
+
+    def _run(self):
+        while True:
+            with self._cond:
+                channel = self._next_channel()
+                while channel is None and not self.closed:
+                    self._cond.wait()
+                    channel = self._next_channel()
+                if self.closed:
+                    return
+                entry = channel.queue[0]
+                queued_at, data, offset = entry
+                size = min(self.chunk_size, len(data) - offset)
+                if channel.window is not None:
+                    size = min(size, channel.credit)
+                    channel.credit -= size
+                chunk = data[offset:offset + size]
+                entry[2] = offset = offset + size
+                more = offset < len(data)
+                if not more:
+                    channel.queue.popleft()
+                    self._cond.notify_all()  # Room for blocked submitters
+                channel.vtime += max(size, 1) / channel.weight
+                depth = len(channel.queue)
+
+            try:
+                self.send(CHANNEL_HEADER.pack(channel.id, FLAG_MORE if more else 0) + chunk)
+            except Exception as e:
+                self.close()
+                if self.on_error:
+                    self.on_error(e)
+                return
+            if not more and channel.on_sent:
+                channel.on_sent(time.perf_counter() - queued_at, depth)
+
+
+def _endpoint(sock, aes_key):
+    from link import ReconnectingLink
+
+    def no_reconnect():
+        raise OSError("Benchmark link dropped")
+
+    mux = None
+    link = ReconnectingLink(no_reconnect, aes_key, on_message=lambda data: mux.receive(data),
+                            max_attempts=1)
+    mux = Mux(link.send)
+    link.start(sock)
+    return link, mux
+
+
+def _measure(megabytes, fifo, interval=0.01, message_size=1024 * 1024):
+    """Chat round trips while `megabytes` of bulk data flow the same way
+
+    With fifo=True the pings are queued behind the bulk data on its own
+    channel, which is what the single-stream link used to do.
+    """
+    import os
+    import socket
+    PING = struct.Struct(">d")
+    total = megabytes * 1024 * 1024
+    rtts = []
+    pong = threading.Event()
+    done = threading.Event()
+    received = [0]
+
+    key = os.urandom(32)
+    sock_a, sock_b = socket.socketpair()
+    link_a, mux_a = _endpoint(sock_a, key)
+    link_b, mux_b = _endpoint(sock_b, key)
+
+    def on_pong(data):
+        rtts.append(time.perf_counter() - PING.unpack(data)[0])
+        pong.set()
+
+    def on_bulk(data):
+        if len(data) == PING.size:
+            mux_b.submit(CHANNEL_CHAT, data)  # FIFO ping, answer on chat
+            return
+        received[0] += len(data)
+        if received[0] >= total:
+            done.set()
+
+    mux_a.open_channel(CHANNEL_CHAT, PRIORITY_INTERACTIVE, on_message=on_pong)
+    mux_b.open_channel(CHANNEL_CHAT, PRIORITY_INTERACTIVE,
+                       on_message=lambda data: mux_b.submit(CHANNEL_CHAT, data))
+    mux_a.open_channel(CHANNEL_BULK, PRIORITY_BULK, maxsize=16)
+    mux_b.open_channel(CHANNEL_BULK, PRIORITY_BULK, on_message=on_bulk)
+
+    def produce():
+        blob = bytes(message_size)
+        for _ in range(total // message_size):
+            mux_a.submit(CHANNEL_BULK, blob)
+
+    start = time.perf_counter()
+    threading.Thread(target=produce, daemon=True).start()
+    while not done.is_set():
+        pong.clear()
+        mux_a.submit(CHANNEL_BULK if fifo else CHANNEL_CHAT, PING.pack(time.perf_counter()))
+        pong.wait(60)
+        time.sleep(interval)
+    elapsed = time.perf_counter() - start
+    link_a.close()
+    link_b.close()
+    return sorted(rtts), megabytes / elapsed
+
+
+def _benchmark(megabytes=1024):
+    print(f"[BENCH] Chat round trips during a {megabytes} MB bulk transfer")
+    for label, fifo in (("single stream (FIFO)", True), ("multiplexed", False)):
+        rtts, throughput = _measure(megabytes, fifo)
+        p50 = rtts[len(rtts) // 2] * 1000
+        p99 = rtts[min(len(rtts) - 1, len(rtts) * 99 // 100)] * 1000
+        print(f"[BENCH] {label}: {len(rtts)} pings, p50 {p50:.1f} ms, p99 {p99:.1f} ms, "
+              f"max {rtts[-1] * 1000:.1f} ms, bulk {throughput:.0f} MB/s")
+
+
+if __name__ == "__main__":
+    import sys
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1024)
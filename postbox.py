@@ -0,0 +1,311 @@
+# postbox.py
+#
+# Store-and-forward mail for peers that are offline.
+#
+# A mediator started with a postbox directory (P2P_POSTBOX) keeps blobs
+# that one client deposits for another, and streams them to the
+# recipient when it next joins the room. Blobs are sealed end to end
+# with a key the two peers derived in an earlier session, so the
+# mediator only ever sees ciphertext and an opaque mailbox address.
+#
+# On disk every mailbox is a directory of append-only segment files:
+#   <postbox>/<address hex>/<number>.seg
+#   [deposited at (8, Unix time) | length (4) | blob] ...
+# Memory holds a size and a few segment numbers per mailbox, however
+# much mail is waiting. A segment is read, sent and deleted as a whole,
+# and expires as a whole once its newest blob is older than the TTL.
+# Every mailbox has a lock of its own for its segment files, so a slow
+# write to one mailbox doesn't hold up deposits to the others.
+
+import hashlib
+import os
+import struct
+import threading
+import time
+
+SEGMENT_SIZE = 1024 * 1024  # Bytes per segment before the next one is started
+QUOTA = 4 * 1024 * 1024  # Bytes of mail one mailbox may hold
+CAPACITY = 1024 * 1024 * 1024  # Bytes of mail the whole postbox may hold
+TTL = 7 * 24 * 3600.0  # Seconds undelivered mail is kept
+EXPIRE_INTERVAL = 60.0  # Seconds between sweeps for expired segments
+MAX_BLOB = 60 * 1024  # Leaves room for the other fields of a protocol frame
+ADDRESS_SIZE = 16
+RECORD = struct.Struct(">dI")  # deposited at, length
+
+
+class MailboxFull(Exception):
+    """A deposit was refused; the message is the reason sent to the client"""
+
+
+class Mailbox:
+    """Bookkeeping of one recipient's segments"""
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.segments = []  # Segment numbers waiting, oldest first
+        self.next = 0  # Number of the next segment to start
+        self.open = False  # Whether segments[-1] still takes deposits
+        self.tail = 0  # Bytes in segments[-1] while it is open
+        self.busy = 0  # Deposits, deliveries and sweeps using it; kept while any run
+        self.lock = threading.Lock()  # Held for the fields above and the segment files
+
+
+class Postbox:
+    """Bounded on-disk mail store with per-mailbox quotas and a TTL"""
+
+    def __init__(self, path, quota=QUOTA, capacity=CAPACITY, ttl=TTL,
+                 segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.quota = quota
+        self.capacity = capacity
+        self.ttl = ttl
+        self.segment_size = segment_size
+        self.mailboxes = {}  # address: Mailbox
+        self.size = 0
+        self._lock = threading.Lock()  # For mailboxes, size and busy; no file I/O under it
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def deposit(self, address, blob):
+        """Append a blob to a mailbox, or raise MailboxFull"""
+        if len(address) != ADDRESS_SIZE:
+            raise MailboxFull("Bad mailbox address")
+        if len(blob) > MAX_BLOB:
+            raise MailboxFull("Blob too large")
+        record = RECORD.pack(time.time(), len(blob)) + blob
+        with self._lock:
+            if self.size + len(record) > self.capacity:
+                raise MailboxFull("Postbox full")
+            self.size += len(record)  # Given back below if the deposit fails
+            box = self.mailboxes.get(address)
+            if box is None:
+                box = self.mailboxes[address] = Mailbox(os.path.join(self.path, address.hex()))
+            box.busy += 1
+        stored = False
+        try:
+            with box.lock:
+                if box.size + len(record) > self.quota:
+                    raise MailboxFull("Mailbox full")
+                if not box.open or box.tail + len(record) > self.segment_size:
+                    os.makedirs(box.path, exist_ok=True)
+                    box.segments.append(box.next)
+                    box.next += 1
+                    box.open = True
+                    box.tail = 0
+                with open(self._segment(box, box.segments[-1]), "ab") as f:
+                    f.write(record)
+                box.tail += len(record)
+                box.size += len(record)
+                stored = True
+        finally:
+            with self._lock:
+                if not stored:
+                    self.size -= len(record)
+                box.busy -= 1
+                self._forget_if_empty(address, box)
+
+    def deliver(self, address, send):
+        """Hand a mailbox's blobs to send(blobs), one segment per call
+
+        Each segment is deleted once send returns, so mail is only lost
+        when the connection dies in the middle of it. If send raises,
+        the remaining segments stay for the next join. Returns the
+        number of blobs delivered.
+        """
+        with self._lock:
+            box = self.mailboxes.get(address)
+            if box is None:
+                return 0
+            box.busy += 1
+        segments = []
+        delivered = 0
+        cutoff = time.time() - self.ttl
+        try:
+            with box.lock:
+                segments, box.segments = box.segments, []
+                box.open = False  # Deposits from now on start a new segment
+            while segments:
+                path = self._segment(box, segments[0])
+                with open(path, "rb") as f:
+                    data = f.read()
+                blobs = [blob for deposited, blob in _records(data) if deposited >= cutoff]
+                if blobs:
+                    send(blobs)
+                os.remove(path)
+                segments.pop(0)
+                delivered += len(blobs)
+                with box.lock:
+                    box.size -= len(data)
+                with self._lock:
+                    self.size -= len(data)
+        finally:
+            with box.lock:
+                box.segments[:0] = segments  # Undelivered, still ahead of newer mail
+            with self._lock:
+                box.busy -= 1
+                self._forget_if_empty(address, box)
+        return delivered
+
+    def expire(self):
+        """Delete segments whose newest blob outlived the TTL; returns bytes freed"""
+        cutoff = time.time() - self.ttl
+        freed = 0
+        with self._lock:
+            boxes = list(self.mailboxes.items())
+            for address, box in boxes:
+                box.busy += 1
+        for address, box in boxes:
+            expired = 0
+            try:
+                with box.lock:
+                    while box.segments:
+                        path = self._segment(box, box.segments[0])
+                        stat = os.stat(path)
+                        if stat.st_mtime >= cutoff:
+                            break  # Later segments are newer still
+                        os.remove(path)
+                        box.segments.pop(0)
+                        box.size -= stat.st_size
+                        expired += stat.st_size
+                    if not box.segments:
+                        box.open = False
+            finally:
+                with self._lock:
+                    self.size -= expired
+                    box.busy -= 1
+                    self._forget_if_empty(address, box)
+            freed += expired
+        return freed
+
+    def _segment(self, box, number):
+        return os.path.join(box.path, f"{number:08d}.seg")
+
+    def _forget_if_empty(self, address, box):
+        # Called with the postbox lock held; nothing holds box.lock while busy is 0
+        if not box.segments and not box.busy and self.mailboxes.get(address) is box:
+            del self.mailboxes[address]
+            try:
+                os.rmdir(box.path)
+            except OSError:
+                pass  # Holds something else; leave it
+
+    def _load(self):
+        for name in os.listdir(self.path):
+            try:
+                address = bytes.fromhex(name)
+            except ValueError:
+                continue
+            box = Mailbox(os.path.join(self.path, name))
+            if not os.path.isdir(box.path):
+                print(f"[POSTBOX] Skipping {box.path}: not a mailbox directory")
+                continue
+            numbers = sorted(int(f[:-4]) for f in os.listdir(box.path) if f.endswith(".seg"))
+            if not numbers:
+                continue
+            box.segments = numbers
+            box.next = numbers[-1] + 1
+            box.size = sum(os.path.getsize(self._segment(box, n)) for n in numbers)
+            self.mailboxes[address] = box
+            self.size += box.size
+
+
+def _records(data):
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        deposited, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break  # Torn by a crash while writing
+        yield deposited, data[offset:offset + length]
+        offset += length
+
+
+# === Client side ===
+
+def mail_key(aes_key):
+    """Long-lived mail key two peers derive while connected and keep"""
+    return hashlib.sha256(b"p2p-chat mail" + aes_key).digest()
+
+
+def mailbox_address(key, name):
+    """Address of name's mailbox among the peers sharing key"""
+    return hashlib.sha256(b"p2p-chat mailbox" + key + name.encode()).digest()[:ADDRESS_SIZE]
+
+
+def seal(key, data):
+    """Encrypt and authenticate a message for a mailbox"""
+    from link import LENGTH, FRAME_DATA, encrypt_frame
+    return encrypt_frame(key, FRAME_DATA, data)[LENGTH.size:]
+
+
+def unseal(key, blob):
+    """Open a blob from seal(); raises ValueError if it was tampered with"""
+    from link import decrypt_frame
+    return decrypt_frame(key, blob)[2]
+
+
+def deposit_mail(server_host, room, address, blobs, server_port=6000, timeout=5.0):
+    """Leave blobs for an offline peer at the mediator that owns the room
+
+    server_host may list a cluster like P2PSession's. Returns once every
+    blob is stored; a refused deposit (e.g. a full mailbox) raises
+    protocol.ProtocolError, and the blobs before it stay stored.
+    """
+    import protocol
+    from cluster import HashRing, parse_nodes
+    from tls import connect_mediator, keep_session
+    if any(len(blob) > MAX_BLOB for blob in blobs):
+        raise ValueError(f"Blobs are limited to {MAX_BLOB} bytes")
+    candidates = HashRing(parse_nodes(server_host, server_port)).owners(room)
+    error = None
+    while candidates:
+        node = candidates.pop(0)
+        try:
+            sock = connect_mediator(node, timeout=timeout)
+        except OSError as e:
+            error = e
+            continue
+        with sock:
+            try:
+                for blob in blobs:
+                    sock.sendall(protocol.encode_deposit(room, address, blob))
+                    protocol.read_stored(sock)
+                keep_session(node, sock)
+                return
+            except protocol.RedirectError as e:
+                candidates.insert(0, e.node)
+    raise error or ConnectionError("No mediator reachable")
+
+
+def _benchmark(mailboxes=1000, blobs=50000, size=1024):
+    """Deposit and delivery rate, and memory held, for a large backlog"""
+    import resource
+    import shutil
+    import tempfile
+    path = tempfile.mkdtemp(prefix="postbox-")
+    try:
+        postbox = Postbox(path, capacity=blobs * (size + RECORD.size))
+        addresses = [os.urandom(ADDRESS_SIZE) for _ in range(mailboxes)]
+        blob = os.urandom(size)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        for i in range(blobs):
+            postbox.deposit(addresses[i % mailboxes], blob)
+        deposited = time.perf_counter() - start
+        grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        print(f"[BENCH] {blobs} blobs of {size} B in {mailboxes} mailboxes: "
+              f"{blobs / deposited:.0f} deposits/s, {postbox.size / 2 ** 20:.0f} MB on disk, "
+              f"peak RSS grew {grown / 1024:.1f} MB")
+
+        start = time.perf_counter()
+        delivered = sum(postbox.deliver(address, lambda blobs: None) for address in addresses)
+        elapsed = time.perf_counter() - start
+        print(f"[BENCH] Delivered {delivered} blobs: {delivered / elapsed:.0f} blobs/s, "
+              f"{mailboxes / elapsed:.0f} mailboxes/s, {postbox.size} B left")
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    _benchmark()
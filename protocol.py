@@ -0,0 +1,504 @@
+# protocol.py
+#
+# Binary mediator protocol.
+#
+# Every message is a frame:
+#   magic (2) | version (1) | type (1) | length (4, big-endian) | fields
+# and the fields are tag (1) | length (2, big-endian) | value.
+# Public keys travel as raw big-endian bytes and IPs as packed addresses,
+# so a frame can be parsed without ever splitting on ':'.
+
+import socket
+import struct
+import time
+
+MAGIC = b"P2"
+VERSION = 1
+
+HEADER = struct.Struct(">2sBBI")
+FIELD_HEADER = struct.Struct(">BH")
+MAX_FRAME = 64 * 1024
+
+# Message types
+MSG_JOIN = 1
+MSG_PEER = 2
+MSG_ERROR = 3
+MSG_REDIRECT = 4  # Join went to the wrong cluster node; retry at FIELD_NODE
+MSG_DEPOSIT = 5  # Leave a blob in a mailbox for an offline peer (see postbox.py)
+MSG_STORED = 6  # The deposit was stored
+MSG_MAIL = 7  # A mailbox blob, streamed to a joining client before its peer info
+MSG_REGISTER = 8  # Go online on a long-lived control connection (see presence.py)
+MSG_REGISTERED = 9
+MSG_SUBSCRIBE = 10  # Follow more contacts' presence
+MSG_PRESENCE = 11  # A contact came online or went offline
+MSG_DIAL = 12  # Ask to be put in touch with an online user, by name or key
+MSG_INVITE = 13  # Room the mediator set up for a dial, pushed to both sides
+MSG_ENQUEUE = 14  # Wait in a matchmaking queue for any peer (see matchmaking.py)
+
+# Field tags
+FIELD_ROOM = 1
+FIELD_PUBKEY = 2
+FIELD_NAME = 3
+FIELD_IP = 4
+FIELD_REASON = 5
+FIELD_PORT = 6  # Optional P2P listening port; peers assume 7000 without it
+FIELD_NODE = 7  # "host:port" of a mediator
+FIELD_MAILBOX = 8  # Mailbox address; on a join, the joiner's own to drain
+FIELD_BLOB = 9
+FIELD_KEY = 10  # Opaque key a user is online under, e.g. a mailbox address
+FIELD_CONTACTS = 11  # Names, one per line
+FIELD_STATUS = 12  # 1 online, 0 offline
+FIELD_TARGET = 13  # Name of the user to dial
+FIELD_ROLE = 14  # Side taken in a matchmaking queue, e.g. "agent"
+FIELD_PRIORITY = 15  # One byte, higher is served first; 0 without it
+
+PORT = struct.Struct(">H")
+
+
+class ProtocolError(Exception):
+    def __init__(self, message, legacy=False):
+        super().__init__(message)
+        self.legacy = legacy  # Whether the offending client spoke the text format
+
+
+class RedirectError(ProtocolError):
+    def __init__(self, node):
+        super().__init__(f"Redirected to mediator {node}")
+        self.node = node
+
+
+def int_to_bytes(n):
+    return n.to_bytes(max(1, (n.bit_length() + 7) // 8), byteorder='big')
+
+
+def bytes_to_int(b):
+    return int.from_bytes(b, byteorder='big')
+
+
+def ip_to_bytes(ip):
+    if ":" in ip:
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return socket.inet_aton(ip)
+
+
+def bytes_to_ip(b):
+    if len(b) == 16:
+        return socket.inet_ntop(socket.AF_INET6, b)
+    return socket.inet_ntoa(b)
+
+
+def encode_frame(msg_type, fields):
+    """Encode a frame from a list of (tag, bytes) fields"""
+    body = b"".join(FIELD_HEADER.pack(tag, len(value)) + value for tag, value in fields)
+    if len(body) > MAX_FRAME:
+        raise ProtocolError("Frame too large")
+    return HEADER.pack(MAGIC, VERSION, msg_type, len(body)) + body
+
+
+def decode_fields(body):
+    """Decode a frame body into a {tag: bytes} dict"""
+    fields = {}
+    offset = 0
+    end = len(body)
+    unpack_from = FIELD_HEADER.unpack_from
+    while offset < end:
+        if offset + FIELD_HEADER.size > end:
+            raise ProtocolError("Truncated field header")
+        tag, length = unpack_from(body, offset)
+        offset += FIELD_HEADER.size
+        if offset + length > end:
+            raise ProtocolError("Truncated field value")
+        fields[tag] = body[offset:offset + length]
+        offset += length
+    return fields
+
+
+def encode_join(room, pubkey, name, port=None, ip=None, mailbox=None):
+    fields = [
+        (FIELD_ROOM, room.encode()),
+        (FIELD_PUBKEY, int_to_bytes(pubkey)),
+        (FIELD_NAME, name.encode()),
+    ]
+    if port is not None:
+        fields.append((FIELD_PORT, PORT.pack(port)))
+    if ip is not None:
+        # Only set by a mediator forwarding someone else's join
+        fields.append((FIELD_IP, ip_to_bytes(ip)))
+    if mailbox is not None:
+        fields.append((FIELD_MAILBOX, mailbox))
+    return encode_frame(MSG_JOIN, fields)
+
+
+def encode_enqueue(queue, role, pubkey, name, port=None, priority=0):
+    fields = [
+        (FIELD_ROOM, queue.encode()),
+        (FIELD_ROLE, role.encode()),
+        (FIELD_PUBKEY, int_to_bytes(pubkey)),
+        (FIELD_NAME, name.encode()),
+    ]
+    if port is not None:
+        fields.append((FIELD_PORT, PORT.pack(port)))
+    if priority:
+        fields.append((FIELD_PRIORITY, bytes([priority])))
+    return encode_frame(MSG_ENQUEUE, fields)
+
+
+def encode_deposit(room, mailbox, blob):
+    # The room only decides which cluster node keeps the mail
+    return encode_frame(MSG_DEPOSIT, [(FIELD_ROOM, room.encode()), (FIELD_MAILBOX, mailbox),
+                                      (FIELD_BLOB, blob)])
+
+
+def encode_stored():
+    return encode_frame(MSG_STORED, [])
+
+
+def encode_mail(blob):
+    return encode_frame(MSG_MAIL, [(FIELD_BLOB, blob)])
+
+
+def encode_names(names):
+    return "\n".join(names).encode()
+
+
+def decode_names(value):
+    return [name for name in value.decode().split("\n") if name]
+
+
+def encode_register(name, key=None, contacts=()):
+    fields = [(FIELD_NAME, name.encode())]
+    if key is not None:
+        fields.append((FIELD_KEY, key))
+    if contacts:
+        fields.append((FIELD_CONTACTS, encode_names(contacts)))
+    return encode_frame(MSG_REGISTER, fields)
+
+
+def encode_registered():
+    return encode_frame(MSG_REGISTERED, [])
+
+
+def encode_subscribe(names):
+    return encode_frame(MSG_SUBSCRIBE, [(FIELD_CONTACTS, encode_names(names))])
+
+
+def encode_presence(name, online):
+    return encode_frame(MSG_PRESENCE, [(FIELD_NAME, name.encode()),
+                                       (FIELD_STATUS, b"\x01" if online else b"\x00")])
+
+
+def encode_dial(name, target=None, key=None):
+    fields = [(FIELD_NAME, name.encode())]
+    if target is not None:
+        fields.append((FIELD_TARGET, target.encode()))
+    if key is not None:
+        fields.append((FIELD_KEY, key))
+    return encode_frame(MSG_DIAL, fields)
+
+
+def encode_invite(room, name):
+    return encode_frame(MSG_INVITE, [(FIELD_ROOM, room.encode()), (FIELD_NAME, name.encode())])
+
+
+def encode_peer(pubkey, ip, name, port=None):
+    fields = [
+        (FIELD_PUBKEY, int_to_bytes(pubkey)),
+        (FIELD_IP, ip_to_bytes(ip)),
+        (FIELD_NAME, name.encode()),
+    ]
+    if port is not None:
+        fields.append((FIELD_PORT, PORT.pack(port)))
+    return encode_frame(MSG_PEER, fields)
+
+
+def _port(fields):
+    value = fields.get(FIELD_PORT)
+    return PORT.unpack(value)[0] if value else None
+
+
+def encode_error(reason):
+    return encode_frame(MSG_ERROR, [(FIELD_REASON, reason.encode())])
+
+
+def encode_redirect(node):
+    return encode_frame(MSG_REDIRECT, [(FIELD_NODE, node.encode())])
+
+
+class FrameReader:
+    """Incremental frame parser that tolerates partial reads"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return every complete (type, fields) frame"""
+        if self.buffer:
+            self.buffer += data
+            data = bytes(self.buffer)
+        frames = []
+        offset = 0
+        while len(data) - offset >= HEADER.size:
+            magic, version, msg_type, length = HEADER.unpack_from(data, offset)
+            if magic != MAGIC:
+                raise ProtocolError("Bad magic")
+            if version != VERSION:
+                raise ProtocolError(f"Unsupported protocol version {version}")
+            if length > MAX_FRAME:
+                raise ProtocolError("Frame too large")
+            start = offset + HEADER.size
+            if len(data) < start + length:
+                break
+            frames.append((msg_type, decode_fields(data[start:start + length])))
+            offset = start + length
+        self.buffer = bytearray(data[offset:])
+        return frames
+
+
+def recv_frame(sock, reader, first=b"", deadline=None):
+    """Block until one complete frame has been read from sock
+
+    deadline (a time.monotonic() value) bounds the whole frame, so a
+    client trickling bytes can't stretch it; socket.timeout is raised.
+    """
+    frames = reader.feed(first) if first else []
+    while not frames:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("Timed out reading frame")
+            sock.settimeout(remaining)
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("Connection closed by peer")
+        frames = reader.feed(data)
+    if len(frames) > 1:
+        raise ProtocolError("Unexpected extra frames")
+    return frames[0]
+
+
+def is_binary(data):
+    # Text joins start with a printable room id, binary ones with MAGIC and
+    # a (non-printable) version byte.
+    if data[:len(MAGIC)] != MAGIC[:len(data)]:
+        return False
+    return len(data) <= len(MAGIC) or data[len(MAGIC)] < 0x20
+
+
+def read_join(sock, timeout=None):
+    """Read a join request, returning (room_id, pubkey, name, port, ip, legacy, mailbox)
+
+    ip is the original client's address on joins forwarded by another
+    mediator and None otherwise, mailbox the address of the joiner's
+    mailbox if it asked for its mail. With a timeout the whole join must
+    arrive within that many seconds, or socket.timeout is raised; the
+    socket is left blocking either way.
+
+    Clients that still speak the colon-separated text format are detected
+    from the first bytes and parsed the old way so they keep working
+    during the rollout.
+    """
+    msg_type, request = read_request(sock, timeout)
+    if msg_type != MSG_JOIN:
+        raise ProtocolError(f"Expected join, got message type {msg_type}")
+    return request
+
+
+def read_request(sock, timeout=None):
+    """Read what a client came for, returning (message type, request)
+
+    A join's request is what read_join returns, a deposit's is
+    (room_id, mailbox, blob), a registration's (name, key, contacts), a
+    dial's (name, target, key) and a queue join's (queue, role, priority,
+    pubkey, name, port). The timeout works as for read_join.
+    """
+    if timeout is None:
+        return _read_request(sock, None)
+    sock.settimeout(timeout)
+    try:
+        return _read_request(sock, time.monotonic() + timeout)
+    finally:
+        sock.settimeout(None)
+
+
+def _read_request(sock, deadline):
+    first = sock.recv(4096)
+    if not first:
+        raise ConnectionError("Connection closed by peer")
+
+    if not is_binary(first):
+        try:
+            parts = first.decode().strip().split(":")
+        except UnicodeDecodeError:
+            raise ProtocolError(f"Invalid legacy join: {first!r}", legacy=True)
+        if len(parts) != 3:
+            raise ProtocolError(f"Invalid legacy join: {first!r}", legacy=True)
+        room_id, pubkey_str, name = parts
+        try:
+            pubkey = int(pubkey_str)
+        except ValueError:
+            raise ProtocolError(f"Invalid legacy pubkey: {pubkey_str}", legacy=True)
+        return MSG_JOIN, (room_id, pubkey, name, None, None, True, None)
+
+    msg_type, fields = recv_frame(sock, FrameReader(), first, deadline)
+    if msg_type == MSG_DEPOSIT:
+        try:
+            return msg_type, (fields[FIELD_ROOM].decode(), fields[FIELD_MAILBOX], fields[FIELD_BLOB])
+        except KeyError as e:
+            raise ProtocolError(f"Deposit is missing field {e}")
+    if msg_type == MSG_ENQUEUE:
+        try:
+            priority = fields.get(FIELD_PRIORITY, b"\x00")
+            return msg_type, (fields[FIELD_ROOM].decode(), fields[FIELD_ROLE].decode(),
+                              priority[0] if priority else 0, bytes_to_int(fields[FIELD_PUBKEY]),
+                              fields[FIELD_NAME].decode(), _port(fields))
+        except KeyError as e:
+            raise ProtocolError(f"Queue join is missing field {e}")
+    if msg_type == MSG_REGISTER:
+        try:
+            return msg_type, (fields[FIELD_NAME].decode(), fields.get(FIELD_KEY),
+                              decode_names(fields.get(FIELD_CONTACTS, b"")))
+        except KeyError as e:
+            raise ProtocolError(f"Registration is missing field {e}")
+    if msg_type == MSG_DIAL:
+        target = fields.get(FIELD_TARGET)
+        if target is None and FIELD_KEY not in fields:
+            raise ProtocolError("Dial names no user")
+        try:
+            return msg_type, (fields[FIELD_NAME].decode(),
+                              target.decode() if target is not None else None,
+                              fields.get(FIELD_KEY))
+        except KeyError as e:
+            raise ProtocolError(f"Dial is missing field {e}")
+    if msg_type != MSG_JOIN:
+        raise ProtocolError(f"Expected join, got message type {msg_type}")
+    try:
+        ip = bytes_to_ip(fields[FIELD_IP]) if FIELD_IP in fields else None
+        return msg_type, (fields[FIELD_ROOM].decode(), bytes_to_int(fields[FIELD_PUBKEY]),
+                          fields[FIELD_NAME].decode(), _port(fields), ip, False,
+                          fields.get(FIELD_MAILBOX))
+    except KeyError as e:
+        raise ProtocolError(f"Join is missing field {e}")
+
+
+def peer_closed(sock):
+    """Whether the other end of an idle socket has hung up
+
+    Peeks without blocking: EOF or a reset means closed, no data means
+    still there. Only for sockets nothing else is reading from, like
+    clients waiting in a room. A TLS socket is peeked at below TLS, on
+    the TCP stream itself.
+    """
+    timeout = sock.gettimeout()
+    try:
+        sock.settimeout(0)
+        return socket.socket.recv(sock, 1, socket.MSG_PEEK) == b""
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+    finally:
+        try:
+            sock.settimeout(timeout)
+        except OSError:
+            pass
+
+
+def encode_reply(pubkey, ip, name, legacy, port=None):
+    """Peer info in whichever format the receiving client spoke"""
+    if legacy:
+        return f"{pubkey}:{ip}:{name}".encode()
+    return encode_peer(pubkey, ip, name, port)
+
+
+def encode_failure(reason, legacy):
+    if legacy:
+        return b"error"
+    return encode_error(reason)
+
+
+def read_peer(sock, on_mail=None):
+    """Read the mediator's reply, returning (pubkey, ip, name, port)
+
+    Mail streamed ahead of the reply goes to on_mail(blob). Raises
+    RedirectError when the room lives on another cluster node.
+    """
+    for msg_type, fields in _frames(sock):
+        if msg_type != MSG_MAIL:
+            break
+        if on_mail:
+            on_mail(fields.get(FIELD_BLOB, b""))
+    if msg_type == MSG_REDIRECT:
+        raise RedirectError(fields.get(FIELD_NODE, b"").decode())
+    if msg_type == MSG_ERROR:
+        raise ProtocolError(f"Mediator error: {fields.get(FIELD_REASON, b'').decode()}")
+    if msg_type != MSG_PEER:
+        raise ProtocolError(f"Expected peer info, got message type {msg_type}")
+    try:
+        return (bytes_to_int(fields[FIELD_PUBKEY]), bytes_to_ip(fields[FIELD_IP]),
+                fields[FIELD_NAME].decode(), _port(fields))
+    except KeyError as e:
+        raise ProtocolError(f"Peer info is missing field {e}")
+
+
+def read_stored(sock):
+    """Wait for a deposit to be confirmed; raises ProtocolError if refused"""
+    msg_type, fields = recv_frame(sock, FrameReader())
+    if msg_type == MSG_REDIRECT:
+        raise RedirectError(fields.get(FIELD_NODE, b"").decode())
+    if msg_type == MSG_ERROR:
+        raise ProtocolError(f"Mediator error: {fields.get(FIELD_REASON, b'').decode()}")
+    if msg_type != MSG_STORED:
+        raise ProtocolError(f"Expected deposit confirmation, got message type {msg_type}")
+
+
+def _frames(sock):
+    # Frames one by one, however many arrive in one read
+    reader = FrameReader()
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError("Connection closed by peer")
+        yield from reader.feed(data)
+
+
+def _benchmark(rounds=100000):
+    """Compare the legacy text handshake with the binary one"""
+    from DHKE import p
+    room, name, ip = "room123", "alice", "10.196.43.51"
+    pubkey = p - 12345
+
+    legacy_join = f"{room}:{pubkey}:{name}".encode()
+    legacy_peer = f"{pubkey}:{ip}:{name}".encode()
+    binary_join = encode_join(room, pubkey, name)
+    binary_peer = encode_peer(pubkey, ip, name)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        room_id, pubkey_str, who = legacy_join.decode().strip().split(":")
+        int(pubkey_str)
+        pubkey_str, _, who = legacy_peer.decode().strip().split(":", 2)
+        int(pubkey_str)
+    legacy_time = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        _, fields = FrameReader().feed(binary_join)[0]
+        bytes_to_int(fields[FIELD_PUBKEY])
+        fields[FIELD_ROOM].decode()
+        fields[FIELD_NAME].decode()
+        _, fields = FrameReader().feed(binary_peer)[0]
+        bytes_to_int(fields[FIELD_PUBKEY])
+        bytes_to_ip(fields[FIELD_IP])
+        fields[FIELD_NAME].decode()
+    binary_time = (time.perf_counter() - start) / rounds
+
+    legacy_bytes = len(legacy_join) + len(legacy_peer)
+    binary_bytes = len(binary_join) + len(binary_peer)
+    print(f"[BENCH] Bytes per join: legacy {legacy_bytes}, binary {binary_bytes} "
+          f"({legacy_bytes - binary_bytes} saved)")
+    print(f"[BENCH] Parse time per join: legacy {legacy_time * 1e6:.2f} us, "
+          f"binary {binary_time * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,170 @@
+# race.py
+#
+# Connection racing for the P2P link.
+#
+# Both peers listen and dial at the same time. The dialing socket is bound
+# to the listening port where the OS allows it, so crossing SYNs turn into a
+# TCP simultaneous open instead of failing. Every connection that comes up
+# is authenticated with an encrypted HELLO; the leader (the peer with the
+# larger public key) keeps the first authenticated one and tells the other
+# side with a SELECT frame. Everything else is closed.
+
+import hashlib
+import socket
+import threading
+import time
+from link import LENGTH, MAX_FRAME, encrypt_frame, decrypt_frame
+
+FRAME_HELLO = 16
+FRAME_SELECT = 17
+
+RACE_TIMEOUT = 10.0  # Seconds before a race counts as a failed attempt
+DIAL_RETRY = 0.05  # Seconds between dials while the peer isn't listening yet
+HANDSHAKE_TIMEOUT = 5.0
+
+
+def create_listener(port):
+    """Listening socket that a dialer can share its port with"""
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind(('', port))
+    listener.listen(4)
+    return listener
+
+
+def _hello_token(aes_key):
+    return hashlib.sha256(aes_key + b"p2p-hello").digest()[:16]
+
+
+def _recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed during handshake")
+        data += chunk
+    return bytes(data)
+
+
+def _recv_frame(sock, aes_key):
+    length = LENGTH.unpack(_recv_exact(sock, LENGTH.size))[0]
+    if length > MAX_FRAME:
+        raise ValueError("Frame too large")
+    frame_type, _, payload = decrypt_frame(aes_key, _recv_exact(sock, length))
+    return frame_type, payload
+
+
+class _Race:
+    def __init__(self, aes_key, leader):
+        self.aes_key = aes_key
+        self.leader = leader
+        self.winner = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.sockets = []
+        self.last_error = None
+
+    def track(self, sock):
+        with self.lock:
+            if self.done.is_set():
+                sock.close()
+                return False
+            self.sockets.append(sock)
+            return True
+
+    def handshake(self, sock):
+        """Authenticate a fresh connection and, if it wins, claim it"""
+        try:
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            token = _hello_token(self.aes_key)
+            sock.sendall(encrypt_frame(self.aes_key, FRAME_HELLO, token))
+            frame_type, payload = _recv_frame(sock, self.aes_key)
+            if frame_type != FRAME_HELLO or payload != token:
+                raise ValueError("Peer failed authentication")
+
+            if self.leader:
+                with self.lock:
+                    if self.done.is_set():
+                        return
+                    sock.sendall(encrypt_frame(self.aes_key, FRAME_SELECT, b""))
+                    self._win(sock)
+            else:
+                # The connection sits here until the leader picks it or
+                # closes it after picking another one.
+                sock.settimeout(RACE_TIMEOUT)
+                frame_type, _ = _recv_frame(sock, self.aes_key)
+                if frame_type != FRAME_SELECT:
+                    raise ValueError("Expected SELECT from leader")
+                with self.lock:
+                    if not self.done.is_set():
+                        self._win(sock)
+        except (OSError, ValueError) as e:
+            self.last_error = e
+
+    def _win(self, sock):
+        sock.settimeout(None)
+        self.winner = sock
+        self.done.set()
+
+    def accept_loop(self, listener):
+        while not self.done.is_set():
+            try:
+                sock, _ = listener.accept()
+            except socket.timeout:
+                continue
+            except OSError as e:
+                self.last_error = e
+                return
+            if self.track(sock):
+                threading.Thread(target=self.handshake, args=(sock,), daemon=True).start()
+
+    def dial_loop(self, peer_addr, local_port):
+        while not self.done.is_set():
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            try:
+                try:
+                    sock.bind(('', local_port))
+                except OSError:
+                    pass  # Fall back to an ephemeral port; no simultaneous open
+                sock.settimeout(HANDSHAKE_TIMEOUT)
+                sock.connect(peer_addr)
+            except OSError as e:
+                sock.close()
+                self.last_error = e
+                time.sleep(DIAL_RETRY)
+                continue
+            if self.track(sock):
+                self.handshake(sock)
+            if not self.done.is_set():
+                time.sleep(DIAL_RETRY)
+
+    def close_losers(self):
+        with self.lock:
+            self.done.set()
+            for sock in self.sockets:
+                if sock is not self.winner:
+                    sock.close()
+
+
+def race_connect(listener, peer_addr, aes_key, leader, timeout=RACE_TIMEOUT):
+    """Return the first authenticated P2P socket, from either direction
+
+    listener should come from create_listener(); it is shared by every
+    race for the lifetime of the session. Raises OSError if no connection
+    wins within the timeout.
+    """
+    race = _Race(aes_key, leader)
+    listener.settimeout(0.1)  # Raises OSError here if the session closed it
+    local_port = listener.getsockname()[1]
+    threading.Thread(target=race.accept_loop, args=(listener,), daemon=True).start()
+    threading.Thread(target=race.dial_loop, args=(peer_addr, local_port), daemon=True).start()
+    race.done.wait(timeout)
+    race.close_losers()
+    if race.winner is None:
+        raise OSError(f"P2P race timed out ({race.last_error or 'no connection'})")
+    return race.winner
@@ -1,54 +1,391 @@
+import os
 import socket
 import threading
+import time
+import protocol
+from admission import Admission, PrefixSet, reject
+from cluster import Cluster, parse_node, PROBE_TIMEOUT
+from postbox import Postbox, MailboxFull, EXPIRE_INTERVAL
+from presence import Presence, PresenceError, User, PRESENCE_ROOM, dial_room
+from matchmaking import Matchmaker, MatchError, Waiter, format_stats
+from waiting import WaitingRooms, RoomWaiter
+from workers import WorkerPool
+from tls import server_context, accept_tls, format_stats as format_tls_stats
+from tracing import Tracer
 
 host = '0.0.0.0' # Listen on all interfaces
 port = 6000
 
-rooms = {}  # room_id: (pubkey, conn, addr, name)
+# Cluster mode: start every mediator with the same member list plus its own
+# entry, e.g. P2P_CLUSTER=10.0.0.1:6000,10.0.0.2:6000 P2P_NODE=10.0.0.2:6000
+cluster_nodes = [n.strip() for n in os.environ.get("P2P_CLUSTER", "").split(",") if n.strip()]
+cluster = None
+if cluster_nodes:
+    node = os.environ.get("P2P_NODE", "")
+    port = parse_node(node)[1]
+    cluster = Cluster(node, cluster_nodes)
+FORWARD_TIMEOUT = 5.0  # Seconds to reach the owning node when forwarding
 
-def handle_client(conn, addr):
+# Admission control: per-IP token buckets, a cap on connections being
+# served and an optional blocklist.txt of addresses/CIDR prefixes
+admission = Admission(rate=5.0, burst=20, max_connections=1000,
+                      blocklist=PrefixSet.load("blocklist.txt"))
+if cluster:
+    for member in cluster.member_ips:
+        admission.allowlist.add(member)  # Forwarded joins all come from one node
+    for member in cluster.unresolved:
+        print(f"[CLUSTER] Can't resolve {member}; joins it forwards will be refused")
+REPORT_INTERVAL = 10.0  # Seconds between rejection summaries
+
+# Admitted connections are handled by a fixed pool of worker threads; when
+# every worker is busy and the backlog is full, new ones are reset
+pool = WorkerPool(workers=64, backlog=1024)
+
+# Offline mail (opt-in): P2P_POSTBOX=<directory> keeps end-to-end encrypted
+# blobs for peers that aren't online, until they next join (see postbox.py)
+postbox = Postbox(os.environ["P2P_POSTBOX"]) if os.environ.get("P2P_POSTBOX") else None
+
+# Presence: registered clients stay online on a control connection and can
+# be dialed by name or key instead of sharing a room (see presence.py)
+presence = Presence(max_users=100000)
+
+# TLS (opt-in): P2P_TLS_CERT=<certificate chain> and P2P_TLS_KEY=<key> (if not
+# in the same file) let clients with P2P_TLS_CA join over TLS and resume their
+# session on later joins; plaintext clients are still served (see tls.py)
+tls_context = (server_context(os.environ["P2P_TLS_CERT"], os.environ.get("P2P_TLS_KEY"))
+               if os.environ.get("P2P_TLS_CERT") else None)
+
+JOIN_TIMEOUT = 10.0  # Seconds a new connection gets to send its whole join
+WAIT_TIMEOUT = 600.0  # Seconds a client may wait in a room for its peer
+REAP_INTERVAL = 5.0  # Seconds between sweeps for hung-up or expired waiters
+
+def send_queue_match(a, b):
+    """Send two clients paired by the matchmaker each other's details"""
+    print(f"[MATCH] Queue {a.queue}: connecting {a.name} ({a.addr}) and {b.name} ({b.addr})")
     try:
-        data = conn.recv(4096).decode()
-        parts = data.strip().split(":")
+        a.conn.send(protocol.encode_peer(b.pubkey, b.addr[0], b.name, b.port))
+        b.conn.send(protocol.encode_peer(a.pubkey, a.addr[0], a.name, a.port))
+    except OSError as e:
+        print("[ERROR] Failed to send to both clients:", e)
+        a.conn.close()
+        b.conn.close()
+    admission.release()
+    admission.release()
 
-        if len(parts) != 3:
-            print(f"[ERROR] Invalid data from {addr}: {data}")
-            conn.send(b"error")
-            return
+def drop_queued(waiter, reason):
+    """Tell a queued client it was dropped and free its slot"""
+    print(f"[PURGE] {waiter.name} ({waiter.addr}) removed from queue {waiter.queue}: {reason}")
+    try:
+        waiter.conn.send(protocol.encode_error(reason))
+    except OSError:
+        pass
+    waiter.conn.close()
+    admission.release()
+
+# Matchmaking: clients wait in typed queues (e.g. agents and customers) and
+# are paired with any peer of the other role in batched rounds
+matchmaker = Matchmaker(send_queue_match, drop_queued,
+                        is_gone=lambda waiter: protocol.peer_closed(waiter.conn),
+                        wait_timeout=WAIT_TIMEOUT)
+
+rooms = WaitingRooms()  # Waiters by room, IP and join time (see waiting.py)
+
+def drop_waiter(waiter, reason):
+    """Tell a waiter it was dropped (if it can still hear it) and free its slot"""
+    print(f"[PURGE] {waiter.name} ({waiter.addr}) removed from room {waiter.room}: {reason}")
+    try:
+        waiter.conn.send(protocol.encode_failure(reason, waiter.legacy))
+    except OSError:
+        pass
+    waiter.conn.close()
+    admission.release()
+
+def reap_waiters():
+    """Purge waiters that hung up or waited too long"""
+    while True:
+        time.sleep(REAP_INTERVAL)
+        expired = rooms.joined_before(time.monotonic() - WAIT_TIMEOUT)
+        candidates = [(waiter, "Timed out waiting for a peer") for waiter in expired]
+        expired = set(expired)
+        # Sockets are checked outside the locks; only waiters still there go
+        candidates += [(waiter, "Disconnected while waiting") for waiter in rooms.oldest()
+                       if waiter not in expired and protocol.peer_closed(waiter.conn)]
+        for waiter, reason in candidates:
+            if rooms.remove(waiter):
+                drop_waiter(waiter, reason)
+
+def report_queues():
+    """Print matchmaking stats while there is anything to report"""
+    last = None
+    while True:
+        time.sleep(REPORT_INTERVAL)
+        stats = matchmaker.stats()
+        current = (stats["queued"], stats["matched"], stats["dropped"])
+        if current != last and (stats["queued"] or last is not None):
+            print(f"[QUEUES] {format_stats(stats)}")
+        last = current
+
+def report_tls():
+    """Print how many TLS handshakes were full and how many resumed"""
+    last = None
+    while True:
+        time.sleep(REPORT_INTERVAL)
+        current = format_tls_stats(tls_context)
+        if current != last:
+            print(f"[TLS] {current}")
+        last = current
+
+def expire_mail():
+    """Delete mail nobody collected within the TTL"""
+    while True:
+        time.sleep(EXPIRE_INTERVAL)
+        freed = postbox.expire()
+        if freed:
+            print(f"[MAIL] Expired {freed} bytes of undelivered mail")
+
+def take_deposits(conn, addr, deposit):
+    """Store deposits, confirming each, until the client hangs up; closes conn"""
+    stored = 0
+    try:
+        while True:
+            room_id, mailbox, blob = deposit
+            try:
+                if postbox is None:
+                    raise MailboxFull("This mediator keeps no mail")
+                postbox.deposit(mailbox, blob)
+                stored += 1
+                conn.sendall(protocol.encode_stored())
+            except MailboxFull as e:
+                conn.sendall(protocol.encode_error(str(e)))
+            try:
+                msg_type, deposit = protocol.read_request(conn, timeout=JOIN_TIMEOUT)
+            except (ConnectionError, socket.timeout, protocol.ProtocolError):
+                break
+            if msg_type != protocol.MSG_DEPOSIT:
+                break
+    finally:
+        conn.close()
+    print(f"[MAIL] {stored} blob(s) deposited by {addr}")
+
+def deliver_mail(conn, addr, name, mailbox):
+    """Stream a joining client's mail to it, a segment per write"""
+    delivered = postbox.deliver(mailbox, lambda blobs: conn.sendall(
+        b"".join(protocol.encode_mail(blob) for blob in blobs)))
+    if delivered:
+        print(f"[MAIL] {delivered} blob(s) delivered to {name} ({addr})")
 
-        room_id, pubkey_str, name = parts
+def serve_presence(conn, addr, request):
+    """Keep a registered client online until it hangs up"""
+    name, key, contacts = request
+    user = User(name, key, conn, addr, contacts)
+    try:
+        presence.register(user)
+    except PresenceError as e:
+        conn.send(protocol.encode_error(str(e)))
+        conn.close()
+        return
+    print(f"[ONLINE] {name} ({addr}), {len(presence)} online")
+    if presence.serve(user):
+        print(f"[OFFLINE] {name} ({addr}), {len(presence)} online")
+
+def dial(conn, addr, request):
+    """Put a caller in touch with an online user: both get a private room"""
+    name, target, key = request
+    callee = presence.lookup(target, key)
+    room_id = dial_room()
+    if callee is None or not callee.push(protocol.encode_invite(room_id, name)):
+        conn.send(protocol.encode_error(f"{target or 'That user'} is not online"))
+        return
+    print(f"[DIAL] {name} ({addr}) -> {callee.name} in room {room_id}")
+    conn.send(protocol.encode_invite(room_id, callee.name))
+
+def forward_join(conn, addr, owner, room_id, pubkey, name, p2p_port):
+    """Relay a legacy client's join to the owning node
+
+    The reply can take as long as the room waits for its second peer, so
+    it is relayed back on a thread of its own rather than a worker. The
+    client waits in the owner's room table, counted by its admission.
+    """
+    s = socket.create_connection(parse_node(owner), timeout=FORWARD_TIMEOUT)
+    try:
+        s.sendall(protocol.encode_join(room_id, pubkey, name, p2p_port, ip=addr[0]))
+    except OSError:
+        s.close()
+        raise
+    s.settimeout(None)
+    threading.Thread(target=relay_reply, args=(conn, addr, s), daemon=True).start()
+
+def relay_reply(conn, addr, s):
+    """Pass the owning node's answer to a forwarded join back to the client"""
+    with s:
         try:
-            pubkey = int(pubkey_str)
-        except ValueError:
-            print(f"[ERROR] Invalid pubkey from {addr}: {pubkey_str}")
-            conn.send(b"error")
+            pubkey1, ip1, name1, p2p_port1 = protocol.read_peer(s)
+            conn.send(protocol.encode_reply(pubkey1, ip1, name1, True, p2p_port1))
+        except protocol.ProtocolError as e:
+            conn.send(protocol.encode_failure(str(e), True))
+        except OSError as e:
+            print(f"[FORWARD] Lost the owner's reply for {addr}: {e}")
+
+def route_join(conn, addr, room_id, pubkey, name, p2p_port, legacy):
+    """Send a join for a room this node doesn't own to the owner
+
+    Returns False if the room turned out to be ours after all (every node
+    before us on the ring is down).
+    """
+    while True:
+        owner = cluster.owner(room_id)
+        if owner == cluster.node:
+            return False
+        try:
+            if not legacy:
+                # Clients route by the same ring, so a misrouted join is
+                # rare enough to check the owner is up before redirecting.
+                socket.create_connection(parse_node(owner), timeout=PROBE_TIMEOUT).close()
+                print(f"[REDIRECT] {name} ({addr}) room {room_id} -> {owner}")
+                conn.send(protocol.encode_redirect(owner))
+            else:
+                print(f"[FORWARD] {name} ({addr}) room {room_id} -> {owner}")
+                forward_join(conn, addr, owner, room_id, pubkey, name, p2p_port)
+            return True
+        except OSError as e:
+            print(f"[CLUSTER] {owner} unreachable ({e}), trying the next node")
+            cluster.mark_down(owner)
+
+def handle_client(conn, addr):
+    tracer = Tracer(f"{addr[0]}:{addr[1]}", process="mediator")
+    waiting = False
+    try:
+        if tls_context:
+            try:
+                with tracer.span("tls_handshake"):
+                    conn = accept_tls(conn, tls_context, JOIN_TIMEOUT)
+            except OSError as e:
+                print(f"[TLS] Handshake with {addr} failed: {e}")
+                return
+            if conn is None:
+                return  # Closed before joining, e.g. a cluster liveness probe
+        try:
+            with tracer.span("read_join"):
+                msg_type, request = protocol.read_request(conn, timeout=JOIN_TIMEOUT)
+        except protocol.ProtocolError as e:
+            print(f"[ERROR] Invalid data from {addr}: {e}")
+            conn.send(protocol.encode_failure(str(e), e.legacy))
+            return
+        except ConnectionError:
+            return  # Closed before joining, e.g. a cluster liveness probe
+        except socket.timeout:
+            print(f"[TIMEOUT] {addr} sent no join within {JOIN_TIMEOUT:.0f}s")
+            conn.close()
+            return
+
+        if msg_type == protocol.MSG_DEPOSIT:
+            # Mail is kept by the room's owner, where the recipient joins
+            if not (cluster and route_join(conn, addr, request[0], None, "(deposit)", None, False)):
+                take_deposits(conn, addr, request)
+            return
+        if msg_type in (protocol.MSG_REGISTER, protocol.MSG_DIAL):
+            # One node keeps the whole registry
+            if cluster and route_join(conn, addr, PRESENCE_ROOM, None, request[0], None, False):
+                return
+            if msg_type == protocol.MSG_DIAL:
+                dial(conn, addr, request)
+                return
+            admission.release()  # Online users are capped by the registry instead
+            waiting = True  # So the slot isn't released twice
+            # Stays connected while online, so not on a worker
+            threading.Thread(target=serve_presence, args=(conn, addr, request),
+                             daemon=True).start()
             return
+        if msg_type == protocol.MSG_ENQUEUE:
+            queue_name, role, priority, pubkey, name, p2p_port = request
+            if cluster and route_join(conn, addr, queue_name, pubkey, name, p2p_port, False):
+                return
+            try:
+                matchmaker.enqueue(Waiter(queue_name, role, priority, conn, addr, name,
+                                          pubkey, p2p_port))
+            except MatchError as e:
+                conn.send(protocol.encode_error(str(e)))
+                return
+            waiting = True  # Stays admitted until matched or dropped
+            print(f"[QUEUED] {name} ({addr}) as {role or 'any'} in queue {queue_name}")
+            return
+        room_id, pubkey, name, p2p_port, forwarded_ip, legacy, mailbox = request
+
+        if cluster:
+            if forwarded_ip and cluster.is_member(addr[0]):
+                addr = (forwarded_ip, addr[1])  # Forwarded joins stay here, no second hop
+            else:
+                with tracer.span("route", room=room_id):
+                    if route_join(conn, addr, room_id, pubkey, name, p2p_port, legacy):
+                        return
+
+        if mailbox and postbox:
+            with tracer.span("deliver_mail"):
+                deliver_mail(conn, addr, name, mailbox)
+
+        # Pair with the room's waiter or become it, in one step; a waiter
+        # that hung up would waste this client's session, so it is replaced
+        waiter, dead = rooms.join(RoomWaiter(room_id, pubkey, conn, addr, name, p2p_port, legacy),
+                                  is_gone=lambda waiter: protocol.peer_closed(waiter.conn))
+        waiting = waiter is None  # Stays admitted until matched or purged
+        if dead:
+            drop_waiter(dead, "Disconnected while waiting")
 
-        if room_id not in rooms:
-            rooms[room_id] = (pubkey, conn, addr, name)
+        if waiting:
             print(f"[WAITING] {name} ({addr}) waiting in room {room_id}")
         else:
-            pubkey1, conn1, addr1, name1 = rooms.pop(room_id)
-            print(f"[MATCH] Connecting {name1} ({addr1}) and {name} ({addr})")
+            admission.release()  # The waiter's slot
+            print(f"[MATCH] Connecting {waiter.name} ({waiter.addr}) and {name} ({addr})")
 
             try:
                 # Send peer info to both clients: pubkey and IP
-                conn1.send(f"{pubkey}:{addr[0]}:{name}".encode())
-                conn.send(f"{pubkey1}:{addr1[0]}:{name1}".encode())
+                with tracer.span("match", room=room_id):
+                    waiter.conn.send(protocol.encode_reply(pubkey, addr[0], name, waiter.legacy,
+                                                           p2p_port))
+                    conn.send(protocol.encode_reply(waiter.pubkey, waiter.addr[0], waiter.name,
+                                                    legacy, waiter.port))
             except Exception as e:
                 print("[ERROR] Failed to send to both clients:", e)
-                conn1.close()
+                waiter.conn.close()
                 conn.close()
     except Exception as e:
         print("[SERVER ERROR]", e)
     finally:
-        pass  # Let client handle socket closing
+        tracer.flush()
+        if not waiting:
+            admission.release()
+        # Let client handle socket closing
 
 server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 server.bind((host, port))
 server.listen(5)
 print(f"[MEDIATOR] Listening on {host}:{port}")
+if cluster:
+    print(f"[MEDIATOR] Cluster node {cluster.node} of {len(cluster.ring.nodes)}")
+threading.Thread(target=reap_waiters, daemon=True).start()
+matchmaker.start()
+threading.Thread(target=report_queues, daemon=True).start()
+if tls_context:
+    print(f"[MEDIATOR] TLS enabled with {os.environ['P2P_TLS_CERT']}")
+    threading.Thread(target=report_tls, daemon=True).start()
+if postbox:
+    print(f"[MEDIATOR] Keeping offline mail in {postbox.path} ({postbox.size} bytes waiting)")
+    threading.Thread(target=expire_mail, daemon=True).start()
 
+last_report = time.monotonic()
+reported = 0
 while True:
     conn, addr = server.accept()
-    threading.Thread(target=handle_client, args=(conn, addr)).start()
+    if admission.admit(addr[0]):
+        reject(conn)  # No thread, no room table
+        if admission.total_rejected != reported and time.monotonic() - last_report > REPORT_INTERVAL:
+            print(f"[ADMISSION] Rejected {admission.rejected}, serving {admission.active}")
+            last_report, reported = time.monotonic(), admission.total_rejected
+        continue
+    if not pool.submit(handle_client, conn, addr):
+        admission.release()
+        reject(conn)  # Every worker busy and the backlog full
+        if time.monotonic() - last_report > REPORT_INTERVAL:
+            print(f"[BUSY] Worker backlog full, {pool.refused} connection(s) refused so far")
+            last_report = time.monotonic()
@@ -0,0 +1,92 @@
+# session_bench.py
+#
+# Drives many headless sessions from one process.
+#
+#   python server.py                        # in another terminal
+#   python session_bench.py [pairs] [messages] [server_host] [batch_window_ms]
+#
+# Every pair joins its own room, both ends listen on ephemeral ports, and
+# each session sends the given number of messages to its peer. Reports
+# how long it took for every link to come up and for every message to
+# arrive, plus the thread count this costs. With a batch window the
+# sessions pack small messages into shared frames (see link.py).
+
+import sys
+import threading
+import time
+from link import STATE_CONNECTED
+from session import P2PSession
+
+TIMEOUT = 60.0
+
+
+class Bot:
+    def __init__(self, name, room, server_host, expected, batch_window):
+        self.expected = expected
+        self.received = 0
+        self.connected = threading.Event()
+        self.done = threading.Event()
+        self.errors = []
+        self.session = P2PSession(name, room, server_host, listen_port=0,
+                                  on_message=self.on_message, on_state=self.on_state,
+                                  on_error=self.errors.append, batch_window=batch_window)
+
+    def on_state(self, state, detail):
+        if state == STATE_CONNECTED:
+            self.connected.set()
+
+    def on_message(self, data):
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+
+def wait_all(events, deadline):
+    for event in events:
+        if not event.wait(max(0, deadline - time.perf_counter())):
+            return False
+    return True
+
+
+def main():
+    pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    server_host = sys.argv[3] if len(sys.argv) > 3 else "127.0.0.1"
+    batch_window = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.0
+
+    bots = []
+    for i in range(pairs):
+        room = f"bench-{i}-{time.time_ns()}"
+        bots.append(Bot(f"bot{i}a", room, server_host, messages, batch_window))
+        bots.append(Bot(f"bot{i}b", room, server_host, messages, batch_window))
+
+    start = time.perf_counter()
+    for bot in bots:
+        bot.session.connect_async()
+    connected = wait_all([bot.connected for bot in bots], start + TIMEOUT)
+    connect_time = time.perf_counter() - start
+    up = sum(bot.connected.is_set() for bot in bots)
+    print(f"[BENCH] {up}/{len(bots)} sessions connected in {connect_time:.2f}s "
+          f"({threading.active_count()} threads)")
+    if not connected:
+        errors = [e for bot in bots for e in bot.errors]
+        print(f"[BENCH] Gave up waiting; first error: {errors[0] if errors else 'none'}")
+
+    start = time.perf_counter()
+    for n in range(messages):
+        for bot in bots:
+            if bot.connected.is_set():
+                bot.session.send(f"message {n}")
+    delivered = wait_all([bot.done for bot in bots if bot.connected.is_set()],
+                         start + TIMEOUT)
+    elapsed = time.perf_counter() - start
+    total = sum(bot.received for bot in bots)
+    print(f"[BENCH] {total} messages delivered in {elapsed:.2f}s "
+          f"({total / elapsed:.0f} msg/s){'' if delivered else ', some missing'}")
+
+    for bot in bots:
+        bot.session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# startup_bench.py
+#
+# Startup benchmark for the clients.
+#
+#   python startup_bench.py [runs]
+#
+# Measures time-to-prompt of client.py and time-to-first-window of the GUI
+# client from process spawn, and lists the slowest imports on the way
+# there using -X importtime. The first run is the coldest; drop the OS
+# page cache beforehand for a true cold-cache number.
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+GUI_DIR = os.path.join(ROOT, "GUI app")
+TARGET_MS = 150
+
+GUI_PROBE = (
+    "import client\n"
+    "app = client.P2PChatGUI()\n"
+    "app.root.update()\n"
+    "print('ready', flush=True)\n"
+    "app.root.destroy()\n"
+)
+
+
+def time_to_prompt():
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "client.py"], cwd=ROOT,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    seen = b""
+    while b"Enter your name:" not in seen:
+        byte = proc.stdout.read(1)
+        if not byte:
+            break
+        seen += byte
+    elapsed = time.perf_counter() - start
+    proc.kill()
+    proc.wait()
+    return elapsed if b"Enter your name:" in seen else None
+
+
+def time_to_window():
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", GUI_PROBE], cwd=GUI_DIR,
+                          capture_output=True, text=True)
+    if "ready" not in proc.stdout:
+        return None
+    return time.perf_counter() - start
+
+
+def slowest_imports(cwd, args, depth=0, count=8):
+    """Top imports at one nesting depth by cumulative time (-X importtime)"""
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=cwd,
+                          stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        if (len(name) - len(name.lstrip()) - 1) // 2 != depth:
+            continue  # Counted in its parent's cumulative time
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def report(label, samples):
+    samples = [s for s in samples if s is not None]
+    if not samples:
+        print(f"[BENCH] {label}: skipped (could not start, no display?)")
+        return
+    first, best = samples[0] * 1000, min(samples) * 1000
+    status = "OK" if first <= TARGET_MS else "over target"
+    print(f"[BENCH] {label}: first {first:.1f} ms, best {best:.1f} ms "
+          f"(target {TARGET_MS} ms, {status})")
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    report("client.py time-to-prompt", [time_to_prompt() for _ in range(runs)])
+    print("[BENCH] Slowest imports before the prompt (cumulative us, self us):")
+    for cumulative, self_us, name in slowest_imports(ROOT, ["client.py"]):
+        print(f"    {cumulative:>8} {self_us:>8}  {name}")
+
+    report("GUI time-to-first-window", [time_to_window() for _ in range(runs)])
+    print("[BENCH] Slowest imports before the window (cumulative us, self us):")
+    for cumulative, self_us, name in slowest_imports(GUI_DIR, ["-c", "import client"], depth=1):
+        print(f"    {cumulative:>8} {self_us:>8}  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# workers.py
+#
+# Bounded worker pool for the mediator's accept loop.
+#
+# Every admitted connection used to get a thread of its own, so a burst
+# of joins meant a burst of threads. The pool runs at most `workers`
+# handlers at once and lets up to `backlog` more wait for a free worker;
+# past that submit() refuses, and the accept loop resets the connection
+# like any other rejected one. Handlers that keep a connection for long
+# (a presence control connection, a legacy join forwarded to another
+# node) move it to a thread of their own so they don't pin a worker.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+WORKERS = 64  # Connections handled at once
+BACKLOG = 1024  # Admitted connections that may wait for a free worker
+
+
+class WorkerPool:
+    """Fixed number of worker threads behind a bounded queue"""
+
+    def __init__(self, workers=WORKERS, backlog=BACKLOG):
+        self.workers = workers
+        self.backlog = backlog
+        self.pending = 0  # Submitted and not finished yet, running or queued
+        self.refused = 0
+        self._slots = threading.BoundedSemaphore(workers + backlog)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="mediator")
+
+    def submit(self, fn, *args):
+        """Run fn(*args) on a worker; False if every worker and queue slot is taken"""
+        if not self._slots.acquire(blocking=False):
+            self.refused += 1
+            return False
+        with self._lock:
+            self.pending += 1
+        self._executor.submit(self._run, fn, args)
+        return True
+
+    def close(self):
+        """Stop taking work; handlers already submitted still run"""
+        self._executor.shutdown(wait=False)
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+
+
+def _benchmark(joins=10000, rooms=500):
+    """Lost matches with 10k concurrent joins spread over a few hundred rooms"""
+    import sys
+    from waiting import WaitingRooms, RoomWaiter
+    print(f"[BENCH] {joins} joins to {rooms} rooms through {WORKERS} workers")
+    sys.setswitchinterval(1e-6)  # Switch threads as often as possible to expose races
+
+    def run(join):
+        table = WaitingRooms()
+        matches = []
+        pool = WorkerPool(backlog=joins)
+        gate = threading.Event()  # Every join is queued before any runs
+
+        def joiner(i):
+            gate.wait()
+            peer = join(table, RoomWaiter(f"room{i % rooms}", i, None, ("10.0.0.1", i), f"user{i}"))
+            if peer is not None:
+                matches.append(peer)
+
+        start = time.perf_counter()
+        for i in range(joins):
+            pool.submit(joiner, i)
+        gate.set()
+        while pool.pending:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        pool.close()
+        lost = joins - 2 * len(matches) - len(table)
+        return len(matches), len(table), lost, elapsed
+
+    def check_then_act(table, waiter):
+        # The shape of the old handler: look, then take or fill in separate steps
+        peer = table.get(waiter.room)
+        if peer is not None and table.remove(peer):
+            return peer
+        table.add(waiter)  # False means someone else got there first: the join is lost
+        return None
+
+    def atomic(table, waiter):
+        return table.join(waiter)[0]
+
+    for label, join in (("check-then-act", check_then_act), ("join()", atomic)):
+        matched, waiting, lost, elapsed = run(join)
+        print(f"[BENCH] {label}: {matched} matches, {waiting} waiting, {lost} lost "
+              f"({joins / elapsed:.0f} joins/s)")
+    sys.setswitchinterval(0.005)
+
+
+if __name__ == "__main__":
+    _benchmark()